@@ -0,0 +1,142 @@
+"""
+Benchmark: gmail backup wall time of the threaded engine and the async engine with a simulated API latency.
+
+Usage: python benchmarks/async_gmail.py [--messages 2000] [--latency-ms 50] [--threads 5] [--max-in-flight 200]
+
+The threaded engine calls an in-process mock service wrapper that sleeps the latency per request,
+the async engine calls a local mock Gmail HTTP server (aiohttp) with the same latency.
+Both engines write into a temporary file storage. The async engine requires the aiohttp package.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gwbackupy.async_gmail import AsyncGmail  # noqa: E402
+from gwbackupy.gmail import Gmail  # noqa: E402
+from gwbackupy.helpers import encode_base64url  # noqa: E402
+from gwbackupy.providers.async_gmail_client import AsyncGmailClient  # noqa: E402
+from gwbackupy.storage.async_storage_interface import (  # noqa: E402
+    AsyncStorageAdapter,
+)
+from gwbackupy.storage.file_storage import FileStorage  # noqa: E402
+from gwbackupy.tests.mock_gmail_service_wrapper import (  # noqa: E402
+    MockGmailServiceWrapper,
+)
+
+EMAIL = "benchmark@example.com"
+
+
+class LatencyGmailServiceWrapper(MockGmailServiceWrapper):
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    def get_messages(self, email: str, q: str) -> dict[str, dict[str, any]]:
+        time.sleep(self.latency)
+        return super().get_messages(email, q)
+
+    def get_message(
+        self, email: str, message_id: str, message_format: str = "minimal"
+    ) -> dict[str, any] | None:
+        time.sleep(self.latency)
+        message = super().get_message(email, message_id, message_format)
+        return dict(message) if message is not None else None
+
+    def get_labels(self, email: str) -> list[dict[str, any]]:
+        time.sleep(self.latency)
+        return super().get_labels(email)
+
+
+def wrapper_with_messages(latency: float, count: int) -> LatencyGmailServiceWrapper:
+    rnd = random.Random(count)
+    sw = LatencyGmailServiceWrapper(latency)
+    sw.inject_label(EMAIL, "INBOX", "INBOX", "system")
+    now = int(time.time() * 1000)
+    for i in range(count):
+        body = " ".join(str(rnd.getrandbits(32)) for _ in range(rnd.randint(20, 400)))
+        raw = f"Subject: message #{i}\r\nTo: {EMAIL}\r\n\r\n{body}\r\n".encode("utf-8")
+        sw.inject_message(
+            EMAIL,
+            {
+                "id": f"{i:016x}",
+                "raw": encode_base64url(raw),
+                "internalDate": str(now - i * 60000),
+                "labelIds": ["INBOX"],
+                "snippet": body[:80],
+            },
+        )
+    return sw
+
+
+def run_thread(args: argparse.Namespace, root: str) -> float:
+    sw = wrapper_with_messages(args.latency_ms / 1000.0, args.messages)
+    gmail = Gmail(
+        email=EMAIL,
+        storage=FileStorage(os.path.join(root, "thread")),
+        service_wrapper=sw,
+        batch_size=args.threads,
+    )
+    t = time.perf_counter()
+    if not gmail.backup():
+        raise RuntimeError("threaded backup failed")
+    return time.perf_counter() - t
+
+
+async def run_async(args: argparse.Namespace, root: str) -> tuple[float, int]:
+    from gwbackupy.tests.mock_gmail_server import MockGmailServer
+
+    sw = wrapper_with_messages(0, args.messages)
+    server = MockGmailServer(sw, latency=args.latency_ms / 1000.0)
+    base_url = await server.start()
+    client = AsyncGmailClient(
+        lambda email: email, base_url=base_url, max_connections=args.max_in_flight
+    )
+    storage = AsyncStorageAdapter(FileStorage(os.path.join(root, "async")))
+    gmail = AsyncGmail(EMAIL, storage, client, max_in_flight=args.max_in_flight)
+    try:
+        t = time.perf_counter()
+        if not await gmail.backup():
+            raise RuntimeError("async backup failed")
+        return time.perf_counter() - t, server.max_in_flight
+    finally:
+        await client.close()
+        await storage.close()
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--threads", type=int, default=5)
+    parser.add_argument("--max-in-flight", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="gwbackupy-bench-") as root:
+        print(f"messages: {args.messages}, latency: {args.latency_ms} ms per request")
+        elapsed = run_thread(args, root)
+        print(
+            f"thread ({args.threads} threads): {elapsed:.2f} s, {args.messages / elapsed:.0f} messages/s"
+        )
+        try:
+            elapsed, in_flight = asyncio.run(run_async(args, root))
+        except RuntimeError as e:
+            print(f"async engine is skipped: {e}")
+            return
+        print(
+            f"async (max. {args.max_in_flight} in flight, {in_flight} reached): {elapsed:.2f} s, "
+            f"{args.messages / elapsed:.0f} messages/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark: memory usage of FileLink objects.
+
+Usage: python benchmarks/file_link_memory.py [--links 5000000]
+
+Loads synthetic links (half metadata, half object with content hash) the same way as
+FileStorage.find() does, and reports the traced memory per link. The previous, dict based
+link representation is measured for comparison.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gwbackupy.storage.file_storage import FileLink  # noqa: E402
+
+
+class DictFileLink:
+    """The previous FileLink representation: instance __dict__ and a properties dict"""
+
+    def __init__(self):
+        self.id = None
+        self.path = None
+        self.properties = {}
+        self.extension = None
+
+    def fill(self, values: dict[str, any]):
+        self.id = values["object_id"]
+        self.path = values["path"]
+        self.extension = values["extension"]
+        for key, value in values.items():
+            if key not in ["object_id", "path", "extension"]:
+                # keys are parsed from the file names, so they are not shared
+                self.properties["".join(key)] = value
+        return self
+
+
+def file_names(count: int):
+    mutation = 1600000000000
+    for i in range(count // 2):
+        message_id = f"{i:016x}"
+        yield f"{message_id}.metadata=.mutation={mutation + i}.json"
+        yield f"{message_id}.ch=m{i:032x}.mutation={mutation + i}.object=.eml.gz"
+
+
+def measure(name: str, factory, count: int):
+    gc.collect()
+    tracemalloc.start()
+    t = time.perf_counter()
+    paths = [f"/data/2023/{day:02d}-01" for day in range(1, 13)]
+    links = []
+    for i, file_name in enumerate(file_names(count)):
+        m = FileLink.parse_file_name(file_name)
+        m["path"] = paths[i % len(paths)]
+        links.append(factory().fill(m))
+    elapsed = time.perf_counter() - t
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name}: {len(links)} links, {current / 1024 / 1024:.0f} MiB, "
+        f"{current / len(links):.0f} bytes/link, {elapsed:.1f}s"
+    )
+    del links
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--links", type=int, default=5000000)
+    args = parser.parse_args()
+    measure("FileLink", FileLink, args.links)
+    measure("dict based link", DictFileLink, args.links)
+
+
+if __name__ == "__main__":
+    main()
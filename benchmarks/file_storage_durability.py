@@ -0,0 +1,61 @@
+"""
+Benchmark: FileStorage put throughput by durability policy (none, file, group).
+
+Usage: python benchmarks/file_storage_durability.py [--messages 2000] [--size 20000] [--root <dir>]
+
+Every message is stored like a gmail backup: a gzip-sized object and a small metadata file.
+Use --root on the filesystem to be measured, the fsync cost depends heavily on the device.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gwbackupy.storage.file_storage import FileStorage  # noqa: E402
+
+
+def run(root: str, durability: str, messages: int, size: int) -> float:
+    storage = FileStorage(root, use_index=False, durability=durability)
+    payload = os.urandom(size)
+    metadata = b'{"labelIds": ["INBOX"]}'
+    start = 1600000000
+    t = time.perf_counter()
+    for i in range(messages):
+        message_id = f"{i:016x}"
+        timestamp = start + i * 3600
+        link = storage.new_link(message_id, "eml.gz", timestamp)
+        link.set_properties({"object": True})
+        if not storage.put(link, payload):
+            raise RuntimeError(f"put fail {link}")
+        link = storage.new_link(message_id, "json", timestamp)
+        link.set_properties({"metadata": True})
+        if not storage.put(link, metadata):
+            raise RuntimeError(f"put fail {link}")
+    if not storage.flush():
+        raise RuntimeError("flush fail")
+    return messages / (time.perf_counter() - t)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--root", type=str, default=None)
+    args = parser.parse_args()
+
+    for durability in FileStorage.durabilities:
+        with tempfile.TemporaryDirectory(
+            prefix="gwbackupy-benchmark-", dir=args.root
+        ) as root:
+            rate = run(root, durability, args.messages, args.size)
+            print(f"durability={durability}: {rate:.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark: FileStorage directory tree scanning, os.walk vs. the parallel scandir based DirectoryScanner.
+
+Usage: python benchmarks/file_storage_scan.py [--files 1000000] [--workers 1,4,8,16] [--root <dir>]
+
+The synthetic tree follows the FileStorage layout (<root>/<YYYY>/<MM-DD>) with empty message and
+metadata files. Use --root on the filesystem to be measured (e.g. an NFS mount), the tree is
+created once and reused by the next runs.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gwbackupy.storage.directory_scanner import DirectoryScanner  # noqa: E402
+from gwbackupy.storage import content_hash  # noqa: E402
+from gwbackupy.storage.file_storage import FileLink  # noqa: E402
+from gwbackupy.storage.storage_interface import LinkInterface  # noqa: E402
+
+
+def create_tree(root: str, files: int):
+    marker = os.path.join(root, f".benchmark-v2-{files}")
+    if os.path.exists(marker):
+        return
+    days = 365 * 5
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    mutation = 1600000000000
+    for i in range(files // 2):
+        day = start + timedelta(days=i % days)
+        path = os.path.join(root, day.strftime("%Y"), day.strftime("%m-%d"))
+        if i < days:
+            os.makedirs(path, exist_ok=True)
+        message_id = f"{i:016x}"
+        # the file names of the links written by the gmail backup
+        metadata = FileLink().fill(
+            {
+                "object_id": message_id,
+                "path": path,
+                "extension": "json",
+                "mutation": str(mutation + i),
+                "metadata": True,
+            }
+        )
+        message = FileLink().fill(
+            {
+                "object_id": message_id,
+                "path": path,
+                "extension": "eml.gz",
+                "mutation": str(mutation + i),
+                "object": True,
+            }
+        )
+        message.set_properties(
+            {
+                LinkInterface.property_content_hash: content_hash.generate(
+                    message_id.encode("utf-8")
+                )
+            }
+        )
+        for link in [metadata, message]:
+            open(link.get_file_path(), "wb").close()
+    open(marker, "wb").close()
+
+
+def scan_walk(root: str) -> int:
+    count = 0
+    for path, _, filenames in os.walk(root):
+        for file in filenames:
+            m = FileLink.parse_file_name(file)
+            if m is None:
+                continue
+            m["path"] = path
+            FileLink().fill(m)
+            count += 1
+    return count
+
+
+def parse_dir(path: str, filenames: list[str]) -> int:
+    count = 0
+    for file in filenames:
+        m = FileLink.parse_file_name(file)
+        if m is None:
+            continue
+        m["path"] = path
+        FileLink().fill(m)
+        count += 1
+    return count
+
+
+def scan_parallel(root: str, workers: int) -> int:
+    scanner = DirectoryScanner(root, parse_dir, workers=workers)
+    return sum(count for _, count in scanner.scan())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--workers", type=str, default="1,4,8,16")
+    parser.add_argument("--root", type=str, default=None)
+    args = parser.parse_args()
+
+    root = args.root
+    tmp = None
+    if root is None:
+        tmp = tempfile.TemporaryDirectory(prefix="gwbackupy-benchmark-")
+        root = tmp.name
+    try:
+        t = time.perf_counter()
+        create_tree(root, args.files)
+        print(f"tree: {args.files} files in {time.perf_counter() - t:.1f}s ({root})")
+
+        t = time.perf_counter()
+        count = scan_walk(root)
+        print(f"os.walk: {count} links in {time.perf_counter() - t:.2f}s")
+        for workers in [int(w) for w in args.workers.split(",")]:
+            t = time.perf_counter()
+            count = scan_parallel(root, workers)
+            print(
+                f"DirectoryScanner(workers={workers}): {count} links in {time.perf_counter() - t:.2f}s"
+            )
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark: message object codecs, CPU seconds and stored bytes (gzip, zstd, zstd with trained dictionary).
+
+Usage: python benchmarks/object_codec.py [--messages 10000] [--mbox <path>]
+
+Without --mbox, synthetic messages are generated with real-shaped headers (Received chains,
+DKIM signatures, MIME parts) and a text body. With --mbox, the first messages of the mailbox
+are used. The zstd codecs require the zstandard package.
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import mailbox
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gwbackupy.gmail import Gmail  # noqa: E402
+from gwbackupy.object_codec import GzipCodec, ObjectCodec, ZstdCodec  # noqa: E402
+
+WORDS = (
+    "the of and to in is you that it he was for on are as with his they at be this "
+    "from have or by one had not but what all were when we there can an your which "
+    "meeting report invoice attached please regards thanks project update schedule"
+).split()
+
+
+def synthetic_message(rnd: random.Random, i: int) -> bytes:
+    sender = f"{rnd.choice(['anna', 'bela', 'csaba', 'dora', 'erik'])}@example{rnd.randint(1, 20)}.com"
+    received = "".join(
+        f"Received: from mail{rnd.randint(1, 99)}.example.com (mail.example.com. [10.0.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}])\r\n"
+        f"        by mx.google.com with ESMTPS id {rnd.getrandbits(64):016x}\r\n"
+        f"        for <user@example.com>; Mon, {rnd.randint(1, 28)} Mar 2023 10:{rnd.randint(10, 59)}:00 -0700 (PDT)\r\n"
+        for _ in range(rnd.randint(2, 5))
+    )
+    dkim = "".join(
+        f"        {''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz0123456789+/') for _ in range(70))}\r\n"
+        for _ in range(4)
+    )
+    body = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 600)))
+    boundary = f"{rnd.getrandbits(96):024x}"
+    return (
+        f"Delivered-To: user@example.com\r\n{received}"
+        f"DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.com; s=20210112;\r\n"
+        f"        h=mime-version:from:date:message-id:subject:to;\r\n        bh={rnd.getrandbits(128):032x}=;\r\n"
+        f"        b={dkim}"
+        f"MIME-Version: 1.0\r\nFrom: {sender}\r\nDate: Mon, 6 Mar 2023 10:00:00 -0700\r\n"
+        f"Message-ID: <{rnd.getrandbits(128):032x}@mail.example.com>\r\n"
+        f"Subject: {' '.join(rnd.choice(WORDS) for _ in range(6))} #{i}\r\nTo: user@example.com\r\n"
+        f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n\r\n'
+        f'--{boundary}\r\nContent-Type: text/plain; charset="UTF-8"\r\n\r\n{body}\r\n\r\n'
+        f'--{boundary}\r\nContent-Type: text/html; charset="UTF-8"\r\n\r\n<div dir="ltr">{body}</div>\r\n\r\n'
+        f"--{boundary}--\r\n"
+    ).encode("utf-8")
+
+
+def load_messages(count: int, mbox: str | None) -> list[bytes]:
+    if mbox is not None:
+        messages = []
+        for message in mailbox.mbox(mbox):
+            messages.append(message.as_bytes())
+            if len(messages) >= count:
+                break
+        return messages
+    rnd = random.Random(42)
+    return [synthetic_message(rnd, i) for i in range(count)]
+
+
+def run(codec: ObjectCodec, messages: list[bytes]) -> tuple[float, float, int]:
+    encoded = []
+    t = time.process_time()
+    for message in messages:
+        stream = io.BytesIO()
+        codec.writer(message)(stream)
+        encoded.append(stream.getvalue())
+    compress_time = time.process_time() - t
+    t = time.process_time()
+    for data, message in zip(encoded, messages):
+        if codec.decompress(io.BytesIO(data)) != message:
+            raise RuntimeError("Decompressed message is not equal")
+    decompress_time = time.process_time() - t
+    return compress_time, decompress_time, sum(len(d) for d in encoded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--mbox", type=str, default=None)
+    args = parser.parse_args()
+
+    messages = load_messages(args.messages, args.mbox)
+    raw_size = sum(len(m) for m in messages)
+    print(f"messages: {len(messages)}, raw: {raw_size} bytes")
+    codecs: list[tuple[str, ObjectCodec]] = [
+        ("gzip-9", GzipCodec(level=9)),
+        ("gzip-6", GzipCodec(level=6)),
+    ]
+    try:
+        samples = [
+            m[: Gmail.zstd_dictionary_sample_size]
+            for m in messages[: Gmail.zstd_dictionary_samples]
+        ]
+        t = time.process_time()
+        dictionary = ZstdCodec.train(samples)
+        print(f"zstd dictionary trained in {time.process_time() - t:.2f} CPU s")
+        codecs += [
+            ("zstd-3", ZstdCodec(level=3)),
+            ("zstd-3-dict", ZstdCodec(level=3, dictionary=dictionary)),
+            ("zstd-9-dict", ZstdCodec(level=9, dictionary=dictionary)),
+        ]
+    except RuntimeError as e:
+        print(f"zstd codecs are skipped: {e}")
+    for name, codec in codecs:
+        compress_time, decompress_time, size = run(codec, messages)
+        print(
+            f"{name}: compress {compress_time:.2f} CPU s, decompress {decompress_time:.2f} CPU s, "
+            f"{size} bytes ({size / raw_size * 100:.1f}%)"
+        )
+
+
+if __name__ == "__main__":
+    main()
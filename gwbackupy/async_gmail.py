@@ -0,0 +1,534 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import io
+import json
+import logging
+import os
+
+from gwbackupy.filters.filter_interface import FilterInterface
+from gwbackupy.gmail import Gmail
+from gwbackupy.helpers import decode_base64url, str_trim
+from gwbackupy.object_codec import (
+    ObjectCodec,
+    ZstdCodec,
+    codec_of_extension,
+    object_codecs,
+)
+from gwbackupy.process_helpers import is_killed
+from gwbackupy.providers.async_gmail_client import AsyncGmailClient
+from gwbackupy.storage.async_storage_interface import AsyncStorageInterface
+from gwbackupy.storage.storage_interface import (
+    Data,
+    LinkFilter,
+    LinkIndex,
+    LinkIndexEntry,
+    LinkInterface,
+)
+
+
+class AsyncGmail:
+    """
+    asyncio Gmail backup and restore engine.
+    The messages are processed by coroutines on one event loop, so hundreds of requests can be in flight
+    without a thread per request. Decoding, hashing and compression run in a CPU thread pool.
+    The storage layout is the same as the layout of the threaded engine (Gmail).
+    """
+
+    def __init__(
+        self,
+        email: str,
+        storage: AsyncStorageInterface,
+        client: AsyncGmailClient,
+        max_in_flight: int = 200,
+        object_codec: str = "gzip",
+        cpu_workers: int | None = None,
+        dry_mode: bool = False,
+    ):
+        """
+        :param email: email of the account
+        :param storage: the storage of the backup
+        :param client: Gmail REST client
+        :param max_in_flight: maximum number of the messages processed at once
+        :param object_codec: compression of the new message objects, see object_codecs
+        :param cpu_workers: number of threads of the CPU work, default is the number of CPUs
+        :param dry_mode: the storage and the server is not modified
+        """
+        if object_codec not in object_codecs:
+            raise ValueError(f"Not supported object codec: {object_codec}")
+        self.email = email
+        self.storage = storage
+        self.client = client
+        self.max_in_flight = max(1, max_in_flight)
+        self.dry_mode = dry_mode
+        self.cpu_workers = max(1, cpu_workers or os.cpu_count() or 1)
+        self.__codec: ObjectCodec = object_codecs[object_codec]()
+        self.__zstd_decoder: ZstdCodec | None = None
+        self.__cpu_executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self.__error_count = 0
+        self.__new_count = 0
+        self.__updated_count = 0
+        self.__not_found_count = 0
+        self.__label_lock: asyncio.Lock | None = None
+
+    async def __scan_storage(
+        self, f: LinkFilter | None = None
+    ) -> tuple[LinkIndex, LinkIndex]:
+        """Return the index of the message links, and the index of the labels links with all mutations"""
+        logging.debug("Scanning backup storage...")
+        stored_messages = LinkIndex()
+        labels_links = LinkIndex(keep_mutations=True)
+        dictionaries: list[LinkInterface] = []
+        async for link in self.storage.iter_find():
+            if link.id() == Gmail.object_id_labels:
+                labels_links.add(link)
+            elif link.id() == Gmail.object_id_zstd_dictionary:
+                dictionaries.append(link)
+            elif link.is_special_id() or not (link.is_metadata() or link.is_object()):
+                continue
+            elif f is None or f(link):
+                stored_messages.add(link)
+        dictionaries.sort(key=lambda l: l.mutation())
+        self.__zstd_decoder = None
+        if len(dictionaries) > 0:
+            self.__zstd_decoder = ZstdCodec(
+                dictionaries=[await self.storage.get(l) for l in dictionaries]
+            )
+        return stored_messages, labels_links
+
+    def __decoder(self, link: LinkInterface) -> ObjectCodec:
+        codec = codec_of_extension(link.get_extension())
+        if codec is ZstdCodec and self.__zstd_decoder is not None:
+            return self.__zstd_decoder
+        return codec()
+
+    async def __run_cpu(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__cpu_executor, fn, *args
+        )
+
+    def __encode_message_file(
+        self, message_id: str, raw: str, create_timestamp: float
+    ) -> tuple[LinkInterface, Data]:
+        """
+        Decode, hash and compress a raw message (CPU thread), return the object link and the compressed message.
+        If the storage has the content already, then the compression is left to the storage as a lazy writer.
+        """
+        raw_message = decode_base64url(raw)
+        link = self.storage.new_link(
+            object_id=message_id,
+            extension=f"eml.{self.__codec.extension}",
+            created_timestamp=create_timestamp,
+        ).set_properties(
+            {
+                LinkInterface.property_object: True,
+                LinkInterface.property_content_hash: self.storage.content_hash_generate(
+                    raw_message
+                ),
+            }
+        )
+        writer = self.__codec.writer(raw_message)
+        if self.storage.has_content(link):
+            return link, writer
+        stream = io.BytesIO()
+        writer(stream)
+        return link, stream.getvalue()
+
+    def __decode_message_file(self, link: LinkInterface, data: bytes) -> bytes:
+        return self.__decoder(link).decompress(io.BytesIO(data))
+
+    async def __storage_put(self, link: LinkInterface, data: bytes | str) -> bool:
+        if self.dry_mode:
+            logging.info(f"DRY MODE storage put: {link}")
+            return True
+        return await self.storage.put(link, data)
+
+    async def __storage_put_many(
+        self, items: list[tuple[LinkInterface, bytes | str]]
+    ) -> list[bool]:
+        if self.dry_mode:
+            for link, _ in items:
+                logging.info(f"DRY MODE storage put: {link}")
+            return [True] * len(items)
+        if len(items) == 0:
+            return []
+        return await self.storage.put_many(items)
+
+    async def __storage_remove_many(self, links: list[LinkInterface]) -> list[bool]:
+        if self.dry_mode:
+            for link in links:
+                logging.info(f"DRY MODE storage remove: {link}")
+            return [True] * len(links)
+        if len(links) == 0:
+            return []
+        return await self.storage.remove_many(links)
+
+    async def __backup_labels(self, link: LinkInterface | None) -> bool:
+        labels = await self.client.get_labels(self.email)
+        if link is not None:
+            try:
+                if json.loads(await self.storage.get(link)) == labels:
+                    logging.debug("Labels is not changed, not saving it")
+                    return True
+            except BaseException as e:
+                logging.exception(f"labels loading or parsing failed: {e}")
+        link = self.storage.new_link(
+            object_id=Gmail.object_id_labels, extension="json", created_timestamp=None
+        ).set_properties({LinkInterface.property_metadata: True})
+        if not await self.__storage_put(link, json.dumps(labels)):
+            logging.error("Error while storing labels")
+            return False
+        return True
+
+    async def __fix_content_hash(self, link: LinkInterface) -> LinkInterface:
+        if link.get_property(LinkInterface.property_content_hash) is not None:
+            return link
+        message = await self.__run_cpu(
+            self.__decode_message_file, link, await self.storage.get(link)
+        )
+        new_link = link.clone().set_properties(
+            {
+                LinkInterface.property_content_hash: self.storage.content_hash_generate(
+                    message
+                )
+            }
+        )
+        await self.storage.modify(link, new_link)
+        return new_link
+
+    async def __backup_message(self, message_id: str, stored_messages: LinkIndex):
+        try:
+            entry = stored_messages.get(message_id)
+            is_new = entry is None
+            message_format = "raw"
+            if not is_new and entry.object is not None:
+                entry.object = await self.__fix_content_hash(entry.object)
+                message_format = "minimal"
+            data = await self.client.get_message(self.email, message_id, message_format)
+            if data is None:
+                logging.debug(f"{message_id} is not found on server")
+                self.__not_found_count += 1
+                return
+            create_timestamp = int(data["internalDate"]) / 1000.0
+            encoded = None
+            if "raw" in data:
+                encoded = await self.__run_cpu(
+                    self.__encode_message_file,
+                    message_id,
+                    data.pop("raw"),
+                    create_timestamp,
+                )
+            write_meta = True
+            if not is_new:
+                try:
+                    write_meta = (
+                        json.loads(await self.storage.get(entry.metadata)) != data
+                    )
+                except BaseException as e:
+                    logging.exception(f"{message_id} metadata load as json failed: {e}")
+            # the object is written before the metadata, in one storage call
+            items = []
+            if encoded is not None:
+                items.append(encoded)
+            if write_meta:
+                link = self.storage.new_link(
+                    object_id=message_id,
+                    extension="json",
+                    created_timestamp=create_timestamp,
+                ).set_properties({LinkInterface.property_metadata: True})
+                items.append((link, json.dumps(data)))
+            results = await self.__storage_put_many(items)
+            if encoded is not None and not results[0]:
+                raise Exception("Mail message save failed")
+            if write_meta and not results[-1]:
+                raise Exception("Meta data put failed")
+            if is_new:
+                logging.debug(
+                    f"{message_id} backed up (new), snippet: {str_trim(data.get('snippet', ''), 64)}"
+                )
+                self.__new_count += 1
+            elif write_meta:
+                logging.debug(f"{message_id} backed up (updated)")
+                self.__updated_count += 1
+            if message_id in stored_messages:
+                del stored_messages[message_id]
+        except Exception as e:
+            self.__error_count += 1
+            logging.exception(f"{message_id} {e}")
+
+    async def __run_all(self, coroutines) -> bool:
+        """Run the coroutines with at most max_in_flight at once, return False if the process is killed"""
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        tasks: set[asyncio.Task] = set()
+
+        def done(task: asyncio.Task):
+            tasks.discard(task)
+            semaphore.release()
+
+        for coroutine in coroutines:
+            await semaphore.acquire()
+            if is_killed():
+                semaphore.release()
+                coroutine.close()
+                for task in list(tasks):
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                return False
+            task = asyncio.create_task(coroutine)
+            tasks.add(task)
+            task.add_done_callback(done)
+        await asyncio.gather(*tasks)
+        return not is_killed()
+
+    async def backup(self) -> bool:
+        logging.info(f"Starting async backup for {self.email}")
+        self.__error_count = 0
+        self.__new_count = 0
+        self.__updated_count = 0
+        self.__not_found_count = 0
+        self.__cpu_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.cpu_workers, thread_name_prefix="async-cpu"
+        )
+        try:
+            return await self.__backup()
+        finally:
+            self.__cpu_executor.shutdown(wait=True)
+            self.__cpu_executor = None
+
+    async def __backup(self) -> bool:
+        stored_messages, labels_links = await self.__scan_storage()
+        if not await self.__backup_labels(labels_links.latest(Gmail.object_id_labels)):
+            logging.error("Backup finished with storing labels failed")
+            return False
+        for message_id in stored_messages.keys():
+            metadata = stored_messages[message_id].metadata
+            if metadata is None or metadata.is_deleted():
+                del stored_messages[message_id]
+        messages_from_server = await self.client.get_messages(self.email, "label:all")
+        logging.info(
+            f"Messages on server: {len(messages_from_server)}, active in local storage: {len(stored_messages)}"
+        )
+        if not await self.__run_all(
+            self.__backup_message(message_id, stored_messages)
+            for message_id in messages_from_server
+        ):
+            logging.warning("Process is killed")
+            return False
+        logging.info(
+            f"Backup summary: {self.__new_count} new, {self.__updated_count} updated"
+            + (
+                f", {self.__not_found_count} removed from server"
+                if self.__not_found_count > 0
+                else ""
+            )
+        )
+        if self.__error_count > 0:
+            # if error then never delete!
+            logging.error(f"Backup failed with {self.__error_count} errors")
+            return False
+
+        deleted_count = 0
+        message_ids = stored_messages.keys()
+        for start in range(0, len(message_ids), Gmail.remove_batch_size):
+            if is_killed():
+                logging.warning("Process is killed")
+                return False
+            batch = message_ids[start : start + Gmail.remove_batch_size]
+            # the metadata is marked as deleted first, then the objects of the marked messages
+            meta_results = await self.__storage_remove_many(
+                [stored_messages[message_id].metadata for message_id in batch]
+            )
+            objects = []
+            for message_id, result in zip(batch, meta_results):
+                if not result:
+                    logging.error(f"{message_id} mark as deleted failed")
+                elif stored_messages[message_id].object is None:
+                    deleted_count += 1
+                else:
+                    objects.append(message_id)
+            object_results = await self.__storage_remove_many(
+                [stored_messages[message_id].object for message_id in objects]
+            )
+            for message_id, result in zip(objects, object_results):
+                if result:
+                    deleted_count += 1
+                else:
+                    logging.error(f"{message_id} object mark as deleted fail")
+        logging.info(f"Marked as deleted: {deleted_count}")
+        if not await self.storage.flush():
+            logging.error("Backup failed with storage flush error")
+            return False
+        logging.info(f"Backup finished for {self.email}")
+        return True
+
+    async def __find_or_create_label_by_name(
+        self, name: str, email: str, labels_form_server: dict[str, dict[str, any]]
+    ) -> dict[str, any]:
+        for data in labels_form_server.values():
+            if data.get("name") == name:
+                return data
+        return await self.client.create_label(
+            email=email, name=name, get_if_already_exists=True
+        )
+
+    async def __get_restore_label_ids(
+        self,
+        to_email: str,
+        labels_from_storage: dict[str, dict[str, any]],
+        labels_form_server: dict[str, dict[str, any]],
+        add_labels: list[str],
+        label_ids_from_message: list[str],
+    ) -> list[str]:
+        """Label IDs of the restored message on the server, the missing labels are created (see Gmail)"""
+        async with self.__label_lock:
+            result = []
+            for message_label_id in label_ids_from_message:
+                label_data_from_storage = labels_from_storage.get(message_label_id)
+                if label_data_from_storage is None:
+                    logging.warning(
+                        f"Label with {message_label_id} ID is cannot be restored because no data can be found."
+                    )
+                    continue
+                label_type = label_data_from_storage.get("type")
+                if label_type not in ["user", "system"]:
+                    raise ValueError(
+                        f"Label with {message_label_id} ID is not user or system label."
+                    )
+                if label_type == "system":
+                    if labels_form_server.get(message_label_id) is None:
+                        raise ValueError(
+                            f"System label {message_label_id} is not exists on server."
+                        )
+                    result.append(message_label_id)
+                    continue
+                if self.email != to_email:
+                    # find user label by name not by ID
+                    label_data = await self.__find_or_create_label_by_name(
+                        label_data_from_storage.get("name"),
+                        to_email,
+                        labels_form_server,
+                    )
+                    # label data stored on original label ID!
+                    labels_form_server[message_label_id] = label_data
+                    result.append(label_data.get("id"))
+                    continue
+                if labels_form_server.get(message_label_id) is not None:
+                    result.append(message_label_id)
+                    continue
+                created_label_data = await self.client.create_label(
+                    email=to_email,
+                    name=label_data_from_storage.get("name"),
+                    get_if_already_exists=True,
+                )
+                # label data stored on original label ID!
+                labels_form_server[message_label_id] = created_label_data
+                result.append(created_label_data.get("id"))
+            for add_label in add_labels:
+                label_data = await self.__find_or_create_label_by_name(
+                    add_label, to_email, labels_form_server
+                )
+                labels_form_server[label_data.get("id")] = label_data
+                result.append(label_data.get("id"))
+            return result
+
+    async def __restore_message(
+        self,
+        message_id: str,
+        entry: LinkIndexEntry,
+        to_email: str,
+        labels_from_storage: dict[str, dict[str, any]],
+        labels_form_server: dict[str, dict[str, any]],
+        add_labels: list[str],
+    ):
+        try:
+            meta = json.loads(await self.storage.get(entry.metadata))
+            label_ids_from_message: list[str] = meta.get("labelIds", [])
+            if "CHAT" in label_ids_from_message:
+                logging.warning(
+                    f"{message_id} message with CHAT label is not supported."
+                )
+                return
+            label_ids = await self.__get_restore_label_ids(
+                to_email,
+                labels_from_storage,
+                labels_form_server,
+                add_labels,
+                label_ids_from_message,
+            )
+            message = await self.__run_cpu(
+                self.__decode_message_file,
+                entry.object,
+                await self.storage.get(entry.object),
+            )
+            if self.dry_mode:
+                logging.info(f"DRY MODE {message_id} message insert")
+            result = await self.client.insert_message(to_email, label_ids, message)
+            logging.debug(f'{message_id}->{result.get("id")} Message uploaded')
+        except BaseException as e:
+            self.__error_count += 1
+            logging.exception(f"{message_id} Exception: {e}")
+
+    async def restore(
+        self,
+        item_filter: FilterInterface,
+        to_email: str | None = None,
+        add_labels: list[str] | None = None,
+    ) -> bool:
+        self.__error_count = 0
+        self.__label_lock = asyncio.Lock()
+        if to_email is None:
+            to_email = self.email
+        if add_labels is None:
+            add_labels = []
+        labels_from_server = {
+            label["id"]: label for label in await self.client.get_labels(to_email)
+        }
+        messages_from_server_dest_email = {}
+        if self.email == to_email:
+            messages_from_server_dest_email = await self.client.get_messages(
+                self.email, "label:all"
+            )
+        stored_messages, labels_links = await self.__scan_storage(
+            f=lambda l: item_filter.match(
+                {
+                    "message-id": l.id(),
+                    "link": l,
+                    "server-data": messages_from_server_dest_email,
+                }
+            ),
+        )
+        labels_from_storage = {}
+        for link in labels_links.mutations(Gmail.object_id_labels):
+            for item in json.loads(await self.storage.get(link)):
+                labels_from_storage[item.get("id")] = item
+        for message_id in stored_messages.keys():
+            entry = stored_messages[message_id]
+            if entry.metadata is None or entry.object is None:
+                del stored_messages[message_id]
+        logging.info(f"Number of potentially affected messages: {len(stored_messages)}")
+        self.__cpu_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.cpu_workers, thread_name_prefix="async-cpu"
+        )
+        try:
+            if not await self.__run_all(
+                self.__restore_message(
+                    message_id,
+                    stored_messages[message_id],
+                    to_email,
+                    labels_from_storage,
+                    labels_from_server,
+                    add_labels,
+                )
+                for message_id in stored_messages.keys()
+            ):
+                logging.warning("Process killed")
+                return False
+        finally:
+            self.__cpu_executor.shutdown(wait=True)
+            self.__cpu_executor = None
+        if self.__error_count > 0:
+            logging.error(f"Messages uploaded with {self.__error_count} errors")
+            return False
+        logging.info("Messages uploaded successfully")
+        return True
@@ -1,31 +1,44 @@
 from __future__ import annotations
 
-import collections
 import concurrent.futures
-import copy
-import gzip
+import io
 import json
 import logging
+import os
+import pickle
+import shutil
+import tempfile
 import threading
+import time
 from datetime import datetime, timedelta
 
 from gwbackupy import global_properties
 from gwbackupy.adaptive_batch_controller import AdaptiveBatchController
 from gwbackupy.filters.filter_interface import FilterInterface
+from gwbackupy.object_codec import (
+    GzipCodec,
+    ObjectCodec,
+    ZstdCodec,
+    codec_of_extension,
+    object_codecs,
+)
 from gwbackupy.helpers import (
     decode_base64url,
-    encode_base64url,
     str_trim,
     json_load,
 )
 from gwbackupy.process_helpers import is_killed, sleep_kc, await_all_futures
+from gwbackupy.stage_executor import Stage
+from gwbackupy.storage import content_hash
 from gwbackupy.providers.gmail_service_wrapper_interface import (
     GmailServiceWrapperInterface,
 )
 from gwbackupy.storage.storage_interface import (
     StorageInterface,
-    LinkList,
+    LinkIndex,
+    LinkIndexEntry,
     LinkInterface,
+    LinkFilter,
     Data,
 )
 
@@ -36,11 +49,99 @@ def __is_system_label_by_label_data(label_data: dict) -> bool:
     return label_data.get("type") == "system"
 
 
+# state of the verify workers (processes, or threads if the storage is not picklable), see _verify_init()
+_verify_storage: StorageInterface | None = None
+_verify_dictionaries: list[bytes] = []
+_verify_zstd_decoder: ZstdCodec | None = None
+
+
+def _verify_init(storage: StorageInterface, dictionaries: list[bytes]):
+    global _verify_storage, _verify_dictionaries, _verify_zstd_decoder
+    _verify_storage = storage
+    _verify_dictionaries = dictionaries
+    _verify_zstd_decoder = None
+
+
+def _verify_objects(links: list[LinkInterface]) -> list[tuple[str, int, str | None]]:
+    """
+    Decompress and hash the message objects (in a verify worker).
+    Return the status, the decompressed size and the error of the links, see Gmail.verify_statuses.
+    """
+    global _verify_zstd_decoder
+    results = []
+    for link in links:
+        expected = link.get_property(LinkInterface.property_content_hash)
+        size = 0
+        try:
+            codec = codec_of_extension(link.get_extension())
+            if codec is ZstdCodec:
+                if _verify_zstd_decoder is None:
+                    _verify_zstd_decoder = ZstdCodec(dictionaries=_verify_dictionaries)
+                decoder = _verify_zstd_decoder
+            else:
+                decoder = codec()
+            algorithm = None
+            if expected is not None:
+                algorithm = content_hash.algorithm_of(expected)
+                if algorithm is None:
+                    raise ValueError(f"Not supported content hash: {expected}")
+            h = content_hash.new_hash(algorithm) if algorithm is not None else None
+            with _verify_storage.get(link) as f:
+                with decoder.open(f) as df:
+                    while True:
+                        chunk = df.read(content_hash.chunk_size)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if h is not None:
+                            h.update(chunk)
+        except FileNotFoundError as e:
+            results.append((Gmail.verify_status_missing, size, str(e)))
+            continue
+        except BaseException as e:
+            results.append(
+                (Gmail.verify_status_corrupt, size, f"{type(e).__name__}: {e}")
+            )
+            continue
+        if h is None:
+            results.append((Gmail.verify_status_unhashed, size, None))
+        elif content_hash.content_hash_prefixes[algorithm] + h.hexdigest() != expected:
+            results.append((Gmail.verify_status_corrupt, size, "content hash mismatch"))
+        else:
+            results.append((Gmail.verify_status_ok, size, None))
+    return results
+
+
 class Gmail:
     """Gmail service"""
 
     object_id_labels = "--gwbackupy-labels--"
     """Gmail's special object ID for storing labels"""
+    object_id_zstd_dictionary = "--gwbackupy-zstd-dictionary--"
+    """Gmail's special object ID for storing the trained zstd dictionaries"""
+    zstd_dictionary_samples = 1000
+    """Number of messages sampled for the zstd dictionary training"""
+    zstd_dictionary_sample_size = 16 * 1024
+    """Sampled bytes of a message (the headers are the most repetitive part)"""
+    restore_spool_size = 1024 * 1024
+    """Restored messages larger than this (bytes) are spooled to a temporary file instead of memory"""
+    restore_chunk_size = 64 * 1024
+    """Chunk size of the message decompression on restore"""
+    remove_batch_size = 1000
+    """Number of the messages marked as deleted in one storage call"""
+    verify_batch_size = 100
+    """Number of the message objects verified by one task of the verify workers"""
+    verify_status_ok = "ok"
+    verify_status_unhashed = "unhashed"
+    """readable, but the object has no content hash"""
+    verify_status_corrupt = "corrupt"
+    verify_status_missing = "missing"
+    verify_statuses = [
+        verify_status_ok,
+        verify_status_unhashed,
+        verify_status_corrupt,
+        verify_status_missing,
+    ]
 
     def __init__(
         self,
@@ -51,7 +152,34 @@ class Gmail:
         labels: list[str] | None = None,
         dry_mode: bool = False,
         auto_batch: bool = False,
+        object_codec: str = GzipCodec.name,
+        zstd_dictionary: bool = False,
+        cpu_workers: int | None = None,
+        write_workers: int = 4,
     ):
+        """
+        :param cpu_workers: number of threads for decoding, hashing and compressing the messages (default: number of CPUs, max. 8)
+        :param write_workers: number of threads for storing the messages
+        :param object_codec: compression codec of the new message objects, see object_codecs
+        :param zstd_dictionary: zstd codec with a dictionary trained per mailbox (it is trained after the first backup)
+        """
+        if object_codec not in object_codecs:
+            raise ValueError(f"Not supported object codec: {object_codec}")
+        self.object_codec = object_codec
+        self.zstd_dictionary = zstd_dictionary and object_codec == ZstdCodec.name
+        if self.zstd_dictionary and storage.shares_content():
+            # the dictionaries are per mailbox, the shared objects are read by other mailboxes
+            raise ValueError("zstd dictionary can not be used with shared content")
+        self.__codec: ObjectCodec = object_codecs[object_codec]()
+        self.__zstd_decoder: ZstdCodec | None = None
+        self.__zstd_dictionaries: list[bytes] = []
+        self.__zstd_samples: list[bytes] | None = None
+        if cpu_workers is None or cpu_workers < 1:
+            cpu_workers = min(8, os.cpu_count() or 1)
+        self.cpu_workers = cpu_workers
+        self.write_workers = max(1, write_workers)
+        self.__cpu_stage: Stage | None = None
+        self.__write_stage: Stage | None = None
         self.dry_mode = dry_mode
         self.email = email
         self.storage = storage
@@ -110,8 +238,90 @@ class Gmail:
         with self.__batch_controller.slot():
             return fn(*args, **kwargs)
 
-    def __get_local_messages_latest_mutations_only(self):
-        pass
+    def __scan_storage(
+        self, f: LinkFilter | None = None
+    ) -> tuple[LinkIndex, LinkIndex]:
+        """
+        Scan the storage in one streaming pass.
+        Return the index of the message links, and the index of the labels links with all mutations.
+        :param f: filter for the message links
+        """
+        logging.debug("Scanning backup storage...")
+        stored_messages = LinkIndex()
+        labels_links = LinkIndex(keep_mutations=True)
+        dictionary_links: list[LinkInterface] = []
+        count = 0
+        for link in self.storage.iter_find():
+            count += 1
+            if link.id() == Gmail.object_id_labels:
+                labels_links.add(link)
+                continue
+            if link.id() == Gmail.object_id_zstd_dictionary:
+                dictionary_links.append(link)
+                continue
+            if link.is_special_id() or not (link.is_metadata() or link.is_object()):
+                continue
+            if f is None or f(link):
+                stored_messages.add(link)
+        logging.debug(f"Stored items: {count}")
+        self.__load_zstd_dictionaries(dictionary_links)
+        return stored_messages, labels_links
+
+    def __load_zstd_dictionaries(self, links: list[LinkInterface]):
+        """Load the stored dictionaries, the latest is used for the compression"""
+        dictionaries = []
+        for link in sorted(links, key=lambda l: l.mutation()):
+            with self.storage.get(link) as f:
+                dictionaries.append(f.read())
+        self.__zstd_dictionaries = dictionaries
+        self.__zstd_decoder = None
+        if self.zstd_dictionary:
+            if len(dictionaries) > 0:
+                self.__codec = ZstdCodec(
+                    dictionary=dictionaries[-1], dictionaries=dictionaries
+                )
+                self.__zstd_samples = None
+            else:
+                logging.info("zstd dictionary is not trained yet, sampling messages")
+                self.__zstd_samples = []
+
+    def __decoder(self, link: LinkInterface) -> ObjectCodec:
+        """Codec of a stored message object by its extension"""
+        codec = codec_of_extension(link.get_extension())
+        if codec is not ZstdCodec:
+            return codec()
+        with self.__lock:
+            if self.__zstd_decoder is None:
+                self.__zstd_decoder = ZstdCodec(dictionaries=self.__zstd_dictionaries)
+            return self.__zstd_decoder
+
+    def __train_zstd_dictionary(self) -> bool:
+        samples = self.__zstd_samples
+        if samples is None or self.dry_mode:
+            return True
+        self.__zstd_samples = None
+        if len(samples) < 100:
+            logging.info(
+                f"Not enough messages for the zstd dictionary training ({len(samples)})"
+            )
+            return True
+        try:
+            dictionary = ZstdCodec.train(samples)
+        except BaseException as e:
+            logging.warning(f"zstd dictionary training failed: {e}")
+            return True
+        link = self.storage.new_link(
+            object_id=Gmail.object_id_zstd_dictionary,
+            extension="bin",
+            created_timestamp=None,
+        )
+        if not self.storage.put(link, dictionary):
+            logging.error("Error while storing zstd dictionary")
+            return False
+        logging.info(
+            f"zstd dictionary trained from {len(samples)} messages ({ZstdCodec.dictionary_id(dictionary)})"
+        )
+        return True
 
     def __get_message_from_server(self, message_id, message_format="raw", email=None):
         if email is None:
@@ -123,27 +333,43 @@ class Gmail:
         logging.debug(f"{message_id} successfully downloaded")
         return result
 
-    def __store_message_file(
+    def __encode_message_file(
         self, message_id: str, raw_message: bytes, create_timestamp: float
-    ):
-        logging.debug("Store message {id}".format(id=message_id))
-        link = self.storage.new_link(
-            object_id=message_id, extension="eml.gz", created_timestamp=create_timestamp
+    ) -> tuple[LinkInterface, Data]:
+        """
+        Hash and compress a raw message (CPU stage), return the object link and the compressed message.
+        If the storage has the content already (e.g. deduplicated), then the compression is left to the storage as a lazy writer.
+        """
+        content_hash = self.storage.content_hash_generate(raw_message)
+        samples = self.__zstd_samples
+        if samples is not None:
+            with self.__lock:
+                if len(samples) < Gmail.zstd_dictionary_samples:
+                    samples.append(raw_message[: Gmail.zstd_dictionary_sample_size])
+        link = self.__message_file_link(message_id, content_hash, create_timestamp)
+        writer = self.__codec.writer(raw_message)
+        if self.storage.has_content(link):
+            return link, writer
+        stream = io.BytesIO()
+        writer(stream)
+        return link, stream.getvalue()
+
+    def __message_file_link(
+        self,
+        message_id: str,
+        content_hash: str,
+        create_timestamp: float,
+    ) -> LinkInterface:
+        return self.storage.new_link(
+            object_id=message_id,
+            extension=f"eml.{self.__codec.extension}",
+            created_timestamp=create_timestamp,
         ).set_properties(
             {
                 LinkInterface.property_object: True,
-                LinkInterface.property_content_hash: self.storage.content_hash_generate(
-                    raw_message
-                ),
+                LinkInterface.property_content_hash: content_hash,
             }
         )
-        result = self.__storage_put(
-            link, data=gzip.compress(raw_message, compresslevel=9)
-        )
-        if result:
-            logging.debug(f"{message_id} message is saved")
-        else:
-            raise Exception("Mail message save failed")
 
     def __fix_content_hash_to_message_object(
         self, message_id: str, link: LinkInterface
@@ -152,9 +378,9 @@ class Gmail:
             return link
         logging.debug(f"{message_id} message object not has content hash, add it")
         with self.storage.get(link) as mf:
-            message_content = gzip.decompress(mf.read())
-            content_hash = self.storage.content_hash_generate(message_content)
-        new_object_link = copy.deepcopy(link)
+            with self.__decoder(link).open(mf) as df:
+                content_hash = self.storage.content_hash_generate(df)
+        new_object_link = link.clone()
         new_object_link.set_properties(
             {LinkInterface.property_content_hash: content_hash}
         )
@@ -165,7 +391,7 @@ class Gmail:
     def __backup_messages(
         self,
         message,
-        stored_messages: dict[str, dict[int, LinkInterface]],
+        stored_messages: LinkIndex,
         quick_sync: bool = False,
         quick_sync_cutoff: datetime | None = None,
     ):
@@ -176,7 +402,7 @@ class Gmail:
             message_id = message["id"]
             latest_meta_link = None
             if message_id in stored_messages:
-                latest_meta_link = stored_messages[message_id][0]
+                latest_meta_link = stored_messages[message_id].metadata
             is_new = latest_meta_link is None
             if is_new:
                 logging.debug(f"{message_id} is new")
@@ -218,10 +444,10 @@ class Gmail:
 
             # TODO: option for force raw mode
             message_format = "raw"
-            if not is_new and stored_messages[message_id][1] is not None:
-                stored_messages[message_id][1] = (
+            if not is_new and stored_messages[message_id].object is not None:
+                stored_messages[message_id].object = (
                     self.__fix_content_hash_to_message_object(
-                        message_id, stored_messages[message_id][1]
+                        message_id, stored_messages[message_id].object
                     )
                 )
                 message_format = "minimal"
@@ -232,17 +458,62 @@ class Gmail:
                 with self.__lock:
                     self.__not_found_count += 1
                 return
+            self.__cpu_stage.submit(
+                self.__backup_messages_encode,
+                message_id,
+                data,
+                is_new,
+                latest_meta_link,
+                stored_messages,
+            )
+        except Exception as e:
+            self.__backup_messages_error(message_id, e)
 
+    def __backup_messages_encode(
+        self,
+        message_id: str,
+        data: dict[str, any],
+        is_new: bool,
+        latest_meta_link: LinkInterface | None,
+        stored_messages: LinkIndex,
+    ):
+        """CPU stage: decode, hash and compress the raw message"""
+        try:
+            encoded = None
+            if "raw" in data.keys():
+                encoded = self.__encode_message_file(
+                    message_id,
+                    decode_base64url(data.pop("raw")),
+                    int(data["internalDate"]) / 1000.0,
+                )
+            self.__write_stage.submit(
+                self.__backup_messages_write,
+                message_id,
+                data,
+                encoded,
+                is_new,
+                latest_meta_link,
+                stored_messages,
+            )
+        except Exception as e:
+            self.__backup_messages_error(message_id, e)
+
+    def __backup_messages_write(
+        self,
+        message_id: str,
+        data: dict[str, any],
+        encoded: tuple[LinkInterface, Data] | None,
+        is_new: bool,
+        latest_meta_link: LinkInterface | None,
+        stored_messages: LinkIndex,
+    ):
+        """Writer stage: store the message object and the changed metadata"""
+        try:
             subject = str_trim(data.get("snippet", ""), 64)
             if not is_new:
                 logging.debug(f"{message_id} Snippet: {subject}")
 
             create_timestamp = int(data["internalDate"]) / 1000.0
-            if "raw" in data.keys():
-                raw = decode_base64url(data.get("raw"))
-                self.__store_message_file(message_id, raw, create_timestamp)
-                data.pop("raw")
-
             write_meta = True  # if any failure then write it force
             if not is_new:
                 logging.log(
@@ -261,19 +532,29 @@ class Gmail:
                 except BaseException as e:
                     logging.exception(f"{message_id} metadata load as json failed: {e}")
 
+            # the object is written before the metadata, in one storage call
+            items = []
+            if encoded is not None:
+                logging.debug(f"Store message {message_id}")
+                items.append(encoded)
             if write_meta:
                 link = self.storage.new_link(
                     object_id=message_id,
                     extension="json",
                     created_timestamp=create_timestamp,
                 ).set_properties({LinkInterface.property_metadata: True})
-                success = self.__storage_put(link, data=json.dumps(data))
-                if success:
-                    logging.debug(f"{message_id} meta data is saved")
-                else:
-                    raise Exception("Meta data put failed")
+                items.append((link, json.dumps(data)))
             else:
                 logging.debug(f"{message_id} meta data is not changed, skip put")
+            results = self.__storage_put_many(items)
+            if encoded is not None:
+                if not results[0]:
+                    raise Exception("Mail message save failed")
+                logging.debug(f"{message_id} message is saved")
+            if write_meta:
+                if not results[-1]:
+                    raise Exception("Meta data put failed")
+                logging.debug(f"{message_id} meta data is saved")
             if is_new:
                 snippet_part = f", snippet: {subject}" if subject else ""
                 logging.debug(f"{message_id} backed up (new){snippet_part}")
@@ -287,11 +568,14 @@ class Gmail:
                 if message_id in stored_messages:
                     del stored_messages[message_id]
         except Exception as e:
-            with self.__lock:
-                self.__error_count += 1
-            if str(e) == "SKIP":
-                return
-            logging.exception(f"{message_id} {e}")
+            self.__backup_messages_error(message_id, e)
+
+    def __backup_messages_error(self, message_id: str, e: Exception):
+        with self.__lock:
+            self.__error_count += 1
+        if str(e) == "SKIP":
+            return
+        logging.exception(f"{message_id} {e}")
 
     def __get_all_messages_from_server(
         self, email: str | None = None, q: str | None = "label:all"
@@ -348,9 +632,39 @@ class Gmail:
             return True
         return self.storage.put(link, data)
 
+    def __storage_put_many(self, items: list[tuple[LinkInterface, Data]]) -> list[bool]:
+        if self.dry_mode:
+            for link, _ in items:
+                logging.info(f"DRY MODE storage put: {link}")
+            return [True] * len(items)
+        if len(items) == 0:
+            return []
+        return self.storage.put_many(items)
+
+    def __storage_remove_many(
+        self, links: list[LinkInterface], as_new_mutation: bool = True
+    ) -> list[bool]:
+        if self.dry_mode:
+            for link in links:
+                logging.info(f"DRY MODE storage remove: {link}")
+            return [True] * len(links)
+        if len(links) == 0:
+            return []
+        return self.storage.remove_many(links, as_new_mutation=as_new_mutation)
+
     def backup(
         self, quick_sync: bool = False, quick_sync_days: int | None = None
     ) -> bool:
+        result = self.__backup(quick_sync=quick_sync, quick_sync_days=quick_sync_days)
+        if not self.__train_zstd_dictionary():
+            result = False
+        # also after a failed backup, the already stored messages are kept
+        if not self.storage.flush():
+            logging.error("Backup failed with storage flush error")
+            return False
+        return result
+
+    def __backup(self, quick_sync: bool, quick_sync_days: int | None) -> bool:
         logging.info(f"Starting backup for {self.email}")
         self.__error_count = 0
         self.__new_count = 0
@@ -358,14 +672,8 @@ class Gmail:
         self.__not_found_count = 0
         self.__skipped_count = 0
 
-        logging.debug("Scanning backup storage...")
-        stored_data_all = self.storage.find()
-        logging.debug(f"Stored items: {len(stored_data_all)}")
-
-        labels_link = stored_data_all.find(
-            f=lambda l: l.id() == Gmail.object_id_labels and l.is_metadata
-        )
-        if not self.__backup_labels(labels_link):
+        stored_messages, labels_links = self.__scan_storage()
+        if not self.__backup_labels(labels_links.latest(Gmail.object_id_labels)):
             logging.error("Backup finished with storing labels failed")
             return False
         if quick_sync_days is not None and quick_sync_days < 1:
@@ -385,15 +693,16 @@ class Gmail:
         quick_sync_cutoff = None
         if quick_sync and quick_sync_days is not None:
             quick_sync_cutoff = datetime.now() - timedelta(days=quick_sync_days)
+        if quick_sync_days is not None and not self.dry_mode:
+            # the new messages are expected in the synced period
+            now = datetime.now()
+            self.storage.prepare(
+                (now - timedelta(days=quick_sync_days)).timestamp(), now.timestamp()
+            )
 
-        stored_messages: dict[str, dict[int, LinkInterface]] = stored_data_all.find(
-            f=lambda l: not l.is_special_id() and (l.is_metadata() or l.is_object()),
-            g=lambda l: [l.id(), 0 if l.is_metadata() else 1],
-        )
-        del stored_data_all
         stored_messages_total = len(stored_messages)
-        for message_id in list(stored_messages.keys()):
-            link_metadata = stored_messages[message_id].get(0)
+        for message_id in stored_messages.keys():
+            link_metadata = stored_messages[message_id].metadata
             if link_metadata is None:
                 logging.error(f"{message_id} metadata is not found in locally")
                 del stored_messages[message_id]
@@ -421,9 +730,15 @@ class Gmail:
         )
         logging.debug("Processing...")
         self.__start_batch_controller()
-        executor = concurrent.futures.ThreadPoolExecutor(
-            max_workers=self.__get_executor_max_workers()
+        # pipeline: network fetch -> decode, hash, compress (CPU) -> storage write
+        executor = Stage("fetch", self.__get_executor_max_workers())
+        self.__cpu_stage = Stage(
+            "cpu", self.cpu_workers, max_queue=self.cpu_workers * 2
+        )
+        self.__write_stage = Stage(
+            "write", self.write_workers, max_queue=self.write_workers * 4
         )
+        stages = [executor, self.__cpu_stage, self.__write_stage]
         futures = []
         # submit message download jobs
         for message_id in messages_from_server:
@@ -437,13 +752,21 @@ class Gmail:
                     quick_sync_cutoff=quick_sync_cutoff,
                 )
             )
-        # wait for jobs
-        if not await_all_futures(futures):
-            # cancel jobs
-            executor.shutdown(cancel_futures=True)
+        # wait for jobs, then for the next stages
+        if not await_all_futures(futures) or not all(
+            stage.join(should_stop=is_killed) for stage in stages[1:]
+        ):
+            # cancel jobs, the blocked submits of the previous stages are released by the cancellation
+            for stage in stages:
+                stage.shutdown(wait=False, cancel_futures=True)
+            for stage in stages:
+                stage.shutdown()
             self.__stop_batch_controller()
             logging.warning("Process is killed")
             return False
+        for stage in stages:
+            stage.shutdown()
+            logging.info(repr(stage))
         self.__stop_batch_controller()
         logging.info(
             f"Backup summary: {self.__new_count} new, {self.__updated_count} updated"
@@ -463,34 +786,40 @@ class Gmail:
         if quick_sync or quick_sync_days is None:
             logging.debug("Mark as deletes...")
             deleted_count = 0
-            for message_id in stored_messages:
+            message_ids = [
+                message_id
+                for message_id in stored_messages.keys()
+                if stored_messages[message_id].metadata is not None
+            ]
+            for start in range(0, len(message_ids), Gmail.remove_batch_size):
                 if is_killed():
                     logging.warning("Process is killed")
                     return False
-
-                links = stored_messages[message_id]
-                logging.debug(f"{message_id} mark as deleted in local storage...")
-                meta_link = links.get(0)
-                if meta_link is None:
-                    continue
-                logging.debug(f"{message_id} - {meta_link}")
-                if self.__storage_remove(meta_link):
+                batch = message_ids[start : start + Gmail.remove_batch_size]
+                # the metadata is marked as deleted first, then the objects of the marked messages
+                meta_results = self.__storage_remove_many(
+                    [stored_messages[message_id].metadata for message_id in batch]
+                )
+                objects = []
+                for message_id, result in zip(batch, meta_results):
+                    if not result:
+                        logging.error(f"{message_id} mark as deleted failed")
+                        continue
                     logging.debug(f"{message_id} metadata mark as deleted successfully")
-                    message_link = links.get(1)
-                    if message_link is None:
+                    if stored_messages[message_id].object is None:
                         logging.debug(f"{message_id} marked as deleted")
                         deleted_count += 1
                     else:
-                        if self.__storage_remove(message_link):
-                            logging.debug(
-                                f"{message_id} object mark as deleted successfully"
-                            )
-                            logging.debug(f"{message_id} marked as deleted")
-                            deleted_count += 1
-                        else:
-                            logging.error(f"{message_id} object mark as deleted fail")
-                else:
-                    logging.error(f"{message_id} mark as deleted failed")
+                        objects.append(message_id)
+                object_results = self.__storage_remove_many(
+                    [stored_messages[message_id].object for message_id in objects]
+                )
+                for message_id, result in zip(objects, object_results):
+                    if result:
+                        logging.debug(f"{message_id} marked as deleted")
+                        deleted_count += 1
+                    else:
+                        logging.error(f"{message_id} object mark as deleted fail")
             logging.info(f"Marked as deleted: {deleted_count}")
         else:
             logging.info("Quick syncing mode, skip deletion for locale storage")
@@ -595,7 +924,7 @@ class Gmail:
     def __restore_message(
         self,
         restore_message_id: str,
-        link: dict[int, LinkInterface],
+        link: LinkIndexEntry,
         to_email: str,
         labels_from_storage: dict[str, dict[str, any]],
         labels_form_server: dict[str, dict[str, any]],
@@ -603,13 +932,11 @@ class Gmail:
     ):
         try:
             logging.debug(f"{restore_message_id} Restoring message...")
-            if 0 not in link or 1 not in link:
+            if link.metadata is None or link.object is None:
                 raise Exception("Metadata and/or message link not found in storage")
-            with self.storage.get(link[0]) as mf:
+            with self.storage.get(link.metadata) as mf:
                 meta = json.load(mf)
             logging.debug(f"{restore_message_id} {meta}")
-            with self.storage.get(link[1]) as mf:
-                message_content = gzip.decompress(mf.read())
             # meta without labelIds is valid from server
             label_ids_from_message: [str] = meta.get("labelIds", [])
             try:
@@ -636,14 +963,23 @@ class Gmail:
                 f"{restore_message_id} snippet: {str_trim(meta['snippet'], 80)} / labels: {', '.join(label_names)}"
             )
 
-            message_data = {
-                "labelIds": label_ids,
-                "raw": encode_base64url(message_content),
-            }
             subject = str_trim(meta.get("snippet", ""), 64)
             if self.dry_mode:
                 logging.info(f"DRY MODE {restore_message_id} message insert")
-            result = self.__service_wrapper.insert_message(to_email, message_data)
+            # decompressed in chunks into a seekable spool (the upload can be retried),
+            # only the small messages are kept in memory
+            with (
+                self.storage.get(link.object) as mf,
+                self.__decoder(link.object).open(mf) as df,
+                tempfile.SpooledTemporaryFile(
+                    max_size=Gmail.restore_spool_size
+                ) as message,
+            ):
+                shutil.copyfileobj(df, message, Gmail.restore_chunk_size)
+                message.seek(0)
+                result = self.__service_wrapper.insert_message_stream(
+                    to_email, label_ids, message
+                )
             logging.debug(f"Message uploaded {result}")
             logging.debug(
                 f'{restore_message_id}->{result.get("id")} Message uploaded ({subject})'
@@ -655,17 +991,11 @@ class Gmail:
             logging.exception(f"{restore_message_id} Exception: {e}")
 
     def __load_labels_from_storage(
-        self, links: LinkList[LinkInterface]
+        self, links: LinkIndex
     ) -> dict[str, dict[str, any]] | None:
         logging.debug(f"Loading labels...")
-        labels_links: dict[str, LinkInterface] = links.find(
-            f=lambda l: l.id() == Gmail.object_id_labels and l.is_metadata,
-            g=lambda l: [l.mutation()],
-        )
-        labels_links = collections.OrderedDict(sorted(labels_links.items()))
         result = {}
-        for key in labels_links:
-            labels_link = labels_links[key]
+        for labels_link in links.mutations(Gmail.object_id_labels):
             with self.storage.get(labels_link) as lf:
                 json_data: list[dict[str, any]] = json_load(lf)
                 if json_data is None:
@@ -689,14 +1019,6 @@ class Gmail:
         if to_email is None:
             to_email = self.email
 
-        logging.debug("Scanning backup storage...")
-        stored_data_all = self.storage.find()
-        logging.debug(f"Stored items: {len(stored_data_all)}")
-
-        latest_labels_from_storage = self.__load_labels_from_storage(stored_data_all)
-        if latest_labels_from_storage is None:
-            logging.error("Stored labels loading failed")
-            return False
         _labels_from_server = self.__get_labels_from_server(email=to_email)
         if _labels_from_server is None:
             logging.error("Loading labels from server failed")
@@ -712,23 +1034,24 @@ class Gmail:
             messages_from_server_dest_email = self.__get_all_messages_from_server()
 
         logging.debug("Filtering messages...")
-        stored_messages: dict[str, dict[int, LinkInterface]] = stored_data_all.find(
-            f=lambda l: not l.is_special_id()
-            and (l.is_metadata() or l.is_object())
-            and item_filter.match(
+        stored_messages, labels_links = self.__scan_storage(
+            f=lambda l: item_filter.match(
                 {
                     "message-id": l.id(),
                     "link": l,
                     "server-data": messages_from_server_dest_email,
                 }
             ),
-            g=lambda l: [l.id(), 0 if l.is_metadata() else 1],
         )
-        del stored_data_all
-        for message_id in list(stored_messages.keys()):
+        latest_labels_from_storage = self.__load_labels_from_storage(labels_links)
+        del labels_links
+        if latest_labels_from_storage is None:
+            logging.error("Stored labels loading failed")
+            return False
+        for message_id in stored_messages.keys():
             if (
-                stored_messages[message_id].get(0) is None
-                or stored_messages[message_id].get(1) is None
+                stored_messages[message_id].metadata is None
+                or stored_messages[message_id].object is None
             ):
                 # no metadata or no object
                 del stored_messages[message_id]
@@ -740,7 +1063,7 @@ class Gmail:
             max_workers=self.__get_executor_max_workers()
         )
         futures = []
-        for message_id in stored_messages:
+        for message_id in stored_messages.keys():
             futures.append(
                 self.__submit_task(
                     executor,
@@ -765,3 +1088,388 @@ class Gmail:
         logging.info("Messages uploaded successfully")
 
         return True
+
+    def compact(
+        self,
+        keep_metadata_versions: int = 1,
+        deleted_retention_days: int | None = None,
+    ) -> bool:
+        """
+        Remove the superseded links by the retention policy:
+        keep the latest metadata versions and the latest object of the messages,
+        drop the messages deleted from the server before the retention period,
+        and merge the labels snapshots into one.
+        The partitions (date directories) are compacted in parallel. The deleted metadata of a dropped message
+        is removed after all of its other links, so an interrupted compaction continues by running it again.
+        :param keep_metadata_versions: number of the kept metadata versions per message (min. 1)
+        :param deleted_retention_days: days of keeping the deleted messages, None: keep them forever
+        """
+        if keep_metadata_versions < 1:
+            raise ValueError("keep_metadata_versions must be positive")
+        logging.info(f"Starting compaction for {self.email}")
+        stored_messages = LinkIndex(keep_mutations=True)
+        labels_links = LinkIndex(keep_mutations=True)
+        count = 0
+        for link in self.storage.iter_find():
+            count += 1
+            if link.id() == Gmail.object_id_labels:
+                labels_links.add(link)
+            elif not link.is_special_id() and (link.is_metadata() or link.is_object()):
+                stored_messages.add(link)
+        logging.debug(f"Stored items: {count}")
+        deleted_before = None
+        if deleted_retention_days is not None:
+            deleted_before = int(
+                (datetime.now() - timedelta(days=deleted_retention_days)).timestamp()
+                * 1000
+            )
+
+        # first stage: everything except the deleted metadata of the dropped messages
+        first: dict[str | None, list[LinkInterface]] = {}
+        last: dict[str | None, list[LinkInterface]] = {}
+        dropped_count = 0
+        for message_id in stored_messages.keys():
+            entry = stored_messages[message_id]
+            mutations = stored_messages.mutations(message_id)
+            metadata = [link for link in mutations if link.is_metadata()]
+            objects = [link for link in mutations if link.is_object()]
+            partition = entry.latest.partition()
+            if (
+                deleted_before is not None
+                and entry.metadata is not None
+                and entry.metadata.is_deleted()
+                and entry.metadata.mutation().isdigit()
+                and int(entry.metadata.mutation()) < deleted_before
+            ):
+                dropped_count += 1
+                first.setdefault(partition, []).extend(objects + metadata[:-1])
+                last.setdefault(partition, []).append(metadata[-1])
+            else:
+                removable = metadata[: max(0, len(metadata) - keep_metadata_versions)]
+                first.setdefault(partition, []).extend(removable + objects[:-1])
+        logging.info(
+            f"Messages: {len(stored_messages)}, dropped by the retention: {dropped_count}"
+        )
+        del stored_messages
+
+        failed = self.__compact_stage(first)
+        if failed is None:
+            logging.warning("Process is killed")
+            return False
+        for partition in last:
+            last[partition] = [l for l in last[partition] if l.id() not in failed]
+        failed_last = self.__compact_stage(last)
+        if failed_last is None:
+            logging.warning("Process is killed")
+            return False
+        result = len(failed) + len(failed_last) == 0
+        if not self.__compact_labels(labels_links):
+            result = False
+        if not self.storage.reclaim():
+            logging.error("Compaction failed with storage reclaim error")
+            return False
+        if not self.storage.flush():
+            logging.error("Compaction failed with storage flush error")
+            return False
+        if not result:
+            logging.error("Compaction finished with errors")
+            return False
+        logging.info(f"Compaction finished for {self.email}")
+        return True
+
+    def __compact_stage(
+        self, partitions: dict[str | None, list[LinkInterface]]
+    ) -> set[str] | None:
+        """
+        Remove the links of the partitions in parallel, the links of the unpartitioned storages are removed in batches.
+        Return the object IDs of the failed removals, None if the process is killed.
+        """
+        batches = []
+        for partition, links in partitions.items():
+            if partition is not None:
+                batches.append(links)
+                continue
+            for start in range(0, len(links), Gmail.remove_batch_size):
+                batches.append(links[start : start + Gmail.remove_batch_size])
+        batches = [batch for batch in batches if len(batch) > 0]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.batch_size
+        ) as executor:
+            futures = [
+                executor.submit(self.__compact_remove, batch) for batch in batches
+            ]
+            if not await_all_futures(futures):
+                executor.shutdown(wait=False, cancel_futures=True)
+                return None
+        failed: set[str] = set()
+        removed_count = 0
+        for batch, future in zip(batches, futures):
+            batch_failed = future.result()
+            removed_count += len(batch) - len(batch_failed)
+            failed.update(batch_failed)
+        logging.info(f"Removed links: {removed_count}")
+        return failed
+
+    def __compact_remove(self, links: list[LinkInterface]) -> list[str]:
+        if is_killed():
+            return [link.id() for link in links]
+        failed = []
+        try:
+            results = self.__storage_remove_many(links, as_new_mutation=False)
+        except BaseException as e:
+            logging.exception(f"Remove of {len(links)} links failed: {e}")
+            results = [False] * len(links)
+        for link, result in zip(links, results):
+            if not result:
+                logging.error(f"{link.id()} link remove failed: {link}")
+                failed.append(link.id())
+        return failed
+
+    def __compact_labels(self, labels_links: LinkIndex) -> bool:
+        """Merge the labels snapshots into the latest one, as the restore merges them"""
+        mutations = labels_links.mutations(Gmail.object_id_labels)
+        if len(mutations) < 2:
+            return True
+        labels = self.__load_labels_from_storage(labels_links)
+        if labels is None:
+            logging.error("Stored labels loading failed")
+            return False
+        with self.storage.get(mutations[-1]) as f:
+            latest = json_load(f)
+        if latest is None or {item.get("id"): item for item in latest} != labels:
+            link = self.storage.new_link(
+                object_id=Gmail.object_id_labels,
+                extension="json",
+                created_timestamp=None,
+            ).set_properties({LinkInterface.property_metadata: True})
+            if not self.__storage_put(link, data=json.dumps(list(labels.values()))):
+                logging.error("Error while storing the merged labels")
+                return False
+            removable = mutations
+        else:
+            removable = mutations[:-1]
+        results = self.__storage_remove_many(removable, as_new_mutation=False)
+        if not all(results):
+            logging.error("Removing the superseded labels failed")
+            return False
+        logging.debug(f"Labels snapshots are merged ({len(removable)} removed)")
+        return True
+
+    def verify(
+        self,
+        report_path: str,
+        checkpoint_path: str | None = None,
+        workers: int | None = None,
+    ) -> bool:
+        """
+        Verify the stored message objects: every object is decompressed and hashed by a process pool
+        (by a thread pool, if the storage can not be pickled), and compared with its content hash.
+        The verified objects are appended to the checkpoint, an interrupted verify continues from it.
+        After the full pass, the report is written (JSON) and the checkpoint is removed.
+        Return True if all objects are readable and match their content hash.
+        :param report_path: path of the JSON report of the corrupt and missing objects
+        :param checkpoint_path: path of the checkpoint (JSON lines), default: <report_path>.checkpoint
+        :param workers: number of the worker processes, default: cpu_workers
+        """
+        if checkpoint_path is None:
+            checkpoint_path = f"{report_path}.checkpoint"
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        if workers is None or workers < 1:
+            workers = self.cpu_workers
+        logging.info(f"Starting verify for {self.email}")
+        started = time.monotonic()
+        # the objects are read from the primary storage, not from a cached copy
+        storage = self.storage.uncached()
+        stored_messages = LinkIndex()
+        objects: list[LinkInterface] = []
+        dictionary_links: list[LinkInterface] = []
+        for link in storage.iter_find():
+            if link.id() == Gmail.object_id_zstd_dictionary:
+                dictionary_links.append(link)
+            elif not link.is_special_id() and (link.is_metadata() or link.is_object()):
+                stored_messages.add(link)
+                if link.is_object():
+                    objects.append(link)
+        self.__load_zstd_dictionaries(dictionary_links)
+        objects.sort(key=lambda l: (l.id(), l.mutation()))
+
+        counts = {status: 0 for status in Gmail.verify_statuses}
+        problems: list[dict[str, any]] = []
+        for message_id in stored_messages.keys():
+            entry = stored_messages[message_id]
+            if (
+                entry.object is None
+                and entry.metadata is not None
+                and not entry.metadata.is_deleted()
+            ):
+                counts[Gmail.verify_status_missing] += 1
+                problems.append(
+                    {
+                        "object_id": message_id,
+                        "mutation": None,
+                        "status": Gmail.verify_status_missing,
+                        "error": "message object is not found",
+                    }
+                )
+        del stored_messages
+        verified, size = Gmail.__load_verify_checkpoint(
+            checkpoint_path, counts, problems
+        )
+        resumed = len(verified)
+        if resumed > 0:
+            logging.info(f"Resuming verify from checkpoint, verified: {resumed}")
+        objects = [l for l in objects if Gmail.__verify_key(l) not in verified]
+        batches = [
+            objects[start : start + Gmail.verify_batch_size]
+            for start in range(0, len(objects), Gmail.verify_batch_size)
+        ]
+        logging.info(f"Objects to verify: {len(objects)} (workers: {workers})")
+
+        executor_class = concurrent.futures.ProcessPoolExecutor
+        try:
+            pickle.dumps(storage)
+        except BaseException as e:
+            logging.info(f"Storage is not picklable, verify with threads ({e})")
+            executor_class = concurrent.futures.ThreadPoolExecutor
+        run_size = 0
+        run_count = 0
+        last_log = time.monotonic()
+        killed = False
+        with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+            executor = executor_class(
+                max_workers=workers,
+                initializer=_verify_init,
+                initargs=(storage, self.__zstd_dictionaries),
+            )
+            try:
+                pending: dict[concurrent.futures.Future, list[LinkInterface]] = {}
+                next_batch = 0
+                while next_batch < len(batches) or len(pending) > 0:
+                    if is_killed():
+                        killed = True
+                        break
+                    while next_batch < len(batches) and len(pending) < workers * 2:
+                        batch = batches[next_batch]
+                        pending[executor.submit(_verify_objects, batch)] = batch
+                        next_batch += 1
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        timeout=1,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    for future in done:
+                        batch = pending.pop(future)
+                        try:
+                            results = future.result()
+                        except BaseException as e:
+                            logging.exception(f"Verify task failed: {e}")
+                            killed = True
+                            continue
+                        record = Gmail.__verify_record(batch, results)
+                        checkpoint.write(json.dumps(record) + "\n")
+                        checkpoint.flush()
+                        Gmail.__add_verify_record(record, counts, problems)
+                        run_size += record["size"]
+                        run_count += len(batch)
+                    if time.monotonic() - last_log >= 10:
+                        last_log = time.monotonic()
+                        logging.info(
+                            Gmail.__verify_progress(
+                                run_count, len(objects), run_size, started
+                            )
+                        )
+            finally:
+                executor.shutdown(wait=not killed, cancel_futures=True)
+        if killed:
+            logging.warning("Verify is interrupted, run it again to continue")
+            return False
+        logging.info(
+            Gmail.__verify_progress(run_count, len(objects), run_size, started)
+        )
+        report = {
+            "email": self.email,
+            "objects": sum(counts[s] for s in Gmail.verify_statuses),
+            "resumed": resumed,
+            "size": size + run_size,
+            "seconds": round(time.monotonic() - started, 3),
+            "counts": counts,
+            "problems": problems,
+        }
+        report_path_tmp = f"{report_path}.tmp"
+        with open(report_path_tmp, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        os.replace(report_path_tmp, report_path)
+        os.remove(checkpoint_path)
+        logging.info(
+            "Verify summary: "
+            + ", ".join(f"{counts[s]} {s}" for s in Gmail.verify_statuses)
+            + f" (report: {report_path})"
+        )
+        return (
+            counts[Gmail.verify_status_corrupt] + counts[Gmail.verify_status_missing]
+            == 0
+        )
+
+    @staticmethod
+    def __verify_key(link: LinkInterface) -> str:
+        return f"{link.id()}/{link.mutation()}/{link.get_extension()}"
+
+    @staticmethod
+    def __verify_record(
+        links: list[LinkInterface], results: list[tuple[str, int, str | None]]
+    ) -> dict[str, any]:
+        """Checkpoint record of a verified batch"""
+        record = {"links": [], "statuses": [], "size": 0, "problems": []}
+        for link, (status, size, error) in zip(links, results):
+            record["links"].append(Gmail.__verify_key(link))
+            record["statuses"].append(status)
+            record["size"] += size
+            if status in [Gmail.verify_status_corrupt, Gmail.verify_status_missing]:
+                record["problems"].append(
+                    {
+                        "object_id": link.id(),
+                        "mutation": link.mutation(),
+                        "extension": link.get_extension(),
+                        "status": status,
+                        "error": error,
+                    }
+                )
+        return record
+
+    @staticmethod
+    def __add_verify_record(
+        record: dict[str, any], counts: dict[str, int], problems: list[dict[str, any]]
+    ):
+        for status in record["statuses"]:
+            counts[status] += 1
+        problems.extend(record["problems"])
+
+    @staticmethod
+    def __load_verify_checkpoint(
+        checkpoint_path: str, counts: dict[str, int], problems: list[dict[str, any]]
+    ) -> tuple[set[str], int]:
+        """Load the verified batches of an interrupted verify, return the verified keys and their size"""
+        verified: set[str] = set()
+        size = 0
+        if not os.path.exists(checkpoint_path):
+            return verified, size
+        with open(checkpoint_path, "r+b") as f:
+            lines = f.read().split(b"\n")
+            if len(lines[-1]) > 0:
+                # partial record of a killed process
+                logging.debug("Partial checkpoint record is removed")
+                f.truncate(f.tell() - len(lines[-1]))
+        for line in lines[:-1]:
+            record = json.loads(line)
+            Gmail.__add_verify_record(record, counts, problems)
+            verified.update(record["links"])
+            size += record["size"]
+        return verified, size
+
+    @staticmethod
+    def __verify_progress(count: int, total: int, size: int, started: float) -> str:
+        elapsed = max(time.monotonic() - started, 0.001)
+        return (
+            f"Verified {count}/{total} objects, {count / elapsed:.1f} objects/s, "
+            f"{size / elapsed / 1024 / 1024:.1f} MiB/s"
+        )
@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import logging
 import multiprocessing
 import sys
@@ -9,13 +10,23 @@ from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from tzlocal import get_localzone
 
 import gwbackupy.global_properties as global_properties
+from gwbackupy.async_gmail import AsyncGmail
 from gwbackupy.filters.gmail_filter import GmailFilter
 from gwbackupy.gmail import Gmail
 from gwbackupy.helpers import parse_date
+from gwbackupy.object_codec import GzipCodec, ZstdCodec, object_codecs
+from gwbackupy.providers.async_gmail_client import AsyncGmailClient
 from gwbackupy.providers.gapi_gmail_service_wrapper import GapiGmailServiceWrapper
 from gwbackupy.providers.gapi_service_provider import AccessNotInitializedError
 from gwbackupy.providers.gmail_service_provider import GmailServiceProvider
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.async_storage_interface import AsyncStorageAdapter
+from gwbackupy.storage.cached_storage import CachedStorage
 from gwbackupy.storage.file_storage import FileStorage
+from gwbackupy.storage.pack_storage import PackStorage
+from gwbackupy.storage.s3_storage import S3Storage
+from gwbackupy.storage.sqlite_storage import SqliteStorage
+from gwbackupy.storage.storage_interface import StorageInterface
 
 lock = threading.Lock()
 
@@ -72,6 +83,25 @@ def parse_arguments() -> argparse.Namespace:
         help="Automatically adjust batch size to maximize throughput without hitting rate limits",
         action="store_true",
     )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["thread", "async"],
+        help="Gmail backup and restore engine, default: thread",
+        default="thread",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        help="Messages processed at once by the async engine, default: 200",
+        default=200,
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        help="Threads for decoding, hashing and compressing the messages, default: number of CPUs (max. 8)",
+        default=None,
+    )
     parser.add_argument(
         "--service-account-email",
         type=str,
@@ -97,6 +127,87 @@ def parse_arguments() -> argparse.Namespace:
         required=False,
         default="./data",
     )
+    parser.add_argument(
+        "--workdir-cache",
+        type=str,
+        help="Path to a local cache directory (e.g. on SSD) in front of the storage in the workdir (e.g. on NAS)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--workdir-cache-size",
+        type=int,
+        help="Size budget of the workdir cache per account in MiB, default is 1024",
+        default=1024,
+    )
+    parser.add_argument(
+        "--content-hash-algorithm",
+        type=str.lower,
+        help="Content hash algorithm of new backup objects, default is md5",
+        default=content_hash.default_algorithm,
+        choices=content_hash.content_hash_prefixes.keys(),
+    )
+    parser.add_argument(
+        "--storage",
+        type=str.lower,
+        help="Storage backend: file (default, one file per object), pack (objects appended into large segment files), sqlite (links in an SQLite database) or s3 (S3-compatible object storage)",
+        default="file",
+        choices=["file", "pack", "sqlite", "s3"],
+    )
+    parser.add_argument(
+        "--s3-bucket",
+        type=str,
+        help="Bucket of the s3 storage",
+        default=None,
+    )
+    parser.add_argument(
+        "--s3-prefix",
+        type=str,
+        help="Key prefix of the s3 storage, the objects of an account are stored under <prefix>/<email>/gmail",
+        default="",
+    )
+    parser.add_argument(
+        "--s3-endpoint-url",
+        type=str,
+        help="Endpoint of the S3-compatible service (e.g. MinIO), default is AWS S3",
+        default=None,
+    )
+    parser.add_argument(
+        "--object-codec",
+        type=str.lower,
+        help="Compression of new message objects: gzip (default) or zstd (requires the zstandard package)",
+        default=GzipCodec.name,
+        choices=list(object_codecs.keys()),
+    )
+    parser.add_argument(
+        "--zstd-dictionary",
+        action="store_true",
+        help="Use a zstd dictionary trained per mailbox (trained after the first backup with zstd codec)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Store the message objects once in a shared content-addressed pool (<workdir>/objects), the accounts link into it (file storage only)",
+    )
+    parser.add_argument(
+        "--tombstone-mode",
+        type=str.lower,
+        help="How deleted messages are marked in the storage: copy (default), hardlink or reflink",
+        default=FileStorage.tombstone_mode_copy,
+        choices=FileStorage.tombstone_modes,
+    )
+    parser.add_argument(
+        "--durability",
+        type=str.lower,
+        help="Storage fsync policy: none (default, no fsync), file (every file is synced) or group (synced in batches)",
+        default=FileStorage.durability_none,
+        choices=FileStorage.durabilities,
+    )
+    parser.add_argument(
+        "--metadata-segments",
+        action="store_true",
+        help="Append the message metadata into per-month segment files instead of one file per message (file storage only)",
+    )
     parser.add_argument(
         "--oauth-bind-address",
         type=str,
@@ -203,6 +314,37 @@ def parse_arguments() -> argparse.Namespace:
         help="Filter date to (exclusive, format: yyyy-mm-dd or yyyy-mm-dd hh:mm:ss)",
         default=None,
     )
+    gmail_compact_parser = gmail_command_parser.add_parser(
+        "compact", help="Remove the superseded versions by the retention policy"
+    )
+    gmail_compact_parser.add_argument(
+        "--email", type=str, help="Email of the account", required=True, action="append"
+    )
+    gmail_compact_parser.add_argument(
+        "--keep-metadata-versions",
+        type=int,
+        default=1,
+        help="Number of the kept metadata versions per message, default is 1",
+    )
+    gmail_compact_parser.add_argument(
+        "--deleted-retention-days",
+        type=int,
+        default=None,
+        help="Drop the messages deleted from the server more than this many days ago, "
+        "by default the deleted messages are kept",
+    )
+    gmail_verify_parser = gmail_command_parser.add_parser(
+        "verify", help="Verify the stored messages by their content hashes"
+    )
+    gmail_verify_parser.add_argument(
+        "--email", type=str, help="Email of the account", required=True, action="append"
+    )
+    gmail_verify_parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Path of the JSON report, default is <workdir>/<email>/gmail-verify.json",
+    )
     if len(sys.argv) == 1 or "--help" in sys.argv:
         parser.print_help(sys.stderr)
         sys.exit(1)
@@ -227,6 +369,59 @@ def parse_arguments() -> argparse.Namespace:
         parser.error(
             "at least one of --credentials-filepath and --service-account-key-filepath required"
         )
+    if args.max_in_flight <= 0:
+        parser.error("--max-in-flight must be positive")
+    if args.engine == "async" and args.zstd_dictionary:
+        # the async engine reads the trained dictionaries, but it does not train them
+        parser.error("--engine async and --zstd-dictionary can not be used together")
+    if (
+        args.engine == "async"
+        and args.command == "backup"
+        and (args.quick_sync or args.quick_sync_days is not None)
+    ):
+        # the async engine has no quick sync mode, it would do a full backup silently
+        parser.error(
+            "--engine async and --quick-sync, --quick-sync-days can not be used together"
+        )
+    if args.command == "compact":
+        if args.keep_metadata_versions < 1:
+            parser.error("--keep-metadata-versions must be positive")
+        if args.deleted_retention_days is not None and args.deleted_retention_days < 0:
+            parser.error("--deleted-retention-days must not be negative")
+    if args.workdir_cache_size <= 0:
+        parser.error("--workdir-cache-size must be positive")
+    if args.storage == "s3" and args.s3_bucket is None:
+        parser.error("--s3-bucket is required with --storage s3")
+    if args.storage != "file":
+        # these options are implemented by the file storage only, the other backends would ignore them
+        file_only = []
+        if args.dedup:
+            file_only.append("--dedup")
+        if args.tombstone_mode != FileStorage.tombstone_mode_copy:
+            file_only.append("--tombstone-mode")
+        if args.durability != FileStorage.durability_none:
+            file_only.append("--durability")
+        if args.metadata_segments:
+            file_only.append("--metadata-segments")
+        if len(file_only) > 0:
+            parser.error(
+                ", ".join(file_only) + f" can not be used with --storage {args.storage}"
+            )
+    if (
+        args.dedup
+        and args.content_hash_algorithm not in FileStorage.pool_content_hash_algorithms
+    ):
+        # the pool is shared by the accounts, the content hash is the only identity of the objects
+        parser.error(
+            "--dedup requires --content-hash-algorithm "
+            + " or ".join(FileStorage.pool_content_hash_algorithms)
+        )
+    if args.dedup and args.zstd_dictionary:
+        # the dictionaries are per mailbox, the pooled objects are shared by the mailboxes
+        parser.error("--dedup and --zstd-dictionary can not be used together")
+    if args.zstd_dictionary and args.object_codec != ZstdCodec.name:
+        # the dictionary is not used by the other codecs
+        parser.error("--zstd-dictionary requires --object-codec zstd")
     return args
 
 
@@ -236,7 +431,45 @@ def _run_single_email(args: argparse.Namespace, email: str):
         handler.setFormatter(logging.Formatter(log_format))
 
     if args.service == "gmail":
-        storage = FileStorage(args.workdir + "/" + email + "/gmail")
+        if args.storage == "s3":
+            storage = S3Storage(
+                args.s3_bucket,
+                prefix="/".join(
+                    p for p in [args.s3_prefix.strip("/"), email, "gmail"] if p
+                ),
+                endpoint_url=args.s3_endpoint_url,
+                content_hash_algorithm=args.content_hash_algorithm,
+            )
+        elif args.storage == "sqlite":
+            storage = SqliteStorage(
+                args.workdir + "/" + email + "/gmail-sqlite",
+                content_hash_algorithm=args.content_hash_algorithm,
+            )
+        elif args.storage == "pack":
+            storage = PackStorage(
+                args.workdir + "/" + email + "/gmail-pack",
+                content_hash_algorithm=args.content_hash_algorithm,
+            )
+        else:
+            storage = FileStorage(
+                args.workdir + "/" + email + "/gmail",
+                content_hash_algorithm=args.content_hash_algorithm,
+                tombstone_mode=args.tombstone_mode,
+                durability=args.durability,
+                object_pool=args.workdir + "/objects" if args.dedup else None,
+                metadata_segments=args.metadata_segments,
+            )
+        primary_storage = storage
+        # the maintenance commands work on the primary storage, without filling the cache
+        if args.workdir_cache is not None and args.command not in [
+            "compact",
+            "verify",
+        ]:
+            storage = CachedStorage(
+                primary_storage,
+                args.workdir_cache + "/" + email + "/gmail",
+                max_size=args.workdir_cache_size * 1024 * 1024,
+            )
         storage_oauth_tokens = FileStorage(args.workdir + "/oauth-tokens")
         service_provider = GmailServiceProvider(
             credentials_file_path=args.credentials_filepath,
@@ -258,7 +491,16 @@ def _run_single_email(args: argparse.Namespace, email: str):
             storage=storage,
             dry_mode=args.dry,
             auto_batch=args.auto_batch,
+            object_codec=args.object_codec,
+            zstd_dictionary=args.zstd_dictionary,
+            cpu_workers=args.cpu_workers,
         )
+        if (
+            args.command in ["backup", "restore"]
+            and not args.dry
+            and isinstance(primary_storage, FileStorage)
+        ):
+            primary_storage.start_sweeper()
         if args.command == "access-init":
             service_wrapper.get_labels(email)
         elif args.command == "access-check":
@@ -267,6 +509,11 @@ def _run_single_email(args: argparse.Namespace, email: str):
                     service_wrapper.get_labels(email)
             except AccessNotInitializedError:
                 sys.exit(1)
+        elif args.command == "backup" and args.engine == "async":
+            if asyncio.run(_async_gmail_backup(args, email, storage, service_provider)):
+                sys.exit(0)
+            else:
+                sys.exit(1)
         elif args.command == "backup":
             if gmail.backup(
                 quick_sync=args.quick_sync, quick_sync_days=args.quick_sync_days
@@ -274,6 +521,22 @@ def _run_single_email(args: argparse.Namespace, email: str):
                 sys.exit(0)
             else:
                 sys.exit(1)
+        elif args.command == "compact":
+            if gmail.compact(
+                keep_metadata_versions=args.keep_metadata_versions,
+                deleted_retention_days=args.deleted_retention_days,
+            ):
+                sys.exit(0)
+            else:
+                sys.exit(1)
+        elif args.command == "verify":
+            report_path = args.report
+            if report_path is None:
+                report_path = args.workdir + "/" + email + "/gmail-verify.json"
+            if gmail.verify(report_path, workers=args.cpu_workers):
+                sys.exit(0)
+            else:
+                sys.exit(1)
         elif args.command == "restore":
             add_labels = (
                 args.add_labels if args.add_labels is not None else ["gwbackupy"]
@@ -301,11 +564,24 @@ def _run_single_email(args: argparse.Namespace, email: str):
                 logging.warning("Tasks not found, see more e.g. --restore-deleted")
                 sys.exit(0)
 
-            if gmail.restore(
-                to_email=args.to_email,
-                item_filter=item_filter,
-                add_labels=add_labels,
-            ):
+            if args.engine == "async":
+                result = asyncio.run(
+                    _async_gmail_restore(
+                        args,
+                        email,
+                        storage,
+                        service_provider,
+                        item_filter,
+                        add_labels,
+                    )
+                )
+            else:
+                result = gmail.restore(
+                    to_email=args.to_email,
+                    item_filter=item_filter,
+                    add_labels=add_labels,
+                )
+            if result:
                 sys.exit(0)
             else:
                 sys.exit(1)
@@ -313,6 +589,59 @@ def _run_single_email(args: argparse.Namespace, email: str):
             raise Exception("Unknown command")
 
 
+def _async_gmail(
+    args: argparse.Namespace,
+    email: str,
+    storage: StorageInterface,
+    service_provider: GmailServiceProvider,
+) -> AsyncGmail:
+    return AsyncGmail(
+        email=email,
+        storage=AsyncStorageAdapter(storage, workers=args.batch_size),
+        client=AsyncGmailClient(
+            service_provider.get_access_token,
+            max_connections=args.max_in_flight,
+            dry_mode=args.dry,
+        ),
+        max_in_flight=args.max_in_flight,
+        object_codec=args.object_codec,
+        cpu_workers=args.cpu_workers,
+        dry_mode=args.dry,
+    )
+
+
+async def _async_gmail_backup(
+    args: argparse.Namespace,
+    email: str,
+    storage: StorageInterface,
+    service_provider: GmailServiceProvider,
+) -> bool:
+    gmail = _async_gmail(args, email, storage, service_provider)
+    try:
+        return await gmail.backup()
+    finally:
+        await gmail.client.close()
+        await gmail.storage.close()
+
+
+async def _async_gmail_restore(
+    args: argparse.Namespace,
+    email: str,
+    storage: StorageInterface,
+    service_provider: GmailServiceProvider,
+    item_filter: GmailFilter,
+    add_labels: list[str],
+) -> bool:
+    gmail = _async_gmail(args, email, storage, service_provider)
+    try:
+        return await gmail.restore(
+            to_email=args.to_email, item_filter=item_filter, add_labels=add_labels
+        )
+    finally:
+        await gmail.client.close()
+        await gmail.storage.close()
+
+
 def _ensure_access(args: argparse.Namespace, emails: list[str]):
     """Sequentially ensure all email accounts have valid OAuth tokens before parallel execution."""
     if args.credentials_filepath is None:
@@ -351,6 +680,14 @@ def cli_startup():
             logging.error("--to-email cannot be used with multiple --email accounts")
             sys.exit(1)
 
+        if (
+            args.command == "verify"
+            and getattr(args, "report", None) is not None
+            and len(emails) > 1
+        ):
+            logging.error("--report cannot be used with multiple --email accounts")
+            sys.exit(1)
+
         if len(emails) == 1:
             _run_single_email(args, emails[0])
             return
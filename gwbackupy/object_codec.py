@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import gzip
+import threading
+from typing import IO, Callable
+
+DataWriter = Callable[[IO[bytes]], None]
+
+
+class ObjectCodec:
+    """Compression codec of the stored message objects, the codec is recorded in the extension of the object"""
+
+    name = ""
+    extension = ""
+
+    def writer(self, data: bytes) -> DataWriter:
+        """Return a writer callback which compresses the data into a stream"""
+        raise NotImplementedError("ObjectCodec#writer")
+
+    def open(self, f: IO[bytes]) -> IO[bytes]:
+        """Open a decompressing stream on a compressed (seekable) stream"""
+        raise NotImplementedError("ObjectCodec#open")
+
+    def decompress(self, f: IO[bytes]) -> bytes:
+        with self.open(f) as df:
+            return df.read()
+
+
+class GzipCodec(ObjectCodec):
+    name = "gzip"
+    extension = "gz"
+
+    def __init__(self, level: int = 9):
+        self.level = level
+
+    def writer(self, data: bytes) -> DataWriter:
+        def write(f: IO[bytes]):
+            # without mtime and file name, so the output is deterministic
+            with gzip.GzipFile(
+                filename="", fileobj=f, mode="wb", compresslevel=self.level, mtime=0
+            ) as gf:
+                gf.write(data)
+
+        return write
+
+    def open(self, f: IO[bytes]) -> IO[bytes]:
+        return gzip.GzipFile(fileobj=f, mode="rb")
+
+
+class ZstdCodec(ObjectCodec):
+    """
+    Zstandard codec, optionally with a trained dictionary.
+    The dictionary ID is recorded in the frame header, the decoder selects the dictionary by it.
+    Requires the optional zstandard package.
+    """
+
+    name = "zstd"
+    extension = "zst"
+    dictionary_size = 112640
+    """Default size of the trained dictionaries (bytes)"""
+    frame_header_size_max = 18
+
+    def __init__(
+        self,
+        level: int = 3,
+        dictionary: bytes | None = None,
+        dictionaries: list[bytes] | None = None,
+    ):
+        """
+        :param level: compression level
+        :param dictionary: dictionary of the compression
+        :param dictionaries: dictionaries of the decompression (the compression dictionary is added automatically)
+        """
+        zstandard = ZstdCodec.module()
+        self.level = level
+        self.__dictionary = None
+        self.__dictionaries: dict[int, any] = {}
+        for d in (dictionaries or []) + ([dictionary] if dictionary else []):
+            zd = zstandard.ZstdCompressionDict(d)
+            self.__dictionaries[zd.dict_id()] = zd
+            if d is dictionary:
+                self.__dictionary = zd
+        # the compressors are not thread safe, one per thread
+        self.__local = threading.local()
+
+    @staticmethod
+    def module():
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                "zstd codec requires the zstandard package: pip install gwbackupy[zstd]"
+            )
+        return zstandard
+
+    @staticmethod
+    def train(samples: list[bytes], size: int = dictionary_size) -> bytes:
+        """Train a dictionary from sample messages"""
+        return ZstdCodec.module().train_dictionary(size, samples).as_bytes()
+
+    @staticmethod
+    def dictionary_id(dictionary: bytes) -> int:
+        return ZstdCodec.module().ZstdCompressionDict(dictionary).dict_id()
+
+    def has_dictionary(self) -> bool:
+        return self.__dictionary is not None
+
+    def __compressor(self):
+        compressor = getattr(self.__local, "compressor", None)
+        if compressor is None:
+            compressor = ZstdCodec.module().ZstdCompressor(
+                level=self.level, dict_data=self.__dictionary
+            )
+            self.__local.compressor = compressor
+        return compressor
+
+    def writer(self, data: bytes) -> DataWriter:
+        def write(f: IO[bytes]):
+            # the content size is stored in the frame, the decompression allocates once
+            f.write(self.__compressor().compress(data))
+
+        return write
+
+    def open(self, f: IO[bytes]) -> IO[bytes]:
+        zstandard = ZstdCodec.module()
+        header = f.read(ZstdCodec.frame_header_size_max)
+        f.seek(0)
+        dict_id = zstandard.get_frame_parameters(header).dict_id
+        dictionary = None
+        if dict_id != 0:
+            dictionary = self.__dictionaries.get(dict_id)
+            if dictionary is None:
+                raise RuntimeError(f"zstd dictionary is not found ({dict_id})")
+        return zstandard.ZstdDecompressor(dict_data=dictionary).stream_reader(
+            f, closefd=False
+        )
+
+
+object_codecs = {GzipCodec.name: GzipCodec, ZstdCodec.name: ZstdCodec}
+"""Codec classes by name"""
+
+
+def codec_of_extension(extension: str | None) -> type[ObjectCodec]:
+    """Codec class of an object extension (e.g. eml.gz), gzip if it is unknown"""
+    if extension is not None:
+        for codec in object_codecs.values():
+            if extension.endswith(f".{codec.extension}"):
+                return codec
+    return GzipCodec
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import json
+import logging
+from typing import Any, Awaitable, Callable
+
+from gwbackupy.helpers import random_string
+
+TokenProvider = Callable[[str, bool], "str | Awaitable[str]"]
+"""Return an access token of the email, refreshed if the flag is set (blocking providers are called in a thread)"""
+
+
+class AsyncGmailHttpError(Exception):
+    def __init__(self, status: int, reason: str, body: Any = None):
+        super().__init__(f"HTTP {status}: {reason}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class AsyncGmailClient:
+    """
+    asyncio Gmail REST client on a pooled aiohttp session.
+    The requests of all accounts share the connection pool.
+    Requires the optional aiohttp package.
+    """
+
+    default_base_url = "https://gmail.googleapis.com"
+    list_page_size = 500
+
+    def __init__(
+        self,
+        token_provider: TokenProvider,
+        base_url: str = default_base_url,
+        max_connections: int = 100,
+        try_count: int = 5,
+        try_sleep: float = 10,
+        dry_mode: bool = False,
+        on_rate_limit_callback: Callable[[], None] | None = None,
+    ):
+        """
+        :param token_provider: access token of an email
+        :param base_url: base URL of the Gmail API
+        :param max_connections: size of the connection pool
+        :param try_count: number of attempts of the rate limited or failed requests
+        :param try_sleep: sleep (seconds) after a rate limited request
+        :param dry_mode: the modifications are not sent to the server
+        """
+        self.token_provider = token_provider
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.try_count = try_count
+        self.try_sleep = try_sleep
+        self.dry_mode = dry_mode
+        self.on_rate_limit_callback = on_rate_limit_callback
+        self.__session = None
+        self.__tokens: dict[str, str] = {}
+
+    @staticmethod
+    def module():
+        try:
+            import aiohttp
+        except ImportError:
+            raise RuntimeError(
+                "async engine requires the aiohttp package: pip install gwbackupy[async]"
+            )
+        return aiohttp
+
+    async def __aenter__(self) -> AsyncGmailClient:
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __get_session(self):
+        if self.__session is None:
+            aiohttp = AsyncGmailClient.module()
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, limit_per_host=self.max_connections
+                ),
+                timeout=aiohttp.ClientTimeout(total=300),
+            )
+        return self.__session
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __token(self, email: str, refresh: bool = False) -> str:
+        if not refresh and email in self.__tokens:
+            return self.__tokens[email]
+        if inspect.iscoroutinefunction(self.token_provider):
+            token = await self.token_provider(email, refresh)
+        else:
+            token = await asyncio.to_thread(self.token_provider, email, refresh)
+        self.__tokens[email] = token
+        return token
+
+    @staticmethod
+    def __is_rate_limit_exceeded(status: int, body: Any) -> bool:
+        if status == 429:
+            return True
+        if status != 403 or not isinstance(body, dict):
+            return False
+        errors = body.get("error", {}).get("errors", [])
+        return any(
+            e.get("reason") in ["rateLimitExceeded", "userRateLimitExceeded"]
+            for e in errors
+        )
+
+    async def request(
+        self,
+        email: str,
+        method: str,
+        path: str,
+        params: dict[str, Any] | None = None,
+        json_data: Any = None,
+        data: Any = None,
+        headers: dict[str, str] | None = None,
+    ) -> Any:
+        """Send a request with retries, return the JSON response"""
+        session = self.__get_session()
+        refresh_token = False
+        refreshed = False
+        for i in range(self.try_count):
+            token = await self.__token(email, refresh=refresh_token)
+            refresh_token = False
+            request_headers = {"Authorization": f"Bearer {token}"}
+            if headers is not None:
+                request_headers.update(headers)
+            try:
+                async with session.request(
+                    method,
+                    f"{self.base_url}{path}",
+                    params={k: v for k, v in (params or {}).items() if v is not None},
+                    json=json_data,
+                    data=data() if callable(data) else data,
+                    headers=request_headers,
+                ) as response:
+                    if response.status < 300:
+                        return await response.json(content_type=None)
+                    try:
+                        body = await response.json(content_type=None)
+                    except ValueError:
+                        body = None
+                    error = AsyncGmailHttpError(response.status, response.reason, body)
+            except (asyncio.TimeoutError, OSError) as e:
+                if i == self.try_count - 1:
+                    raise
+                logging.warning(f"Request failed ({method} {path}): {e}, next attempt")
+                continue
+            if error.status in [400, 404, 409] or i == self.try_count - 1:
+                raise error
+            if error.status == 401 and not refreshed:
+                # expired or revoked token, it is refreshed once
+                refresh_token = True
+                refreshed = True
+                continue
+            if AsyncGmailClient.__is_rate_limit_exceeded(error.status, error.body):
+                if self.on_rate_limit_callback is not None:
+                    self.on_rate_limit_callback()
+                logging.warning(
+                    f"Rate limit exceeded ({method} {path}), sleeping for {self.try_sleep} seconds"
+                )
+                await asyncio.sleep(self.try_sleep)
+            elif error.status < 500:
+                raise error
+            else:
+                logging.warning(
+                    f"Server error ({method} {path}): {error}, next attempt"
+                )
+        raise Exception(f"Request failed after {self.try_count} attempts")
+
+    async def get_labels(self, email: str) -> list[dict[str, Any]]:
+        response = await self.request(email, "GET", "/gmail/v1/users/me/labels")
+        return response.get("labels", [])
+
+    async def get_messages(self, email: str, q: str) -> dict[str, dict[str, Any]]:
+        """Return all messages that match with query"""
+        messages = {}
+        next_page_token = None
+        while True:
+            data = await self.request(
+                email,
+                "GET",
+                "/gmail/v1/users/me/messages",
+                params={
+                    "q": q,
+                    "maxResults": AsyncGmailClient.list_page_size,
+                    "pageToken": next_page_token,
+                },
+            )
+            for message in data.get("messages", []):
+                messages[message.get("id")] = message
+            next_page_token = data.get("nextPageToken")
+            if next_page_token is None:
+                return messages
+
+    async def get_message(
+        self, email: str, message_id: str, message_format: str = "minimal"
+    ) -> dict[str, Any] | None:
+        """Get one message by message ID. If not exists then return None"""
+        try:
+            return await self.request(
+                email,
+                "GET",
+                f"/gmail/v1/users/me/messages/{message_id}",
+                params={"format": message_format},
+            )
+        except AsyncGmailHttpError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    async def create_label(
+        self, email: str, name: str, get_if_already_exists: bool = False
+    ) -> dict[str, Any]:
+        if self.dry_mode:
+            return {
+                "name": name,
+                "id": f"Label_DRYMODE{random_string()}",
+                "type": "user",
+            }
+        try:
+            return await self.request(
+                email, "POST", "/gmail/v1/users/me/labels", json_data={"name": name}
+            )
+        except AsyncGmailHttpError as e:
+            if e.status != 409:
+                raise
+            logging.debug(f"label ({name}) already exists")
+        if not get_if_already_exists:
+            return {"name": name, "type": "user"}
+        for label in await self.get_labels(email):
+            if label.get("name") == name:
+                return label
+        raise Exception(f"Label ({name}) is already exists but cannot found it")
+
+    async def insert_message(
+        self, email: str, label_ids: list[str], message: bytes
+    ) -> dict[str, Any]:
+        """Insert a raw (RFC 822) message as a multipart upload, and return new message ID"""
+        if self.dry_mode:
+            return {"id": f"DRYMODE{random_string()}"}
+        aiohttp = AsyncGmailClient.module()
+
+        def body():
+            # a new body for every attempt
+            writer = aiohttp.MultipartWriter("related")
+            writer.append(
+                json.dumps({"labelIds": label_ids}),
+                {"Content-Type": "application/json; charset=UTF-8"},
+            )
+            writer.append(message, {"Content-Type": "message/rfc822"})
+            return writer
+
+        return await self.request(
+            email,
+            "POST",
+            "/upload/gmail/v1/users/me/messages",
+            params={"uploadType": "multipart", "internalDateSource": "dateHeader"},
+            data=body,
+        )
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+import io
 import logging
-from typing import Any, Callable
+from typing import IO, Any, Callable
 
 from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 
 from gwbackupy.helpers import is_rate_limit_exceeded, random_string
 from gwbackupy.process_helpers import sleep_kc
@@ -14,6 +16,9 @@ from gwbackupy.providers.gmail_service_wrapper_interface import (
 
 
 class GapiGmailServiceWrapper(GmailServiceWrapperInterface):
+    upload_chunk_size = 1024 * 1024
+    """Chunk size of the resumable message upload (multiple of 256 KiB), the larger messages are uploaded in chunks"""
+
     def __init__(
         self,
         service_provider: GmailServiceProvider,
@@ -160,19 +165,53 @@ class GapiGmailServiceWrapper(GmailServiceWrapperInterface):
         if self.dry_mode:
             return {"id": f"DRYMODE{random_string()}"}
 
+        return self.__insert(
+            email,
+            lambda service: service.users()
+            .messages()
+            .insert(
+                userId="me",
+                internalDateSource="dateHeader",
+                body=data,
+            ),
+        )
+
+    def insert_message_stream(
+        self, email: str, label_ids: list[str], message: IO[bytes]
+    ) -> dict[str, Any]:
+        if self.dry_mode:
+            return {"id": f"DRYMODE{random_string()}"}
+
+        size = message.seek(0, io.SEEK_END)
+
+        def request(service):
+            # from the start in every attempt
+            message.seek(0)
+            # the resumable upload reads the stream in chunks, the small messages are sent in one request
+            media = MediaIoBaseUpload(
+                message,
+                mimetype="message/rfc822",
+                chunksize=self.upload_chunk_size,
+                resumable=size > self.upload_chunk_size,
+            )
+            return (
+                service.users()
+                .messages()
+                .insert(
+                    userId="me",
+                    internalDateSource="dateHeader",
+                    body={"labelIds": label_ids},
+                    media_body=media,
+                )
+            )
+
+        return self.__insert(email, request)
+
+    def __insert(self, email: str, request: Callable[[Any], Any]) -> dict[str, Any]:
         for i in range(self.try_count):
             try:
                 with self.service_provider.get_service(email) as service:
-                    result = (
-                        service.users()
-                        .messages()
-                        .insert(
-                            userId="me",
-                            internalDateSource="dateHeader",
-                            body=data,
-                        )
-                        .execute()
-                    )
+                    result = request(service).execute()
                     return result
             except HttpError as e:
                 if i == self.try_count - 1:
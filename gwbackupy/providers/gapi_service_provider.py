@@ -17,6 +17,7 @@ from gwbackupy.providers.service_provider_interface import (
     ServiceItem,
 )
 from gwbackupy.storage.storage_interface import (
+    LinkIndex,
     LinkInterface,
     StorageInterface,
 )
@@ -53,12 +54,8 @@ class GapiServiceProvider(ServiceProviderInterface):
         self.storage = storage
         self.tlock = threading.RLock()
         self.services: dict[str, list[any]] = dict()
-        self.credentials_token_links: dict[
-            str, LinkInterface
-        ] = self.storage.find().find(
-            f=lambda l: l.id() == GapiServiceProvider.object_id_token,
-            g=lambda l: [l.get_properties().get("email", "")],
-        )
+        self.credentials: dict[str, any] = dict()
+        self.__credentials_token_links: dict[str, LinkInterface] | None = None
         self.oauth_bind_addr = oauth_bind_addr
         self.oauth_port = oauth_port
         self.oauth_redirect_host = oauth_redirect_host
@@ -83,23 +80,43 @@ class GapiServiceProvider(ServiceProviderInterface):
                 service = self.services[email].pop()
             if service is None:
                 logging.debug(f"{email} Create new service")
-                if self.credentials_file_path is not None:
-                    credentials = self.__get_credentials_by_oauth(
-                        email, access_init=access_init
-                    )
-                elif self.service_account_file_path is not None:
-                    credentials = self.__get_credentials_by_service_account(email)
-                else:
-                    raise Exception(f"{email} Not supported credentials")
-                if not credentials:
-                    raise Exception(f"{email} Credentials cannot be None")
                 service = build(
                     self.service_name,
                     self.version,
-                    credentials=credentials,
+                    credentials=self.__get_credentials(email, access_init),
                 )
         return ServiceItem(self, email, service)
 
+    def __get_credentials(self, email: str, access_init: bool = True):
+        if self.credentials_file_path is not None:
+            credentials = self.__get_credentials_by_oauth(
+                email, access_init=access_init
+            )
+        elif self.service_account_file_path is not None:
+            credentials = self.__get_credentials_by_service_account(email)
+        else:
+            raise Exception(f"{email} Not supported credentials")
+        if not credentials:
+            raise Exception(f"{email} Credentials cannot be None")
+        return credentials
+
+    def get_access_token(
+        self, email: str, force_refresh: bool = False, access_init: bool = True
+    ) -> str:
+        """
+        Return a valid access token of the email (e.g. for the async REST client)
+        :param force_refresh: refresh the token even if it is not expired locally (e.g. it is rejected by the server)
+        """
+        with self.tlock:
+            credentials = self.credentials.get(email)
+            if credentials is None:
+                credentials = self.__get_credentials(email, access_init)
+                self.credentials[email] = credentials
+            if force_refresh or not credentials.valid:
+                logging.debug(f"{email} Refresh access token")
+                credentials.refresh(Request())
+            return credentials.token
+
     def __get_credentials_by_service_account(self, email: str):
         """get credentials by service account access"""
         extension = self.service_account_file_path.split(".")[-1].lower()
@@ -120,14 +137,24 @@ class GapiServiceProvider(ServiceProviderInterface):
         credentials = credentials.with_subject(email)
         return credentials
 
+    def __token_links(self) -> dict[str, LinkInterface]:
+        """Latest token links by email hash, loaded on the first use by a point lookup of the token object ID"""
+        with self.tlock:
+            if self.__credentials_token_links is None:
+                self.__credentials_token_links = LinkIndex.build(
+                    self.storage.get_versions(GapiServiceProvider.object_id_token),
+                    key=lambda l: l.get_property("email", ""),
+                ).latest_links()
+            return self.__credentials_token_links
+
     def __get_credentials_by_oauth(self, email: str, access_init: bool = True):
         """Get credentials object from OAuth access. This method store token and reuse/refresh if required"""
         credentials = None
         fd, temp = tempfile.mkstemp()
         email_md5 = hashlib.md5(email.encode("utf-8")).hexdigest().lower()
-        if email_md5 in self.credentials_token_links:
+        if email_md5 in self.__token_links():
             logging.debug(f"{email} Try to load previously saved token")
-            token_link = self.credentials_token_links.get(email_md5)
+            token_link = self.__token_links().get(email_md5)
             with self.storage.get(token_link) as tf:
                 with open(temp, "wb") as tfo:
                     tfo.write(tf.read())
@@ -182,8 +209,8 @@ class GapiServiceProvider(ServiceProviderInterface):
                 raise Exception(f"{email} Failed to store token ({token_link_new})")
             else:
                 logging.info(f"{email} token stored successfully")
-                token_link_old = self.credentials_token_links.get(email_md5)
-                self.credentials_token_links[email_md5] = token_link_new
+                token_link_old = self.__token_links().get(email_md5)
+                self.__token_links()[email_md5] = token_link_new
                 if token_link_old:
                     result = self.storage.remove(token_link_old, False)
                     if result:
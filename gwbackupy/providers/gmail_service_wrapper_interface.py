@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import Any, Callable
+from typing import IO, Any, Callable
+
+from gwbackupy.helpers import encode_base64url
 
 from gwbackupy.providers.service_provider_interface import ServiceProviderInterface
 
@@ -33,3 +35,15 @@ class GmailServiceWrapperInterface:
     def insert_message(self, email: str, data: dict[str, Any]) -> dict[str, Any]:
         """Insert a message to server with specified data, and return new message ID"""
         ...
+
+    def insert_message_stream(
+        self, email: str, label_ids: list[str], message: IO[bytes]
+    ) -> dict[str, Any]:
+        """
+        Insert a message to server from a seekable stream of the raw (RFC 822) message, and return new message ID.
+        The default implementation reads the whole message, the implementations can upload it in chunks.
+        """
+        message.seek(0)
+        return self.insert_message(
+            email, {"labelIds": label_ids, "raw": encode_base64url(message.read())}
+        )
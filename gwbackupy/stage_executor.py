@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import concurrent.futures
+import threading
+import time
+from typing import Callable
+
+
+class Stage:
+    """
+    One stage of a processing pipeline: a thread pool with its own (optionally bounded) queue and metrics.
+    If the queue is bounded, then submit() blocks while the queue is full, so a slow stage slows down
+    the previous stages instead of buffering their results in memory.
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int | None = None):
+        """
+        :param name: name of the stage (thread names, metrics)
+        :param workers: number of worker threads
+        :param max_queue: maximum number of waiting tasks, None means unbounded
+        """
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=f"stage-{name}"
+        )
+        self.__slots: threading.Semaphore | None = None
+        if max_queue is not None:
+            self.__slots = threading.Semaphore(self.workers + max(0, max_queue))
+        self.__lock = threading.Lock()
+        self.__pending: set[concurrent.futures.Future] = set()
+        self.__queued = 0
+        self.__running = 0
+        self.__max_queue_depth = 0
+        self.__submitted = 0
+        self.__completed = 0
+        self.__busy_seconds = 0.0
+        self.__blocked_seconds = 0.0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        if self.__slots is not None:
+            start = time.perf_counter()
+            self.__slots.acquire()
+            blocked = time.perf_counter() - start
+        else:
+            blocked = 0.0
+        with self.__lock:
+            self.__blocked_seconds += blocked
+            self.__submitted += 1
+            self.__queued += 1
+            self.__max_queue_depth = max(self.__max_queue_depth, self.__queued)
+        try:
+            future = self.__executor.submit(self.__run, fn, args, kwargs)
+        except BaseException:
+            with self.__lock:
+                self.__queued -= 1
+            if self.__slots is not None:
+                self.__slots.release()
+            raise
+        with self.__lock:
+            self.__pending.add(future)
+        future.add_done_callback(self.__done)
+        return future
+
+    def __run(self, fn: Callable, args: tuple, kwargs: dict):
+        with self.__lock:
+            self.__queued -= 1
+            self.__running += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.__lock:
+                self.__running -= 1
+                self.__completed += 1
+                self.__busy_seconds += time.perf_counter() - start
+
+    def __done(self, future: concurrent.futures.Future):
+        with self.__lock:
+            self.__pending.discard(future)
+            if future.cancelled():
+                self.__queued -= 1
+        if self.__slots is not None:
+            self.__slots.release()
+
+    def pending(self) -> list[concurrent.futures.Future]:
+        """Submitted and not finished tasks"""
+        with self.__lock:
+            return list(self.__pending)
+
+    def join(
+        self, should_stop: Callable[[], bool] | None = None, step: float = 0.1
+    ) -> bool:
+        """
+        Wait for all submitted tasks (also for the ones submitted meanwhile).
+        :param should_stop: checked every step seconds, if it returns True then the waiting is stopped
+        :return: True if all tasks are finished, False if it is stopped
+        """
+        while True:
+            pending = self.pending()
+            if len(pending) == 0:
+                return True
+            concurrent.futures.wait(pending, timeout=step)
+            if should_stop is not None and should_stop():
+                return False
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        self.__executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of the waiting tasks"""
+        with self.__lock:
+            return self.__queued
+
+    def metrics(self) -> dict[str, any]:
+        with self.__lock:
+            return {
+                "name": self.name,
+                "workers": self.workers,
+                "submitted": self.__submitted,
+                "completed": self.__completed,
+                "queue_depth": self.__queued,
+                "max_queue_depth": self.__max_queue_depth,
+                "running": self.__running,
+                "busy_seconds": self.__busy_seconds,
+                "blocked_seconds": self.__blocked_seconds,
+            }
+
+    def __repr__(self) -> str:
+        m = self.metrics()
+        return (
+            f"Stage {m['name']}: {m['completed']}/{m['submitted']} tasks, "
+            f"queue depth {m['queue_depth']} (max {m['max_queue_depth']}), "
+            f"busy {m['busy_seconds']:.1f}s on {m['workers']} workers, "
+            f"submit blocked {m['blocked_seconds']:.1f}s"
+        )
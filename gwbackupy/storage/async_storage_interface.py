@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+from typing import AsyncIterator
+
+from gwbackupy.storage.storage_interface import (
+    Data,
+    LinkFilter,
+    LinkInterface,
+    LinkList,
+    StorageInterface,
+)
+
+
+class AsyncStorageInterface:
+    """
+    asyncio version of StorageInterface.
+    The data is read as bytes, the links are the links of the underlying storage.
+    """
+
+    def new_link(
+        self,
+        object_id: str,
+        extension: str,
+        created_timestamp: int | float | None = None,
+    ) -> LinkInterface:
+        raise NotImplementedError("AsyncStorageInterface#new_link")
+
+    async def get(self, link: LinkInterface) -> bytes:
+        raise NotImplementedError("AsyncStorageInterface#get")
+
+    async def put(self, link: LinkInterface, data: Data) -> bool:
+        raise NotImplementedError("AsyncStorageInterface#put")
+
+    async def remove(self, link: LinkInterface, as_new_mutation: bool = True) -> bool:
+        raise NotImplementedError("AsyncStorageInterface#remove")
+
+    async def put_many(self, items: list[tuple[LinkInterface, Data]]) -> list[bool]:
+        """
+        Put multiple links, see StorageInterface#put_many.
+        The default implementation calls put() item by item.
+        """
+        return [await self.put(link, data) for link, data in items]
+
+    async def remove_many(
+        self, links: list[LinkInterface], as_new_mutation: bool = True
+    ) -> list[bool]:
+        """
+        Remove multiple links, see StorageInterface#remove_many.
+        The default implementation calls remove() link by link.
+        """
+        return [await self.remove(link, as_new_mutation) for link in links]
+
+    async def find(self, f: LinkFilter | None = None) -> LinkList[LinkInterface]:
+        raise NotImplementedError("AsyncStorageInterface#find")
+
+    async def iter_find(
+        self, f: LinkFilter | None = None
+    ) -> AsyncIterator[LinkInterface]:
+        """
+        Find links as a stream.
+        The default implementation iterates over the result of find().
+        """
+        for link in await self.find(f):
+            yield link
+
+    async def modify(self, link: LinkInterface, to_link: LinkInterface) -> bool:
+        raise NotImplementedError("AsyncStorageInterface#modify")
+
+    async def flush(self) -> bool:
+        """
+        Make all previous writes durable.
+        The default implementation has nothing to flush.
+        """
+        return True
+
+    def content_hash_generate(self, data: bytes | str) -> str:
+        raise NotImplementedError("AsyncStorageInterface#content_hash_generate")
+
+    def content_hash_eq(self, link: LinkInterface, data: bytes | str) -> bool:
+        raise NotImplementedError("AsyncStorageInterface#content_hash_eq")
+
+    def has_content(self, link: LinkInterface) -> bool:
+        """See StorageInterface.has_content(), it is called from the CPU threads"""
+        return False
+
+    async def close(self):
+        pass
+
+
+class AsyncStorageAdapter(AsyncStorageInterface):
+    """
+    AsyncStorageInterface of a (blocking) StorageInterface.
+    The storage operations run in a dedicated thread pool, so the number of threads is bounded
+    by the workers, not by the number of coroutines in flight.
+    """
+
+    def __init__(self, storage: StorageInterface, workers: int = 8):
+        """
+        :param storage: the blocking storage
+        :param workers: number of threads of the storage operations
+        """
+        self.storage = storage
+        self.workers = max(1, workers)
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="async-storage"
+        )
+
+    async def __run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, fn, *args
+        )
+
+    def new_link(
+        self,
+        object_id: str,
+        extension: str,
+        created_timestamp: int | float | None = None,
+    ) -> LinkInterface:
+        return self.storage.new_link(object_id, extension, created_timestamp)
+
+    def __read(self, link: LinkInterface) -> bytes:
+        with self.storage.get(link) as f:
+            return f.read()
+
+    async def get(self, link: LinkInterface) -> bytes:
+        return await self.__run(self.__read, link)
+
+    async def put(self, link: LinkInterface, data: Data) -> bool:
+        return await self.__run(self.storage.put, link, data)
+
+    async def remove(self, link: LinkInterface, as_new_mutation: bool = True) -> bool:
+        return await self.__run(self.storage.remove, link, as_new_mutation)
+
+    async def put_many(self, items: list[tuple[LinkInterface, Data]]) -> list[bool]:
+        return await self.__run(self.storage.put_many, items)
+
+    async def remove_many(
+        self, links: list[LinkInterface], as_new_mutation: bool = True
+    ) -> list[bool]:
+        return await self.__run(self.storage.remove_many, links, as_new_mutation)
+
+    async def find(self, f: LinkFilter | None = None) -> LinkList[LinkInterface]:
+        return await self.__run(self.storage.find, f)
+
+    async def modify(self, link: LinkInterface, to_link: LinkInterface) -> bool:
+        return await self.__run(self.storage.modify, link, to_link)
+
+    async def flush(self) -> bool:
+        return await self.__run(self.storage.flush)
+
+    def content_hash_generate(self, data: bytes | str) -> str:
+        return self.storage.content_hash_generate(data)
+
+    def content_hash_eq(self, link: LinkInterface, data: bytes | str) -> bool:
+        return self.storage.content_hash_eq(link, data)
+
+    def has_content(self, link: LinkInterface) -> bool:
+        return self.storage.has_content(link)
+
+    async def close(self):
+        self.__executor.shutdown(wait=True)
@@ -0,0 +1,385 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import IO, Iterator
+
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.storage_interface import (
+    StorageInterface,
+    Data,
+    LinkFilter,
+    LinkIndexEntry,
+    LinkInterface,
+    LinkList,
+)
+
+# Directory structure of the cache
+# /<root>
+#    - <xx>/<key hash>         cached data of a link, the key is the identity of the link (id, extension, properties)
+#
+
+
+class PrefixedStream(io.RawIOBase):
+    """Read stream of the already read beginning of a stream and the rest of the stream"""
+
+    def __init__(self, prefix: bytes, rest: IO[bytes]):
+        self.__prefix = memoryview(prefix)
+        self.__offset = 0
+        self.__rest = rest
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.__offset < len(self.__prefix):
+            size = min(len(b), len(self.__prefix) - self.__offset)
+            b[:size] = self.__prefix[self.__offset : self.__offset + size]
+            self.__offset += size
+            return size
+        data = self.__rest.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.__rest.close()
+        super().close()
+
+
+class CachedStorage(StorageInterface):
+    """
+    Tiered storage: the writes go through to the primary storage, and a local cache keeps
+    the recently written and read data (e.g. the latest metadata) with LRU eviction in a size budget.
+    The links are the links of the primary storage.
+    """
+
+    def __init__(
+        self,
+        primary: StorageInterface,
+        root: str,
+        max_size: int = 1024 * 1024 * 1024,
+        max_item_size: int = 1024 * 1024,
+    ):
+        """
+        :param primary: the storage of the data (e.g. on a slow network storage)
+        :param root: directory of the cache (e.g. on a local SSD)
+        :param max_size: size budget of the cache (bytes)
+        :param max_item_size: larger items are not cached (bytes)
+        """
+        self.primary = primary
+        self.root = root
+        self.max_size = max_size
+        self.max_item_size = min(max_item_size, max_size)
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[str, int] = OrderedDict()
+        """cached key hashes with their sizes, the least recently used is the first"""
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__load()
+
+    def __load(self):
+        """Load the cached entries, the order of use is restored by the modification times"""
+        entries: list[tuple[float, str, int]] = []
+        os.makedirs(self.root, exist_ok=True)
+        with os.scandir(self.root) as dir_entries:
+            dir_paths = [e.path for e in dir_entries if e.is_dir()]
+        for dir_path in dir_paths:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.name.endswith(".tmp"):
+                        # interrupted write
+                        CachedStorage.__remove_file(entry.path)
+                        continue
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+        entries.sort()
+        for _, key, size in entries:
+            self.__entries[key] = size
+            self.__size += size
+        self.__evict()
+        logging.debug(f"Cache loaded: {len(self.__entries)} items, {self.__size} bytes")
+
+    @staticmethod
+    def key(link: LinkInterface) -> str:
+        """Cache key of a link by its identity"""
+        identity = "\0".join(
+            [
+                link.id(),
+                link.get_extension() or "",
+                json.dumps(
+                    link.get_properties(),
+                    sort_keys=True,
+                    separators=(",", ":"),
+                    default=str,
+                ),
+            ]
+        )
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    @staticmethod
+    def __remove_file(file_path: str):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except BaseException as e:
+            logging.exception(f"Cache file remove fail {file_path}: {e}")
+
+    def __evict(self):
+        """Remove the least recently used items over the size budget, the caller holds the lock"""
+        while self.__size > self.max_size and len(self.__entries) > 0:
+            key, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            CachedStorage.__remove_file(self.__path(key))
+
+    def __drop(self, key: str):
+        with self.__lock:
+            size = self.__entries.pop(key, None)
+            if size is None:
+                return
+            self.__size -= size
+            CachedStorage.__remove_file(self.__path(key))
+
+    def __open_cached(self, key: str) -> IO[bytes] | None:
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+            file_path = self.__path(key)
+            try:
+                f = open(file_path, "rb")
+            except FileNotFoundError:
+                # removed from outside
+                self.__size -= self.__entries.pop(key)
+                return None
+        try:
+            # persistent order of use
+            os.utime(file_path)
+        except OSError:
+            pass
+        return f
+
+    def __store(self, key: str, data: bytes) -> bool:
+        """Cache the data, return False if it is too large"""
+        if len(data) > self.max_item_size:
+            return False
+        file_path = self.__path(key)
+        file_path_tmp = f"{file_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            size = len(data)
+            with open(file_path_tmp, "wb") as f:
+                f.write(data)
+            with self.__lock:
+                os.replace(file_path_tmp, file_path)
+                old_size = self.__entries.pop(key, None)
+                if old_size is not None:
+                    self.__size -= old_size
+                self.__entries[key] = size
+                self.__size += size
+                self.__evict()
+            return True
+        except BaseException as e:
+            logging.exception(f"Cache write fail {file_path}: {e}")
+            return False
+        finally:
+            CachedStorage.__remove_file(file_path_tmp)
+
+    def new_link(
+        self,
+        object_id: str,
+        extension: str,
+        created_timestamp: int | float | None = None,
+    ) -> LinkInterface:
+        return self.primary.new_link(object_id, extension, created_timestamp)
+
+    def get(self, link: LinkInterface) -> IO[bytes]:
+        """
+        Read from the cache, or from the primary storage (once) and cache it if it is not too large.
+        The size is checked before the read if the primary stream knows it.
+        """
+        key = CachedStorage.key(link)
+        f = self.__open_cached(key)
+        with self.__lock:
+            if f is not None:
+                self.hits += 1
+                return f
+            self.misses += 1
+        pf = self.primary.get(link)
+        try:
+            size = CachedStorage.__stream_size(pf)
+            if size is not None and size > self.max_item_size:
+                return pf
+            data = CachedStorage.__read_at_most(pf, self.max_item_size + 1)
+        except BaseException:
+            pf.close()
+            raise
+        if len(data) > self.max_item_size:
+            # too large for the cache, the read part is not read again
+            return io.BufferedReader(PrefixedStream(data, pf))
+        pf.close()
+        if self.__store(key, data):
+            f = self.__open_cached(key)
+            if f is not None:
+                return f
+        return io.BytesIO(data)
+
+    @staticmethod
+    def __stream_size(f: IO[bytes]) -> int | None:
+        """Size of the rest of the stream without reading it, None if it is unknown"""
+        try:
+            if f.seekable():
+                position = f.tell()
+                size = f.seek(0, io.SEEK_END)
+                f.seek(position)
+                return size - position
+        except (OSError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def __read_at_most(f: IO[bytes], size: int) -> bytes:
+        chunks = []
+        while size > 0:
+            chunk = f.read(min(size, content_hash.chunk_size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def put(self, link: LinkInterface, data: Data) -> bool:
+        key = CachedStorage.key(link)
+        if isinstance(data, str):
+            data = bytes(data, "utf-8")
+        if not self.primary.put(link, data):
+            self.__drop(key)
+            return False
+        if isinstance(data, bytes):
+            self.__store(key, data)
+        else:
+            # the stream is consumed by the primary storage, it is cached on the first read
+            self.__drop(key)
+        return True
+
+    def put_many(self, items: list[tuple[LinkInterface, Data]]) -> list[bool]:
+        items = [
+            (link, bytes(data, "utf-8") if isinstance(data, str) else data)
+            for link, data in items
+        ]
+        results = self.primary.put_many(items)
+        for (link, data), result in zip(items, results):
+            key = CachedStorage.key(link)
+            if result and isinstance(data, bytes):
+                self.__store(key, data)
+            else:
+                self.__drop(key)
+        return results
+
+    def remove(self, link: LinkInterface, as_new_mutation: bool = True) -> bool:
+        result = self.primary.remove(link, as_new_mutation)
+        if not as_new_mutation:
+            self.__drop(CachedStorage.key(link))
+        return result
+
+    def remove_many(
+        self, links: list[LinkInterface], as_new_mutation: bool = True
+    ) -> list[bool]:
+        results = self.primary.remove_many(links, as_new_mutation)
+        if not as_new_mutation:
+            for link in links:
+                self.__drop(CachedStorage.key(link))
+        return results
+
+    def find(self, f: LinkFilter | None = None) -> LinkList[LinkInterface]:
+        return self.primary.find(f)
+
+    def iter_find(self, f: LinkFilter | None = None) -> Iterator[LinkInterface]:
+        return self.primary.iter_find(f)
+
+    def get_versions(self, object_id: str) -> LinkList[LinkInterface]:
+        return self.primary.get_versions(object_id)
+
+    def get_latest(self, object_id: str) -> LinkIndexEntry | None:
+        return self.primary.get_latest(object_id)
+
+    def modify(self, link: LinkInterface, to_link: LinkInterface) -> bool:
+        if not self.primary.modify(link, to_link):
+            return False
+        key = CachedStorage.key(link)
+        to_key = CachedStorage.key(to_link)
+        with self.__lock:
+            size = self.__entries.pop(key, None)
+            if size is None:
+                return True
+            try:
+                os.makedirs(os.path.dirname(self.__path(to_key)), exist_ok=True)
+                os.replace(self.__path(key), self.__path(to_key))
+                self.__entries[to_key] = size
+            except BaseException as e:
+                logging.exception(f"Cache file move fail {key} -> {to_key}: {e}")
+                self.__size -= size
+                CachedStorage.__remove_file(self.__path(key))
+        return True
+
+    def prepare(
+        self,
+        created_timestamp_from: int | float,
+        created_timestamp_to: int | float,
+    ) -> bool:
+        return self.primary.prepare(created_timestamp_from, created_timestamp_to)
+
+    def flush(self) -> bool:
+        return self.primary.flush()
+
+    def reclaim(self) -> bool:
+        return self.primary.reclaim()
+
+    def uncached(self) -> StorageInterface:
+        return self.primary.uncached()
+
+    def content_hash_add(self, link: LinkInterface) -> LinkInterface:
+        with self.get(link) as f:
+            link_content_hash = self.content_hash_generate(f)
+        to_link = link.clone()
+        to_link.set_properties({LinkInterface.property_content_hash: link_content_hash})
+        if self.modify(link, to_link):
+            return to_link
+        raise RuntimeError(f"Link hashing failed ({link})")
+
+    def content_hash_check(self, link: LinkInterface) -> bool | None:
+        if not link.has_property(LinkInterface.property_content_hash):
+            return None
+        with self.get(link) as f:
+            return self.content_hash_eq(link, f)
+
+    def content_hash_eq(
+        self, link: LinkInterface, data: IO[bytes] | bytes | str
+    ) -> bool:
+        return self.primary.content_hash_eq(link, data)
+
+    def content_hash_generate(self, b: IO[bytes] | bytes | str) -> str:
+        return self.primary.content_hash_generate(b)
+
+    def has_content(self, link: LinkInterface) -> bool:
+        return self.primary.has_content(link)
+
+    def shares_content(self) -> bool:
+        return self.primary.shares_content()
+
+    def __repr__(self) -> str:
+        with self.__lock:
+            return (
+                f"CachedStorage: {len(self.__entries)} items, {self.__size}/{self.max_size} bytes, "
+                f"{self.hits} hits, {self.misses} misses"
+            )
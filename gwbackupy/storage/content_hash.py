@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import hashlib
+from typing import IO
+
+# Content hash format: <prefix><hex digest>
+#    - m828c88f34ecb4c1ca8d89e018c6fad1a    md5
+#    - b<64 hex chars>                      blake2b (256 bit)
+#    - s<64 hex chars>                      sha256
+
+content_hash_prefixes: dict[str, str] = {
+    "md5": "m",
+    "blake2b": "b",
+    "sha256": "s",
+}
+"""Supported algorithms and their prefixes"""
+
+default_algorithm = "md5"
+
+chunk_size = 1024 * 1024
+"""Size of the chunks which are read from streams"""
+
+
+def new_hash(algorithm: str):
+    if algorithm == "md5":
+        return hashlib.md5()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    raise ValueError(f"Not supported content hash algorithm: {algorithm}")
+
+
+def algorithm_of(content_hash: str) -> str | None:
+    """Return the algorithm of the content hash by its prefix, or None if it is not supported"""
+    for algorithm, prefix in content_hash_prefixes.items():
+        if content_hash.startswith(prefix):
+            return algorithm
+    return None
+
+
+def generate(data: IO[bytes] | bytes | str, algorithm: str = default_algorithm) -> str:
+    """
+    Generate content hash. Streams are read in fixed-size chunks from their current position.
+    :param data: bytes, str (hashed as UTF-8) or any readable binary stream
+    :param algorithm: hash algorithm, see content_hash_prefixes
+    """
+    h = new_hash(algorithm)
+    if isinstance(data, bytes):
+        h.update(data)
+    elif isinstance(data, str):
+        h.update(bytes(data, "utf-8"))
+    elif hasattr(data, "read"):
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    else:
+        raise NotImplementedError(f"Invalid type: {type(data)}")
+    return content_hash_prefixes[algorithm] + h.hexdigest().lower()
+
+
+def eq(content_hash: str, data: IO[bytes] | bytes | str) -> bool:
+    """Check the content hash equality with the algorithm of the content hash"""
+    algorithm = algorithm_of(content_hash)
+    if algorithm is None:
+        return False
+    return generate(data, algorithm) == content_hash
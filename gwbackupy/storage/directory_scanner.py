@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import os
+from typing import Callable, Generic, Iterator, TypeVar
+
+T = TypeVar("T")
+DirectoryParser = Callable[[str, list[str]], T]
+"""Parse the file names of one directory: (directory path, file names) -> result"""
+
+
+class DirectoryScanner(Generic[T]):
+    """
+    Parallel directory tree scanner.
+    The directories are listed with os.scandir in a thread pool, so the per-directory latency
+    of network filesystems (NFS, SMB, network block storage) overlaps.
+    The files of each directory are parsed in a batch by the worker which listed it.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        parser: DirectoryParser[T],
+        workers: int = 8,
+        skip_dirs: list[str] | None = None,
+    ):
+        """
+        :param root: root directory
+        :param parser: directory parser, called once per directory in a worker thread
+        :param workers: number of listing threads (1 means scanning in the caller thread)
+        :param skip_dirs: directory names which are not scanned
+        """
+        self.root = root
+        self.parser = parser
+        self.workers = max(1, workers)
+        self.skip_dirs = set(skip_dirs) if skip_dirs is not None else set()
+
+    def scan(self) -> list[tuple[str, T]]:
+        """
+        Scan the directory tree.
+        :return: (directory path, parser result) pairs ordered by directory path, the root is the first
+        """
+        results = list(self.iter_scan())
+        results.sort(key=lambda r: r[0])
+        return results
+
+    def iter_scan(self) -> Iterator[tuple[str, T]]:
+        """
+        Scan the directory tree as a stream.
+        :return: (directory path, parser result) pairs in order of completion
+        """
+        if self.workers == 1:
+            pending = [self.root]
+            while len(pending) > 0:
+                path = pending.pop()
+                result, subdirs = self.__scan_dir(path)
+                pending.extend(subdirs)
+                yield path, result
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            futures = {executor.submit(self.__scan_dir, self.root): self.root}
+            try:
+                while len(futures) > 0:
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        path = futures.pop(future)
+                        result, subdirs = future.result()
+                        for subdir in subdirs:
+                            futures[executor.submit(self.__scan_dir, subdir)] = subdir
+                        yield path, result
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def __scan_dir(self, path: str) -> tuple[T, list[str]]:
+        filenames: list[str] = []
+        subdirs: list[str] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        filenames.append(entry.name)
+                    elif entry.name not in self.skip_dirs and not entry.is_symlink():
+                        # like os.walk, symbolic links to directories are not followed
+                        subdirs.append(entry.path)
+        except FileNotFoundError:
+            logging.debug(f"Directory not found {path}")
+        except OSError as e:
+            # like os.walk, the unreadable directories are skipped
+            logging.warning(f"Directory listing fail {path}: {e}")
+        return self.parser(path, filenames), subdirs
@@ -0,0 +1,396 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import threading
+from typing import Callable, Iterable
+
+# Index directory structure v2
+# /<root>/.gwbackupy-index
+#    - version                 index format version
+#    - dirs                    append-only known directories (relative to root) with their modification time
+#    - <xx>.log                append-only shard, <xx> is the first two hex chars of md5(object id)
+#
+# Directory records (one per line, the latest record of a directory is valid):
+#    <relpath>\t<mtime ns>     the directory was in sync with the index at this modification time
+#
+# Shard records (one per line, the path is relative to the root and separated by "/"):
+#    +<relpath>                file added
+#    -<relpath>                file removed
+
+
+class FileLinkIndex:
+    """
+    Persistent, append-only index of the link files under a FileStorage root.
+    The records are sharded by object ID, so a lookup of one object reads only one shard.
+    """
+
+    directory_name = ".gwbackupy-index"
+    version = "2"
+    spot_check_count = 16
+    """Number of the latest live records per shard which are checked for existence on load"""
+
+    def __init__(self, root: str, is_link_file: Callable[[str], bool]):
+        """
+        :param root: root directory of the storage
+        :param is_link_file: check a file name is a link file, used by the consistency check
+        """
+        self.root = root
+        self.is_link_file = is_link_file
+        self.path = os.path.join(root, FileLinkIndex.directory_name)
+        self.__lock = threading.Lock()
+        self.__ready: bool | None = None
+        # the whole index passed the consistency check (or it is rebuilt) in this process
+        self.__checked = False
+        # directories changed by this process since the last save_dirs(), their modification time is not checked
+        self.__touched_dirs: set[str] = set()
+
+    @staticmethod
+    def shard_of(object_id: str) -> str:
+        return hashlib.md5(object_id.encode("utf-8")).hexdigest()[:2]
+
+    @staticmethod
+    def __encode(relpath: str) -> str:
+        return (
+            relpath.replace("%", "%25")
+            .replace("\n", "%0a")
+            .replace("\r", "%0d")
+            .replace("\t", "%09")
+        )  # "%" must be first
+
+    @staticmethod
+    def __decode(s: str) -> str:
+        return (
+            s.replace("%0a", "\n")
+            .replace("%0d", "\r")
+            .replace("%09", "\t")
+            .replace("%25", "%")
+        )  # "%" must be last
+
+    def __version_path(self) -> str:
+        return os.path.join(self.path, "version")
+
+    def __dirs_path(self) -> str:
+        return os.path.join(self.path, "dirs")
+
+    def __shard_path(self, shard: str) -> str:
+        return os.path.join(self.path, f"{shard}.log")
+
+    def exists(self) -> bool:
+        """Index exists and its version is supported"""
+        try:
+            with open(self.__version_path(), "r", encoding="utf-8") as f:
+                return f.read().strip() == FileLinkIndex.version
+        except FileNotFoundError:
+            return False
+
+    def is_ready(self) -> bool:
+        """Cached variant of exists(), records are appended only if the index is ready"""
+        if self.__ready is None:
+            self.__ready = self.exists()
+        return self.__ready
+
+    def add(self, object_id: str, relpath: str):
+        self.__append("+", [(object_id, relpath)])
+
+    def remove(self, object_id: str, relpath: str):
+        self.__append("-", [(object_id, relpath)])
+
+    def add_many(self, items: list[tuple[str, str]]):
+        """Add (object ID, relpath) items, with one write per shard"""
+        self.__append("+", items)
+
+    def remove_many(self, items: list[tuple[str, str]]):
+        """Remove (object ID, relpath) items, with one write per shard"""
+        self.__append("-", items)
+
+    def add_dirs(self, relpaths: list[str]):
+        """Record new directories (e.g. the empty day directories created in advance), so they are known on load"""
+        self.touch_dirs(
+            [relpath.rpartition("/")[0] for relpath in relpaths]
+        )  # the parent is changed too
+        self.__append_dirs(relpaths)
+
+    def touch_dirs(self, relpaths: Iterable[str]):
+        """Mark directories as changed by this process, their state is recorded by save_dirs()"""
+        with self.__lock:
+            for relpath in relpaths:
+                while relpath != "":
+                    self.__touched_dirs.add(relpath)
+                    relpath = relpath.rpartition("/")[0]
+
+    def save_dirs(self):
+        """Record the modification time of the directories changed by this process (e.g. on flush)"""
+        with self.__lock:
+            relpaths = sorted(self.__touched_dirs)
+            self.__touched_dirs = set()
+        self.__append_dirs(relpaths)
+
+    def __dir_record(self, relpath: str) -> str:
+        try:
+            mtime = os.stat(self.__abspath(relpath)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = -1
+        return f"{FileLinkIndex.__encode(relpath)}\t{mtime}\n"
+
+    def __append_dirs(self, relpaths: list[str]):
+        if not self.is_ready() or len(relpaths) == 0:
+            return
+        try:
+            lines = "".join(self.__dir_record(relpath) for relpath in relpaths)
+            fd = os.open(
+                self.__dirs_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            try:
+                os.write(fd, lines.encode("utf-8"))
+            finally:
+                os.close(fd)
+        except BaseException as e:
+            logging.exception(f"Link index directory append fail {self.path}: {e}")
+            self.invalidate()
+
+    def __append(self, op: str, items: list[tuple[str, str]]):
+        if not self.is_ready() or len(items) == 0:
+            return
+        lines: dict[str, list[str]] = {}
+        for object_id, relpath in items:
+            lines.setdefault(FileLinkIndex.shard_of(object_id), []).append(
+                f"{op}{FileLinkIndex.__encode(relpath)}\n"
+            )
+        self.touch_dirs(relpath.rpartition("/")[0] for _, relpath in items)
+        for shard, shard_lines in lines.items():
+            shard_path = self.__shard_path(shard)
+            try:
+                # one write call in append mode, so concurrent writers do not interleave records
+                fd = os.open(shard_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, "".join(shard_lines).encode("utf-8"))
+                finally:
+                    os.close(fd)
+            except BaseException as e:
+                logging.exception(f"Link index append fail {shard_path}: {e}")
+                self.invalidate()
+                return
+
+    def invalidate(self):
+        """Mark the index as inconsistent, the next load will fail and the index will be rebuilt"""
+        with self.__lock:
+            self.__ready = False
+            self.__checked = False
+            try:
+                os.remove(self.__version_path())
+            except FileNotFoundError:
+                pass
+            except BaseException as e:
+                logging.exception(f"Link index invalidation fail {self.path}: {e}")
+
+    def load_shard(self, shard: str, dirs: set[str] | None = None) -> list[str] | None:
+        """
+        Load the live relative paths of one shard. Return None if the shard is inconsistent.
+        :param shard: shard key, see shard_of()
+        :param dirs: if specified, then the directories of all records (also the removed ones) are added to it
+        """
+        live: dict[str, None] = {}
+        try:
+            with open(
+                self.__shard_path(shard), "r", encoding="utf-8", newline="\n"
+            ) as f:
+                for line in f:
+                    if len(line) < 2 or line[-1] != "\n" or line[0] not in "+-":
+                        logging.warning(f"Link index shard is corrupted ({shard})")
+                        return None
+                    relpath = FileLinkIndex.__decode(line[1:-1])
+                    if dirs is not None:
+                        dirs.add(relpath.rpartition("/")[0])
+                    if line[0] == "+":
+                        live[relpath] = None
+                    else:
+                        live.pop(relpath, None)
+        except FileNotFoundError:
+            return []
+        return list(live.keys())
+
+    def load(self) -> list[str] | None:
+        """
+        Load all live relative paths. Return None if the index is missing or fails the consistency check:
+        - version is not supported
+        - a shard record is malformed (e.g. interrupted write)
+        - the latest live records of a shard are not exist
+        - the root files or the directories of the date-based layout are not known by the index
+        - a directory is modified since its state was recorded (e.g. by a writer without index)
+        """
+        if not self.exists():
+            return None
+        self.__ready = True
+        result: list[str] = []
+        dir_mtimes = self.__load_dir_mtimes()
+        if dir_mtimes is None:
+            return None
+        known_dirs: set[str] = set(dir_mtimes.keys())
+        shards = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith(".log"):
+                    shards.append(entry.name[:-4])
+        for shard in sorted(shards):
+            relpaths = self.load_shard(shard, known_dirs)
+            if relpaths is None:
+                return None
+            for relpath in relpaths[-FileLinkIndex.spot_check_count :]:
+                if not os.path.exists(self.__abspath(relpath)):
+                    logging.warning(f"Link index record is not exists ({relpath})")
+                    return None
+            result.extend(relpaths)
+
+        for d in list(known_dirs):
+            while d != "":
+                known_dirs.add(d)
+                d = d.rpartition("/")[0]
+        root_files = set(relpath for relpath in result if "/" not in relpath)
+        if not self.__check_tree(known_dirs, root_files):
+            return None
+        if not self.__check_dirs(known_dirs, dir_mtimes):
+            return None
+        self.__checked = True
+        return result
+
+    def load_shard_checked(self, shard: str) -> list[str] | None:
+        """
+        Load the live relative paths of one shard for a point lookup, without loading the other shards.
+        Return None if the index is inconsistent (e.g. a file written by a writer without index, or an index append lost by a crash):
+        the directories of the index are checked once (see load()), the directories of the shard records on every call.
+        The root files are not checked.
+        """
+        dir_mtimes = self.__load_dir_mtimes()
+        if dir_mtimes is None:
+            return None
+        if not self.__checked:
+            known_dirs = set(dir_mtimes.keys())
+            for d in list(known_dirs):
+                while d != "":
+                    known_dirs.add(d)
+                    d = d.rpartition("/")[0]
+            if not self.__check_tree(known_dirs, None) or not self.__check_dirs(
+                known_dirs, dir_mtimes
+            ):
+                return None
+            self.__checked = True
+        dirs: set[str] = set()
+        relpaths = self.load_shard(shard, dirs)
+        if relpaths is None or not self.__check_dirs(dirs, dir_mtimes):
+            return None
+        return relpaths
+
+    def __load_dir_mtimes(self) -> dict[str, int] | None:
+        """Recorded modification times of the known directories, None if a record is invalid"""
+        dir_mtimes: dict[str, int] = {}
+        try:
+            with open(self.__dirs_path(), "r", encoding="utf-8") as f:
+                for line in f:
+                    if line[-1:] != "\n":
+                        # interrupted append, the directory is checked by its previous record
+                        continue
+                    relpath, _, mtime = line[:-1].rpartition("\t")
+                    try:
+                        dir_mtimes[FileLinkIndex.__decode(relpath)] = int(mtime)
+                    except ValueError:
+                        logging.warning(f"Link index directory record is invalid")
+                        return None
+        except FileNotFoundError:
+            pass
+        return dir_mtimes
+
+    def __check_dirs(self, known_dirs: set[str], dir_mtimes: dict[str, int]) -> bool:
+        """Compare the modification time of the known directories with their recorded state (one stat per directory)"""
+        with self.__lock:
+            touched_dirs = set(self.__touched_dirs)
+        for relpath in known_dirs:
+            if relpath == "" or relpath in touched_dirs:
+                continue
+            try:
+                mtime = os.stat(self.__abspath(relpath)).st_mtime_ns
+            except FileNotFoundError:
+                mtime = -1
+            if dir_mtimes.get(relpath) != mtime:
+                logging.warning(f"Link index directory is modified ({relpath})")
+                return False
+        return True
+
+    def __check_tree(self, known_dirs: set[str], root_files: set[str] | None) -> bool:
+        """
+        Compare the root files and the first two directory levels with the index, without listing the leaf directories.
+        :param root_files: link files in the root, None: not checked
+        """
+        try:
+            with os.scandir(self.root) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            return len(known_dirs) == 0 and not root_files
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                if entry.name not in known_dirs:
+                    logging.warning(f"Link index not contains directory ({entry.name})")
+                    return False
+                with os.scandir(entry.path) as it:
+                    for sub_entry in it:
+                        relpath = f"{entry.name}/{sub_entry.name}"
+                        if sub_entry.is_dir() and relpath not in known_dirs:
+                            logging.warning(
+                                f"Link index not contains directory ({relpath})"
+                            )
+                            return False
+                continue
+            if root_files is None or not self.is_link_file(entry.name):
+                continue
+            if entry.name not in root_files:
+                logging.warning(f"Link index not contains file ({entry.name})")
+                return False
+        return True
+
+    def __abspath(self, relpath: str) -> str:
+        return os.path.join(self.root, *relpath.split("/"))
+
+    def rebuild(self, items: Iterable[tuple[str, str]], dirs: Iterable[str]):
+        """
+        Rewrite the index from (object id, relative path) pairs and the known directories.
+        :param items: (object id, relative path) of every stored link file
+        :param dirs: relative paths of every directory under the root
+        """
+        with self.__lock:
+            self.__ready = False
+            os.makedirs(self.path, exist_ok=True)
+            try:
+                os.remove(self.__version_path())
+            except FileNotFoundError:
+                pass
+            shards: dict[str, list[str]] = {}
+            for object_id, relpath in items:
+                shards.setdefault(FileLinkIndex.shard_of(object_id), []).append(
+                    f"+{FileLinkIndex.__encode(relpath)}\n"
+                )
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith(".log") and entry.name[:-4] not in shards:
+                        os.remove(entry.path)
+            for shard, lines in shards.items():
+                FileLinkIndex.__write_file(self.__shard_path(shard), lines)
+            FileLinkIndex.__write_file(
+                self.__dirs_path(), [self.__dir_record(d) for d in dirs]
+            )
+            self.__touched_dirs = set()
+            FileLinkIndex.__write_file(
+                self.__version_path(), [f"{FileLinkIndex.version}\n"]
+            )
+            self.__ready = True
+            self.__checked = True
+        logging.debug(f"Link index rebuilt ({self.path})")
+
+    @staticmethod
+    def __write_file(path: str, lines: list[str]):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+            f.writelines(lines)
+        os.replace(tmp, path)
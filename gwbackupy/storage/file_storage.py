@@ -1,19 +1,28 @@
 from __future__ import annotations
 
-import copy
-import hashlib
 import io
 import logging
 import os
 import re
 import shutil
+import stat
+import sys
+import threading
+import time
 from builtins import float
-from datetime import datetime, timezone
-from typing import IO
+from datetime import datetime, timedelta, timezone
+from typing import IO, Callable, Iterable, Iterator
 
+from gwbackupy import global_properties
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.directory_scanner import DirectoryScanner
+from gwbackupy.storage.file_link_index import FileLinkIndex
+from gwbackupy.storage.file_syncer import FileSyncer
+from gwbackupy.storage.metadata_segments import MetadataSegments
 from gwbackupy.storage.storage_interface import (
     StorageInterface,
     Data,
+    DataCall,
     LinkFilter,
     LinkInterface,
     LinkList,
@@ -38,27 +47,50 @@ class FileLink(LinkInterface):
         r"^(?P<id>[^.]+?)(?P<properties>(?:\.[a-z0-9]+=[^.]*)*)\.(?P<extension>.+)$"
     )
 
+    __slots__ = (
+        "__id",
+        "__path",
+        "__extension",
+        "__flags",
+        "__mutation",
+        "__content_hash",
+        "__properties",
+    )
+
+    __flag_properties: dict[str, int] = {
+        LinkInterface.property_deleted: 1,
+        LinkInterface.property_metadata: 2,
+        LinkInterface.property_object: 4,
+    }
+    """Well-known boolean properties, they are stored as bits of the flags"""
+
     def __init__(self):
         self.__id: str | None = None
         self.__path: str | None = None
-        self.__properties: dict[str, any] = {}
         self.__extension: str | None = None
+        self.__flags: int = 0
+        self.__mutation: str | None = None
+        self.__content_hash: str | None = None
+        # other properties, None if there are not any
+        self.__properties: dict[str, any] | None = None
 
     def fill(self, values: dict[str, any], replace: bool = False) -> FileLink:
         if "object_id" in values:
             self.__id = values["object_id"]
         if replace:
-            self.__properties = {}
+            self.__clear_properties()
         if "deleted" in values:
-            self.__properties[LinkInterface.property_deleted] = True
+            self.__set_property(LinkInterface.property_deleted, True)
         if "object" in values:
-            self.__properties[LinkInterface.property_object] = True
+            self.__set_property(LinkInterface.property_object, True)
         if "metadata" in values:
-            self.__properties[LinkInterface.property_metadata] = True
+            self.__set_property(LinkInterface.property_metadata, True)
         if "extension" in values:
             self.__extension = values["extension"]
+            if self.__extension is not None:
+                self.__extension = sys.intern(self.__extension)
         if "mutation" in values:
-            self.__properties[LinkInterface.property_mutation] = values["mutation"]
+            self.__mutation = values["mutation"]
         if "path" in values:
             self.__path = values["path"]
         for key in values:
@@ -75,9 +107,49 @@ class FileLink(LinkInterface):
                 if isinstance(value, str):
                     if value == "":
                         value = True
-                    self.__properties[key] = value
+                    self.__set_property(key, value)
         return self
 
+    def clone(self) -> FileLink:
+        link = self.__class__.__new__(self.__class__)
+        link.__id = self.__id
+        link.__path = self.__path
+        link.__extension = self.__extension
+        link.__flags = self.__flags
+        link.__mutation = self.__mutation
+        link.__content_hash = self.__content_hash
+        link.__properties = (
+            dict(self.__properties) if self.__properties is not None else None
+        )
+        return link
+
+    def __clear_properties(self):
+        self.__flags = 0
+        self.__mutation = None
+        self.__content_hash = None
+        self.__properties = None
+
+    def __set_property(self, name: str, value: any):
+        if name == LinkInterface.property_mutation:
+            self.__mutation = value
+            return
+        if name == LinkInterface.property_content_hash:
+            self.__content_hash = value
+            return
+        flag = FileLink.__flag_properties.get(name)
+        if flag is not None:
+            self.__flags &= ~flag
+            if value is True:
+                self.__flags |= flag
+                value = None
+        if value is None:
+            if self.__properties is not None:
+                self.__properties.pop(name, None)
+            return
+        if self.__properties is None:
+            self.__properties = {}
+        self.__properties[sys.intern(name)] = value
+
     @staticmethod
     def escape(s: str) -> str:
         s = s.replace("%", "%25")  # must be first
@@ -98,16 +170,26 @@ class FileLink(LinkInterface):
             .replace("%25", "%")
         )  # must be last
 
+    def get_path(self) -> str | None:
+        """Directory (or key prefix) of the link"""
+        return self.__path
+
+    def partition(self) -> str | None:
+        return self.__path
+
     def get_file_path(self) -> str:
-        path = os.path.join(self.__path, FileLink.escape(self.__id))
-        keys = list(self.__properties.keys())
+        return os.path.join(self.__path, self.get_file_name())
+
+    def get_file_name(self) -> str:
+        """The file name encodes the ID, the properties and the extension"""
+        path = FileLink.escape(self.__id)
+        properties = self.get_properties()
+        keys = list(properties.keys())
         keys.sort()
         for k in keys:
-            if self.__properties[k] is None:
-                continue
             path += f".{FileLink.escape(k)}="
-            if self.__properties[k] is not True:
-                path += FileLink.escape(str(self.__properties[k]))
+            if properties[k] is not True:
+                path += FileLink.escape(str(properties[k]))
         if self.__extension is not None:
             path += f".{self.__extension}"
 
@@ -131,34 +213,57 @@ class FileLink(LinkInterface):
                 v = True
             else:
                 v = FileLink.unescape(v)
-            result[FileLink.unescape(p)] = v
+            result[sys.intern(FileLink.unescape(p))] = v
         return result
 
     def mutation(self) -> str:
-        return self.get_property(LinkInterface.property_mutation)
+        return self.__mutation
+
+    def get_extension(self) -> str | None:
+        return self.__extension
 
     def id(self) -> str:
         return self.__id
 
     def get_properties(self) -> dict[str, any]:
-        return self.__properties
+        """Return the properties as a new dict, modify them with set_properties()"""
+        properties: dict[str, any] = {}
+        if self.__flags != 0:
+            for name, flag in FileLink.__flag_properties.items():
+                if self.__flags & flag:
+                    properties[name] = True
+        if self.__mutation is not None:
+            properties[LinkInterface.property_mutation] = self.__mutation
+        if self.__content_hash is not None:
+            properties[LinkInterface.property_content_hash] = self.__content_hash
+        if self.__properties is not None:
+            properties.update(self.__properties)
+        return properties
 
     def get_property(self, name: str, default: any = None) -> any:
-        if name in self.__properties:
-            return self.__properties[name]
-        return default
+        flag = FileLink.__flag_properties.get(name)
+        if flag is not None and self.__flags & flag:
+            return True
+        if name == LinkInterface.property_mutation:
+            value = self.__mutation
+        elif name == LinkInterface.property_content_hash:
+            value = self.__content_hash
+        elif self.__properties is not None:
+            value = self.__properties.get(name)
+        else:
+            value = None
+        if value is None:
+            return default
+        return value
 
     def has_property(self, name: str) -> bool:
-        if self.get_properties().get(name, None) is not None:
-            return True
-        return False
+        return self.get_property(name) is not None
 
     def set_properties(self, sets: dict[str, any], replace: bool = False) -> FileLink:
         if replace:
-            self.__properties = sets
-            return self
+            self.__clear_properties()
         for k, v in sets.items():
-            self.__properties[k] = v
+            self.__set_property(k, v)
         return self
 
     def is_deleted(self) -> bool:
@@ -171,7 +276,7 @@ class FileLink(LinkInterface):
         return self.has_property(LinkInterface.property_object) is True
 
     def __repr__(self) -> str:
-        return f"{self.__class__}#id:{self.id()},props:{self.__properties},path:{self.__path}"
+        return f"{self.__class__}#id:{self.id()},props:{self.get_properties()},path:{self.__path}"
 
     def __eq__(self, other):
         if not isinstance(other, FileLink):
@@ -188,8 +293,116 @@ class FileLink(LinkInterface):
 
 
 class FileStorage(StorageInterface):
-    def __init__(self, root: str):
+    tombstone_mode_copy = "copy"
+    """Deleted mutation is a copy of the file"""
+    tombstone_mode_hardlink = "hardlink"
+    """Deleted mutation is a hardlink to the file (fallback to copy)"""
+    tombstone_mode_reflink = "reflink"
+    """Deleted mutation is a copy-on-write clone of the file, e.g. on btrfs or xfs (fallback to copy)"""
+    tombstone_modes = [
+        tombstone_mode_copy,
+        tombstone_mode_hardlink,
+        tombstone_mode_reflink,
+    ]
+
+    durability_none = "none"
+    """No fsync, the operating system writes back the files (fastest, recent writes can be lost on power failure)"""
+    durability_file = "file"
+    """Every file and its directory is synced before put() returns"""
+    durability_group = "group"
+    """Files and directories are synced in batches by a background flusher, flush() waits for them"""
+    durabilities = [durability_none, durability_file, durability_group]
+
+    temporary_file_grace_period = 3600
+    """Temporary files older than this (in seconds) are leftovers of interrupted writes"""
+
+    __ioctl_ficlone = 0x40049409
+    __dir_open_flags = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+    __pool_key_pattern = re.compile(r"^[0-9a-zA-Z]{8,}$")
+    pool_content_hash_algorithms = ["blake2b", "sha256"]
+    """Content hash algorithms of the object pool keys, the pool is shared by accounts, so the keys must be collision resistant"""
+
+    def __init__(
+        self,
+        root: str,
+        use_index: bool = True,
+        scan_workers: int = 8,
+        content_hash_algorithm: str = content_hash.default_algorithm,
+        tombstone_mode: str = tombstone_mode_copy,
+        durability: str = durability_none,
+        sync_batch_size: int = 256,
+        sync_interval_ms: int = 100,
+        object_pool: str | None = None,
+        metadata_segments: bool = False,
+    ):
+        """
+        :param root: root directory of the storage
+        :param use_index: maintain a persistent link index, so find() does not need to walk the whole tree
+        :param scan_workers: number of threads for listing directories while scanning the whole tree
+        :param content_hash_algorithm: algorithm of the new content hashes, the existing ones are verified by their own algorithm
+        :param tombstone_mode: how remove() creates the deleted mutation, see tombstone_modes
+        :param durability: fsync policy of the writes, see durabilities
+        :param sync_batch_size: group durability: number of written files which triggers a batch sync
+        :param sync_interval_ms: group durability: maximum delay of the sync after a write
+        :param object_pool: shared content-addressed pool directory (e.g. of all accounts), the links with content hash are hardlinks into it
+        :param metadata_segments: append the new metadata links into per-month segment files instead of one file per link (the existing files are still readable)
+        """
+        if content_hash_algorithm not in content_hash.content_hash_prefixes:
+            raise ValueError(
+                f"Not supported content hash algorithm: {content_hash_algorithm}"
+            )
+        if tombstone_mode not in FileStorage.tombstone_modes:
+            raise ValueError(f"Not supported tombstone mode: {tombstone_mode}")
+        if durability not in FileStorage.durabilities:
+            raise ValueError(f"Not supported durability: {durability}")
+        if (
+            object_pool is not None
+            and content_hash_algorithm not in FileStorage.pool_content_hash_algorithms
+        ):
+            raise ValueError(
+                f"Object pool requires content hash algorithm: {', '.join(FileStorage.pool_content_hash_algorithms)}"
+            )
+        self.__options = {
+            "root": root,
+            "use_index": use_index,
+            "scan_workers": scan_workers,
+            "content_hash_algorithm": content_hash_algorithm,
+            "tombstone_mode": tombstone_mode,
+            "durability": durability,
+            "sync_batch_size": sync_batch_size,
+            "sync_interval_ms": sync_interval_ms,
+            "object_pool": object_pool,
+            "metadata_segments": metadata_segments,
+        }
+        self.tombstone_mode = tombstone_mode
+        self.durability = durability
+        self.__syncer: FileSyncer | None = None
+        if durability == FileStorage.durability_group:
+            self.__syncer = FileSyncer(
+                max_pending=sync_batch_size, interval_ms=sync_interval_ms
+            )
         self.root = root
+        self.object_pool = object_pool
+        self.content_hash_algorithm = content_hash_algorithm
+        self.scan_workers = scan_workers
+        self.__known_dirs: set[str] = set()
+        self.__known_dirs_lock = threading.Lock()
+        # a sync failed after the data was written, it is reported by the next flush()
+        self.__sync_failed = False
+        self.__sync_failed_lock = threading.Lock()
+        self.metadata_segments = metadata_segments
+        # always readable, so the storage can be opened in both modes
+        self.segments = MetadataSegments(root)
+        self.index: FileLinkIndex | None = None
+        if use_index:
+            self.index = FileLinkIndex(root, FileStorage.__is_link_file_name)
+
+    def __getstate__(self) -> dict[str, any]:
+        """The storage is pickled by its options (e.g. for a process pool), the receiver opens it again"""
+        return dict(self.__options)
+
+    def __setstate__(self, state: dict[str, any]):
+        self.__init__(**state)
 
     def new_link(
         self,
@@ -198,17 +411,9 @@ class FileStorage(StorageInterface):
         created_timestamp: int | float | None = None,
     ) -> FileLink:
         link = FileLink()
-        path = self.root
-        if created_timestamp is not None:
-            sub_paths = (
-                datetime.fromtimestamp(created_timestamp, tz=timezone.utc)
-                .strftime("%Y-%m-%d")
-                .split("-", 1)
-            )
-            path += f"/{sub_paths[0]}/{sub_paths[1]}"
         link.fill(
             {
-                "path": path,
+                "path": self.__path_of(created_timestamp),
                 "object_id": object_id,
                 "extension": extension,
                 "mutation": FileStorage.__gen_mutation(),
@@ -216,40 +421,373 @@ class FileStorage(StorageInterface):
         )
         return link
 
+    def __path_of(self, created_timestamp: int | float | None) -> str:
+        if created_timestamp is None:
+            return self.root
+        return self.__path_of_date(
+            datetime.fromtimestamp(created_timestamp, tz=timezone.utc)
+        )
+
+    def __path_of_date(self, date: datetime) -> str:
+        sub_paths = date.strftime("%Y-%m-%d").split("-", 1)
+        return f"{self.root}/{sub_paths[0]}/{sub_paths[1]}"
+
+    def prepare(
+        self,
+        created_timestamp_from: int | float,
+        created_timestamp_to: int | float,
+    ) -> bool:
+        """Create the day directories of the range in advance, and add them to the known directories"""
+        date = datetime.fromtimestamp(created_timestamp_from, tz=timezone.utc)
+        date_to = datetime.fromtimestamp(created_timestamp_to, tz=timezone.utc)
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        result = True
+        count = 0
+        while date <= date_to:
+            path = self.__path_of_date(date)
+            if not self.__make_dir(path, []):
+                result = False
+            count += 1
+            date += timedelta(days=1)
+        logging.debug(f"Prepared {count} directories")
+        return result
+
     @staticmethod
     def __gen_mutation():
         return str(int(datetime.now(tz=timezone.utc).timestamp() * 1000))
 
     def get(self, link: FileLink) -> IO[bytes]:
         file_path = link.get_file_path()
+        if link.is_metadata():
+            data = self.segments.read(*os.path.split(file_path))
+            if data is not None:
+                return io.BytesIO(data)
         return open(file_path, "rb")
 
+    def get_many(self, links: list[FileLink]) -> list[IO[bytes]]:
+        """Open the links grouped by directory, the files are opened relative to one directory handle per directory"""
+        if not FileStorage.__supports_dir_fd():
+            return super().get_many(links)
+        streams: list[IO[bytes] | None] = [None] * len(links)
+        try:
+            for path, group in FileStorage.__group_by_dir(
+                links, range(len(links))
+            ).items():
+                files = []
+                for i, file_name in group:
+                    data = None
+                    if links[i].is_metadata():
+                        data = self.segments.read(path, file_name)
+                    if data is not None:
+                        streams[i] = io.BytesIO(data)
+                    else:
+                        files.append((i, file_name))
+                if len(files) == 0:
+                    continue
+                dir_fd = os.open(path, FileStorage.__dir_open_flags)
+                try:
+                    for i, file_name in files:
+                        streams[i] = open(
+                            os.open(file_name, os.O_RDONLY, dir_fd=dir_fd), "rb"
+                        )
+                finally:
+                    os.close(dir_fd)
+        except BaseException:
+            for stream in streams:
+                if stream is not None:
+                    stream.close()
+            raise
+        return streams
+
     def put(self, link: FileLink, data: Data) -> bool:
         file_path = link.get_file_path()
         logging.debug(f"Put object {file_path}")
-        result = self.__write(file_path=file_path, data=data)
+        if self.__is_segment_link(link):
+            return self.__put_segment(file_path, data)
+        pool_path = self.__pool_path(link)
+        if pool_path is not None:
+            result = self.__put_pooled(pool_path, file_path, data)
+        else:
+            result = self.__write(file_path=file_path, data=data)
         if result:
             logging.debug(f"{file_path} put successfully")
+            self.__index_add(link)
             return True
         logging.error(f"File put fail ({file_path})")
         return False
 
+    def put_many(self, items: list[tuple[FileLink, Data]]) -> list[bool]:
+        """
+        Put the links grouped by directory: one directory check, one directory handle and one directory sync
+        per directory. The metadata segment and object pool links are put one by one, in order.
+        """
+        if not FileStorage.__supports_dir_fd():
+            return super().put_many(items)
+        results = [False] * len(items)
+        run: list[int] = []
+        for i, (link, data) in enumerate(items):
+            if self.__is_segment_link(link) or self.__pool_path(link) is not None:
+                self.__put_run(items, run, results)
+                run = []
+                results[i] = self.put(link, data)
+            else:
+                run.append(i)
+        self.__put_run(items, run, results)
+        return results
+
+    def __put_run(
+        self,
+        items: list[tuple[FileLink, Data]],
+        indexes: list[int],
+        results: list[bool],
+    ):
+        links = [link for link, _ in items]
+        for path, group in FileStorage.__group_by_dir(links, indexes).items():
+            for i in self.__put_group(path, [(i, items[i]) for i, _ in group]):
+                results[i] = True
+
+    def __put_group(
+        self, path: str, group: list[tuple[int, tuple[FileLink, Data]]]
+    ) -> list[int]:
+        """Write the links of one directory relative to the directory handle, return the indexes of the written items"""
+        sync_dirs = [path]
+        if not self.__make_dir(path, sync_dirs):
+            return []
+        try:
+            try:
+                dir_fd = os.open(path, FileStorage.__dir_open_flags)
+            except FileNotFoundError:
+                # the known directory is removed meanwhile
+                with self.__known_dirs_lock:
+                    self.__known_dirs.discard(path)
+                if not self.__make_dir(path, sync_dirs):
+                    return []
+                dir_fd = os.open(path, FileStorage.__dir_open_flags)
+        except BaseException as e:
+            logging.exception(f"Directory open fail {path}: {e}")
+            return []
+        written: list[tuple[int, FileLink]] = []
+        try:
+            for i, (link, data) in group:
+                file_name = os.path.basename(link.get_file_path())
+                file_name_tmp = f"{file_name}.tmp"
+                logging.debug(f"Put object {link.get_file_path()}")
+                try:
+                    fd = os.open(
+                        file_name_tmp,
+                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                        0o666,
+                        dir_fd=dir_fd,
+                    )
+                    try:
+                        f = open(fd, "wb")
+                    except BaseException:
+                        os.close(fd)
+                        raise
+                    with f:
+                        FileStorage.__write_data(f, data)
+                        if self.durability == FileStorage.durability_file:
+                            f.flush()
+                            os.fsync(f.fileno())
+                    # rename replaces the destination on POSIX (the only platforms with dir_fd)
+                    os.rename(
+                        file_name_tmp, file_name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd
+                    )
+                except BaseException as e:
+                    logging.exception(f"File put fail ({link.get_file_path()}): {e}")
+                    try:
+                        os.unlink(file_name_tmp, dir_fd=dir_fd)
+                    except OSError:
+                        pass
+                    continue
+                written.append((i, link))
+        finally:
+            os.close(dir_fd)
+        # the renamed files are stored, a sync failure is reported by flush()
+        self.__index_add_many([link for _, link in written])
+        if self.durability == FileStorage.durability_file:
+            self.__sync(None, sync_dirs)
+        else:
+            self.__sync_written(
+                [link.get_file_path() for _, link in written], sync_dirs
+            )
+        return [i for i, _ in written]
+
+    def __is_segment_link(self, link: FileLink) -> bool:
+        """The link is written into a metadata segment"""
+        if not self.metadata_segments or not link.is_metadata() or link.is_special_id():
+            return False
+        path, file_name = os.path.split(link.get_file_path())
+        return self.segments.location_of(
+            path
+        ) is not None and MetadataSegments.is_valid_name(file_name)
+
+    def __in_segment(self, link: FileLink) -> bool:
+        """The link is stored in a metadata segment"""
+        return (
+            link.is_metadata()
+            and self.segments.get(*os.path.split(link.get_file_path())) is not None
+        )
+
+    def __put_segment(self, file_path: str, data: Data) -> bool:
+        path, file_name = os.path.split(file_path)
+        year_path = os.path.dirname(path)
+        sync_dirs = [year_path]
+        if not self.__make_dir(year_path, sync_dirs):
+            return False
+        try:
+            if isinstance(data, str):
+                data = bytes(data, "utf-8")
+            elif callable(data):
+                stream = io.BytesIO()
+                data(stream)
+                data = stream.getvalue()
+            elif hasattr(data, "read"):
+                with data:
+                    data = data.read()
+            elif not isinstance(data, bytes):
+                raise NotImplementedError(f"Not supported data type: {type(data)}")
+            written = self.segments.put(path, file_name, data)
+        except BaseException as e:
+            logging.exception(f"Metadata segment put fail {file_path}: {e}")
+            return False
+        # the segment files are created in the year directory
+        self.__index_touch_dir(year_path)
+        logging.debug(f"{file_path} put into metadata segment successfully")
+        return self.__sync_written(written, sync_dirs)
+
+    def __sync_written(self, written: list[str], sync_dirs: list[str]) -> bool:
+        ok = True
+        for i, file_path in enumerate(written):
+            ok = self.__sync(file_path, sync_dirs if i == 0 else []) and ok
+        return ok
+
+    def __pool_path(self, link: FileLink) -> str | None:
+        """Path of the link data in the object pool, None if the link is not pooled"""
+        if self.object_pool is None or link.is_special_id():
+            return None
+        ch = link.get_property(LinkInterface.property_content_hash)
+        if ch is None or FileStorage.__pool_key_pattern.match(ch) is None:
+            return None
+        if (
+            content_hash.algorithm_of(ch)
+            not in FileStorage.pool_content_hash_algorithms
+        ):
+            # e.g. md5 of an older backup
+            return None
+        name = ch
+        if link.get_extension() is not None:
+            name += f".{link.get_extension()}"
+        return os.path.join(self.object_pool, ch[-2:], name)
+
+    def has_content(self, link: FileLink) -> bool:
+        pool_path = self.__pool_path(link)
+        return pool_path is not None and os.path.exists(pool_path)
+
+    def shares_content(self) -> bool:
+        return self.object_pool is not None
+
+    def __put_pooled(self, pool_path: str, file_path: str, data: Data) -> bool:
+        if self.__link_from_pool(pool_path, file_path):
+            # the content is already stored (e.g. by another account), the data is not written
+            logging.debug(f"{file_path} linked from object pool")
+            return True
+        # unique temporary file, the same content can be written by other processes
+        pool_path_tmp = f"{pool_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        if not self.__write(pool_path, data, file_path_tmp=pool_path_tmp):
+            return False
+        if self.__link_from_pool(pool_path, file_path):
+            return True
+        logging.debug(f"Hardlink to object pool is not supported, copy {file_path}")
+        try:
+            return self.__write(file_path, open(pool_path, "rb"))
+        except BaseException as e:
+            logging.exception(f"Copy from object pool fail {pool_path}: {e}")
+            return False
+
+    def __link_from_pool(self, pool_path: str, file_path: str) -> bool:
+        path = os.path.dirname(file_path)
+        sync_dirs = [path]
+        if not self.__make_dir(path, sync_dirs):
+            return False
+        file_path_tmp = f"{file_path}.tmp"
+        try:
+            FileStorage.__remove(file_path_tmp)
+            os.link(pool_path, file_path_tmp)
+            os.replace(file_path_tmp, file_path)
+        except OSError as e:
+            # e.g. not in the pool yet, or removed by the pool gc meanwhile
+            logging.log(global_properties.log_finest, f"Link from pool fail: {e}")
+            return False
+        finally:
+            FileStorage.__remove(file_path_tmp)
+        self.__sync(None, sync_dirs)
+        return True
+
+    def gc_object_pool(self, grace_period: float = temporary_file_grace_period) -> int:
+        """
+        Remove the pool objects without links (the hardlink count is the reference count)
+        and the leftover temporary files.
+        :param grace_period: only the files not modified in the last grace_period seconds are removed
+        :return: number of the removed files
+        """
+        if self.object_pool is None:
+            return 0
+        scanner = DirectoryScanner(
+            self.object_pool,
+            lambda path, filenames: [os.path.join(path, f) for f in filenames],
+            workers=self.scan_workers,
+        )
+        count = 0
+        for _, file_paths in scanner.iter_scan():
+            for file_path in file_paths:
+                try:
+                    st = os.stat(file_path)
+                    if time.time() - st.st_mtime < grace_period:
+                        continue
+                    if st.st_nlink > 1 and not file_path.endswith(".tmp"):
+                        continue
+                    os.remove(file_path)
+                    count += 1
+                except FileNotFoundError:
+                    pass
+                except BaseException as e:
+                    logging.exception(f"Object pool file remove fail {file_path}: {e}")
+        if count > 0:
+            logging.info(f"Removed object pool files: {count}")
+        return count
+
     def remove(self, link: FileLink, as_new_mutation: bool = True) -> bool:
         if not as_new_mutation:
             try:
+                if self.__in_segment(link):
+                    written = self.segments.remove(*os.path.split(link.get_file_path()))
+                    self.__sync_written(written, [])
+                    return True
                 if os.path.exists(link.get_file_path()):
                     os.remove(link.get_file_path())
+                    self.__sync(None, [os.path.dirname(link.get_file_path())])
+                self.__index_remove(link)
                 return True
             except BaseException as e:
                 logging.exception(f"Delete fail {link.get_file_path()} with error: {e}")
                 return False
 
-        dst = copy.deepcopy(link).fill(
+        dst = link.clone().fill(
             {
                 "deleted": True,
                 "mutation": self.__gen_mutation(),
             }
         )
+        if (
+            self.tombstone_mode != FileStorage.tombstone_mode_copy
+            and not self.__in_segment(link)
+        ):
+            if self.__link_file(link.get_file_path(), dst.get_file_path()):
+                logging.debug(f"{dst.get_file_path()} linked successfully")
+                self.__sync(None, [os.path.dirname(dst.get_file_path())])
+                self.__index_add(dst)
+                return True
         try:
             with self.get(link) as f:
                 return self.put(dst, f)
@@ -259,39 +797,417 @@ class FileStorage(StorageInterface):
             )
             return False
 
+    def remove_many(
+        self, links: list[FileLink], as_new_mutation: bool = True
+    ) -> list[bool]:
+        """
+        Remove the links with one directory sync per directory.
+        The deleted mutations are linked (see tombstone_mode) or copied by put_many().
+        """
+        if not FileStorage.__supports_dir_fd():
+            return super().remove_many(links, as_new_mutation)
+        if not as_new_mutation:
+            return self.__unlink_many(links)
+        results = [False] * len(links)
+        linked: list[FileLink] = []
+        copies: list[int] = []
+        copy_items: list[tuple[FileLink, Data]] = []
+        for i, link in enumerate(links):
+            dst = link.clone().fill(
+                {
+                    "deleted": True,
+                    "mutation": self.__gen_mutation(),
+                }
+            )
+            if (
+                self.tombstone_mode != FileStorage.tombstone_mode_copy
+                and not self.__in_segment(link)
+                and self.__link_file(link.get_file_path(), dst.get_file_path())
+            ):
+                logging.debug(f"{dst.get_file_path()} linked successfully")
+                linked.append(dst)
+                results[i] = True
+                continue
+            copies.append(i)
+            copy_items.append((dst, self.__copy_writer(link)))
+        if len(linked) > 0:
+            self.__sync(
+                None, list({os.path.dirname(l.get_file_path()): None for l in linked})
+            )
+            self.__index_add_many(linked)
+        for i, result in zip(copies, self.put_many(copy_items)):
+            results[i] = result
+        return results
+
+    def __copy_writer(self, link: FileLink) -> DataCall:
+        def write(f: IO[bytes]):
+            with self.get(link) as src:
+                FileStorage.copy_stream(src, f)
+
+        return write
+
+    def __unlink_many(self, links: list[FileLink]) -> list[bool]:
+        results = [False] * len(links)
+        files: list[int] = []
+        for i, link in enumerate(links):
+            if self.__in_segment(link):
+                results[i] = self.remove(link, as_new_mutation=False)
+            else:
+                files.append(i)
+        for path, group in FileStorage.__group_by_dir(links, files).items():
+            removed: list[int] = []
+            unlinked = False
+            try:
+                dir_fd = os.open(path, FileStorage.__dir_open_flags)
+            except FileNotFoundError:
+                # nothing to remove
+                dir_fd = None
+            except BaseException as e:
+                logging.exception(f"Directory open fail {path}: {e}")
+                continue
+            try:
+                for i, file_name in group:
+                    if dir_fd is not None:
+                        try:
+                            os.unlink(file_name, dir_fd=dir_fd)
+                            unlinked = True
+                        except FileNotFoundError:
+                            pass
+                        except BaseException as e:
+                            logging.exception(
+                                f"Delete fail {links[i].get_file_path()} with error: {e}"
+                            )
+                            continue
+                    removed.append(i)
+            finally:
+                if dir_fd is not None:
+                    os.close(dir_fd)
+            if unlinked:
+                self.__sync(None, [path])
+            self.__index_remove_many([links[i] for i in removed])
+            for i in removed:
+                results[i] = True
+        return results
+
+    @staticmethod
+    def __group_by_dir(
+        links: list[FileLink], indexes: Iterable[int]
+    ) -> dict[str, list[tuple[int, str]]]:
+        """Indexes and file names of the links by directory, in the given order"""
+        groups: dict[str, list[tuple[int, str]]] = {}
+        for i in indexes:
+            path, file_name = os.path.split(links[i].get_file_path())
+            groups.setdefault(path, []).append((i, file_name))
+        return groups
+
+    @staticmethod
+    def __supports_dir_fd() -> bool:
+        return (
+            os.open in os.supports_dir_fd
+            and os.rename in os.supports_dir_fd
+            and os.unlink in os.supports_dir_fd
+        )
+
+    def __link_file(self, src: str, dst: str) -> bool:
+        """Create the destination as a hardlink or a reflink of the source. Return False if it is not supported."""
+        try:
+            if self.tombstone_mode == FileStorage.tombstone_mode_hardlink:
+                os.link(src, dst)
+                return True
+            dst_tmp = f"{dst}.tmp"
+            try:
+                with open(src, "rb") as fs, open(dst_tmp, "wb") as fd:
+                    import fcntl
+
+                    fcntl.ioctl(fd.fileno(), FileStorage.__ioctl_ficlone, fs.fileno())
+                os.replace(dst_tmp, dst)
+                return True
+            finally:
+                FileStorage.__remove(dst_tmp)
+        except (OSError, ImportError) as e:
+            # e.g. cross-device link, not supported by the filesystem or the platform
+            logging.debug(f"Link as new mutation is failed {src} -> {dst}: {e}")
+            return False
+
     def find(self, f: LinkFilter | None = None) -> LinkList[FileLink]:
-        abspath = self.root
-        skip_path = len(abspath)
-        result: LinkList[FileLink] = LinkList([])
-        for _path, _, filenames in os.walk(abspath):
-            for file in filenames:
-                file_path = os.path.join(_path, file)
-                relpath = _path[skip_path:]
-                link = FileLink()
-                if len(relpath) > 0:
-                    link.path = relpath
-                m = FileLink.parse_file_name(file)
-                if m is None:
-                    continue
-                m["path"] = _path
-                link.fill(m)
+        return LinkList(self.iter_find(f))
+
+    def iter_find(self, f: LinkFilter | None = None) -> Iterator[FileLink]:
+        for link in self.__iter_all():
+            if f is None or f(link):
+                yield link
+
+    def get_versions(self, object_id: str) -> LinkList[FileLink]:
+        """
+        All links of one object ID from its shard of the link index and from the metadata segment indexes,
+        without walking the directory tree. If the index is not ready or inconsistent (see FileLinkIndex.load_shard_checked()),
+        then the storage is scanned (and the index is rebuilt).
+        """
+        relpaths = None
+        if self.index is not None and self.index.is_ready():
+            relpaths = self.index.load_shard_checked(FileLinkIndex.shard_of(object_id))
+        prefix = FileLink.escape(object_id)
+        if relpaths is None or not self.__root_files_indexed(prefix, relpaths):
+            return super().get_versions(object_id)
+        links: LinkList[FileLink] = LinkList()
+        for link in self.__links_from_relpaths(
+            [
+                relpath
+                for relpath in relpaths
+                if FileStorage.__has_id_prefix(relpath.rpartition("/")[2], prefix)
+            ]
+        ):
+            # the records of the files removed from outside are skipped
+            if link.id() == object_id and os.path.exists(link.get_file_path()):
+                links.append(link)
+        for path, file_name in self.segments.records_of(prefix):
+            m = FileLink.parse_file_name(file_name)
+            if m is None or m["object_id"] != object_id:
+                continue
+            m["path"] = path
+            links.append(FileLink().fill(m))
+        links.sort(key=lambda link: link.mutation())
+        return links
+
+    def __root_files_indexed(self, escaped_id: str, relpaths: list[str]) -> bool:
+        """The link files of the object ID in the root are in the index (the root is not checked by the index)"""
+        indexed = set(relpaths)
+        try:
+            with os.scandir(self.root) as it:
+                for entry in it:
+                    if (
+                        FileStorage.__has_id_prefix(entry.name, escaped_id)
+                        and FileStorage.__is_link_file_name(entry.name)
+                        and entry.name not in indexed
+                    ):
+                        logging.warning(f"Link index not contains file ({entry.name})")
+                        return False
+        except FileNotFoundError:
+            pass
+        return True
+
+    @staticmethod
+    def __has_id_prefix(file_name: str, escaped_id: str) -> bool:
+        """The file name is of the object ID (the escaped ID has no dot)"""
+        return file_name == escaped_id or file_name.startswith(f"{escaped_id}.")
+
+    def __iter_all(self) -> Iterator[FileLink]:
+        """Stream all links of the files and the metadata segments"""
+        yield from self.__iter_files()
+        for path, file_name in self.segments.iter_records():
+            m = FileLink.parse_file_name(file_name)
+            if m is None:
+                continue
+            m["path"] = path
+            yield FileLink().fill(m)
+
+    def __iter_files(self) -> Iterator[FileLink]:
+        """Stream the links of the files from the index, or scan the directory tree and rebuild the index"""
+        if self.index is not None:
+            relpaths = self.index.load()
+            if relpaths is not None:
+                logging.debug(f"Links loaded from index ({len(relpaths)})")
+                yield from self.__links_from_relpaths(relpaths)
+                return
+            logging.info("Link index is missing or inconsistent, scanning storage...")
+        index_items: list[tuple[str, str]] = []
+        dirs: list[str] = []
+        for link in self.__scan(dirs):
+            if self.index is not None:
+                relpath = self.__relpath(link)
+                if relpath is not None:
+                    index_items.append((link.id(), relpath))
+            yield link
+        if self.index is not None and os.path.isdir(self.root):
+            try:
+                self.index.rebuild(index_items, dirs)
+            except BaseException as e:
+                logging.exception(f"Link index rebuild fail: {e}")
+                self.index.invalidate()
+
+    def __links_from_relpaths(self, relpaths: list[str]) -> Iterator[FileLink]:
+        paths: dict[str, str] = {}
+        for relpath in relpaths:
+            reldir, _, file = relpath.rpartition("/")
+            m = FileLink.parse_file_name(file)
+            if m is None:
+                continue
+            if reldir not in paths:
+                paths[reldir] = (
+                    os.path.join(self.root, *reldir.split("/"))
+                    if reldir != ""
+                    else self.root
+                )
+            m["path"] = paths[reldir]
+            yield FileLink().fill(m)
+        self.__add_known_dirs(paths.values())
 
-                if m["extension"] == "tmp":
+    def __scan(self, dirs: list[str]) -> Iterator[FileLink]:
+        """Scan the directory tree, stream the links and collect the relative directories into dirs"""
+        skip_path = len(self.root)
+        scanner = DirectoryScanner(
+            self.root,
+            FileStorage.__parse_dir,
+            workers=self.scan_workers,
+            skip_dirs=[FileLinkIndex.directory_name],
+        )
+        for _path, links in scanner.iter_scan():
+            self.__add_known_dirs([_path])
+            relpath = _path[skip_path:]
+            if len(relpath) > 0:
+                dirs.append(relpath.strip(os.sep).replace(os.sep, "/"))
+            yield from links
+
+    @staticmethod
+    def __parse_dir(path: str, filenames: list[str]) -> list[FileLink]:
+        """Parse the file names of a directory, the temporary files are skipped"""
+        links: list[FileLink] = []
+        for file in filenames:
+            m = FileLink.parse_file_name(file)
+            if m is None or m["extension"] == "tmp":
+                continue
+            m["path"] = path
+            links.append(FileLink().fill(m))
+        return links
+
+    @staticmethod
+    def __parse_dir_tmp_files(path: str, filenames: list[str]) -> list[str]:
+        return [
+            os.path.join(path, file)
+            for file in filenames
+            if file.endswith(".tmp") and FileLink.parse_file_name(file) is not None
+        ]
+
+    def sweep_temporary_files(
+        self, grace_period: float = temporary_file_grace_period
+    ) -> int:
+        """
+        Remove the leftover temporary files of interrupted writes.
+        :param grace_period: only the files not modified in the last grace_period seconds are removed, so the in-progress writes (also of other processes) are kept
+        :return: number of the removed files
+        """
+        scanner = DirectoryScanner(
+            self.root,
+            FileStorage.__parse_dir_tmp_files,
+            workers=self.scan_workers,
+            skip_dirs=[FileLinkIndex.directory_name],
+        )
+        count = 0
+        for _, tmp_files in scanner.iter_scan():
+            for file_path in tmp_files:
+                try:
+                    if time.time() - os.path.getmtime(file_path) < grace_period:
+                        continue
                     logging.debug(f"Temporary file {file_path}, remove it")
-                    try:
-                        os.remove(file_path)
-                    except BaseException as e:
-                        logging.exception(
-                            f"Temporary file remove fail {file_path}: {e}"
-                        )
-                    continue
+                    os.remove(file_path)
+                    self.__index_touch_dir(os.path.dirname(file_path))
+                    count += 1
+                except FileNotFoundError:
+                    # renamed or removed by its writer meanwhile
+                    pass
+                except BaseException as e:
+                    logging.exception(f"Temporary file remove fail {file_path}: {e}")
+        if count > 0:
+            logging.info(f"Removed temporary files: {count}")
+        return count
 
-                if f is None or f(link):
-                    result.append(link)
-        return result
+    def start_sweeper(
+        self, grace_period: float = temporary_file_grace_period
+    ) -> threading.Thread:
+        """Run sweep_temporary_files() and gc_object_pool() once in a background thread"""
+
+        def sweep():
+            self.sweep_temporary_files(grace_period)
+            self.gc_object_pool(grace_period)
+
+        thread = threading.Thread(
+            target=sweep,
+            name="FileStorageSweeper",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    @staticmethod
+    def __is_link_file_name(filename: str) -> bool:
+        m = FileLink.parse_file_name(filename)
+        return m is not None and m["extension"] != "tmp"
+
+    def __relpath(self, link: FileLink) -> str | None:
+        relpath = os.path.relpath(link.get_file_path(), self.root)
+        if relpath.startswith(".."):
+            return None
+        return relpath.replace(os.sep, "/")
+
+    def __index_add(self, link: FileLink):
+        if self.index is None:
+            return
+        relpath = self.__relpath(link)
+        if relpath is not None:
+            self.index.add(link.id(), relpath)
+
+    def __index_add_many(self, links: list[FileLink]):
+        if self.index is None:
+            return
+        self.index.add_many(
+            [
+                (link.id(), relpath)
+                for link, relpath in ((l, self.__relpath(l)) for l in links)
+                if relpath is not None
+            ]
+        )
+
+    def __index_remove_many(self, links: list[FileLink]):
+        if self.index is None:
+            return
+        self.index.remove_many(
+            [
+                (link.id(), relpath)
+                for link, relpath in ((l, self.__relpath(l)) for l in links)
+                if relpath is not None
+            ]
+        )
+
+    def __reldir(self, path: str) -> str | None:
+        """Directory relative to the root, None if it is the root or not under the root"""
+        relpath = os.path.relpath(path, self.root)
+        if relpath == "." or relpath.startswith(".."):
+            return None
+        return relpath.replace(os.sep, "/")
+
+    def __index_add_dir(self, path: str):
+        if self.index is None:
+            return
+        relpath = self.__reldir(path)
+        if relpath is not None:
+            self.index.add_dirs([relpath])
+
+    def __index_touch_dir(self, path: str):
+        if self.index is None:
+            return
+        relpath = self.__reldir(path)
+        if relpath is not None:
+            self.index.touch_dirs([relpath])
+
+    def __index_remove(self, link: FileLink):
+        if self.index is None:
+            return
+        relpath = self.__relpath(link)
+        if relpath is not None:
+            self.index.remove(link.id(), relpath)
+
+    def rebuild_index(self):
+        """Drop the link index, and rebuild it by scanning the directory tree"""
+        if self.index is None:
+            return
+        self.index.invalidate()
+        for _ in self.__iter_files():
+            pass
 
     def modify(self, link: FileLink, to_link: FileLink) -> bool:
-        if os.path.exists(to_link.get_file_path()):
+        if self.__in_segment(link):
+            return self.__modify_segment(link, to_link)
+        if os.path.exists(to_link.get_file_path()) or self.__in_segment(to_link):
             logging.error(
                 f"Modify fail ({link.get_file_path()}): destination link already exists ({to_link.get_file_path()})"
             )
@@ -303,15 +1219,100 @@ class FileStorage(StorageInterface):
                 f"File move fail: {e} ({link.get_file_path()} -> {to_link.get_file_path()})"
             )
             return False
+        self.__sync(
+            None,
+            list(
+                {
+                    os.path.dirname(link.get_file_path()): None,
+                    os.path.dirname(to_link.get_file_path()): None,
+                }.keys()
+            ),
+        )
+        self.__index_remove(link)
+        self.__index_add(to_link)
         return True
 
+    def __modify_segment(self, link: FileLink, to_link: FileLink) -> bool:
+        path, file_name = os.path.split(link.get_file_path())
+        to_path, to_file_name = os.path.split(to_link.get_file_path())
+        if self.__in_segment(to_link) or os.path.exists(to_link.get_file_path()):
+            logging.error(
+                f"Modify fail ({link.get_file_path()}): destination link already exists ({to_link.get_file_path()})"
+            )
+            return False
+        if path == to_path and self.__is_segment_link(to_link):
+            try:
+                written = self.segments.rename(path, file_name, to_file_name)
+            except BaseException as e:
+                logging.exception(
+                    f"Metadata segment rename fail: {e} ({link.get_file_path()} -> {to_link.get_file_path()})"
+                )
+                return False
+            return self.__sync_written(written, [])
+        # e.g. another day directory, copy it and drop the old record
+        try:
+            data = self.segments.read(path, file_name)
+        except BaseException as e:
+            logging.exception(f"Metadata segment read fail {link.get_file_path()}: {e}")
+            return False
+        if not self.put(to_link, data):
+            return False
+        return self.remove(link, as_new_mutation=False)
+
+    def flush(self) -> bool:
+        """
+        Wait for the pending syncs, and record the state of the changed directories in the link index.
+        Return False if any sync failed since the last flush.
+        """
+        result = True
+        if self.__syncer is not None:
+            result = self.__syncer.flush()
+        with self.__sync_failed_lock:
+            if self.__sync_failed:
+                result = False
+            self.__sync_failed = False
+        if self.index is not None:
+            self.index.save_dirs()
+        return result
+
+    def reclaim(self) -> bool:
+        """Rewrite the metadata segments with removed records"""
+        try:
+            year_paths = self.segments.compact()
+        except BaseException as e:
+            logging.exception(f"Metadata segment compaction fail: {e}")
+            return False
+        for year_path in year_paths:
+            self.__index_touch_dir(year_path)
+        return self.__sync(None, year_paths)
+
+    def __sync(self, file_path: str | None, dir_paths: list[str]) -> bool:
+        """Sync a written file and the changed directories by the durability policy"""
+        if self.durability == FileStorage.durability_none:
+            return True
+        if self.__syncer is not None:
+            self.__syncer.add(file_path, dir_paths)
+            return True
+        ok = True
+        if file_path is not None:
+            ok = FileSyncer.fsync_file(file_path)
+        for dir_path in dir_paths:
+            ok = FileSyncer.fsync_dir(dir_path) and ok
+        if not ok:
+            logging.error(f"Sync fail ({file_path}, {dir_paths})")
+            with self.__sync_failed_lock:
+                self.__sync_failed = True
+        return ok
+
     def content_hash_add(self, link: FileLink) -> FileLink:
         try:
             with self.get(link) as f:
-                content_hash = self.content_hash_generate(f)
+                link_content_hash = self.content_hash_generate(f)
 
-            to_link = copy.deepcopy(link)
-            to_link.set_properties({LinkInterface.property_content_hash: content_hash})
+            to_link = link.clone()
+            to_link.set_properties(
+                {LinkInterface.property_content_hash: link_content_hash}
+            )
             if self.modify(link, to_link):
                 return to_link
             raise RuntimeError(f"Link hashing failed ({link.get_file_path()})")
@@ -332,21 +1333,12 @@ class FileStorage(StorageInterface):
     def content_hash_eq(self, link: FileLink, data: IO[bytes] | bytes | str) -> bool:
         if not link.has_property(LinkInterface.property_content_hash):
             return False
-        return self.content_hash_generate(data) == link.get_property(
-            LinkInterface.property_content_hash
+        return content_hash.eq(
+            link.get_property(LinkInterface.property_content_hash), data
         )
 
     def content_hash_generate(self, b: IO[bytes] | bytes | str) -> str:
-        if isinstance(b, bytes):
-            data = b
-        elif isinstance(b, str):
-            data = bytes(b, "utf-8")
-        elif isinstance(b, io.BufferedReader):
-            data = b.read()
-        else:
-            raise NotImplementedError(f"Invalid type: {type(b)}")
-
-        return "m" + hashlib.md5(data).hexdigest().lower()
+        return content_hash.generate(b, self.content_hash_algorithm)
 
     @staticmethod
     def __remove(file_path: str) -> bool:
@@ -366,37 +1358,135 @@ class FileStorage(StorageInterface):
         return True
 
     @staticmethod
-    def __write(file_path: str, data: Data) -> bool:
-        path = os.path.dirname(file_path)
+    def copy_stream(src: IO[bytes], dst: IO[bytes]):
+        """
+        Copy the rest of the source stream to the destination stream without buffering it in memory.
+        If both sides are regular files, then the data is copied in kernel space (copy_file_range or sendfile).
+        """
+        src_fd = FileStorage.__regular_file_fd(src)
+        dst_fd = FileStorage.__regular_file_fd(dst)
+        if src_fd is not None and dst_fd is not None:
+            dst.flush()
+            offset = src.tell()
+            size = os.fstat(src_fd).st_size
+            for copy in FileStorage.__kernel_copy_functions():
+                try:
+                    while offset < size:
+                        copied = copy(src_fd, dst_fd, size - offset, offset)
+                        if copied == 0:
+                            break
+                        offset += copied
+                    break
+                except OSError as e:
+                    # e.g. not supported by the filesystem, try the next method from the copied offset
+                    logging.log(
+                        global_properties.log_finest,
+                        f"Kernel space copy fail, fallback: {e}",
+                    )
+            src.seek(offset)
+        shutil.copyfileobj(src, dst, content_hash.chunk_size)
+
+    @staticmethod
+    def __regular_file_fd(f: IO[bytes]) -> int | None:
+        if not isinstance(f, (io.BufferedReader, io.BufferedWriter, io.FileIO)):
+            return None
+        try:
+            fd = f.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                return fd
+        except (OSError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def __kernel_copy_functions() -> list[Callable[[int, int, int, int], int]]:
+        functions = []
+        if hasattr(os, "copy_file_range"):
+            functions.append(
+                lambda src_fd, dst_fd, count, offset: os.copy_file_range(
+                    src_fd, dst_fd, count, offset
+                )
+            )
+        if sys.platform.startswith("linux") and hasattr(os, "sendfile"):
+            # sendfile supports regular file destination only on Linux
+            functions.append(
+                lambda src_fd, dst_fd, count, offset: os.sendfile(
+                    dst_fd, src_fd, offset, count
+                )
+            )
+        return functions
+
+    def __add_known_dirs(self, paths: Iterable[str]):
+        with self.__known_dirs_lock:
+            self.__known_dirs.update(paths)
+
+    def __make_dir(self, path: str, sync_dirs: list[str]) -> bool:
+        """Create the directory if it is not known, the parents of the new directories are added to sync_dirs"""
+        with self.__known_dirs_lock:
+            if path in self.__known_dirs:
+                return True
         try:
             path_exists = os.path.exists(path)
             if not path_exists:
+                # the parents of the new directories are changed too
+                d = path
+                while not os.path.isdir(d) and os.path.dirname(d) != d:
+                    d = os.path.dirname(d)
+                    sync_dirs.append(d)
                 try:
                     os.makedirs(path, exist_ok=True)
                 except BaseException as e:
                     logging.exception(f"Directory create fail {path}: {e}")
                     return False
+                self.__index_add_dir(path)
         except BaseException as e:
             logging.exception(f"Directory exists check fail {path}: {e}")
             return False
+        self.__add_known_dirs([path])
+        return True
 
-        file_path_tmp = f"{file_path}.tmp"
+    @staticmethod
+    def __write_data(f: IO[bytes], data: Data):
+        if isinstance(data, bytes):
+            f.write(data)
+        elif isinstance(data, str):
+            f.write(bytes(data, "utf-8"))
+        elif callable(data):
+            data(f)
+        elif hasattr(data, "read"):
+            try:
+                FileStorage.copy_stream(data, f)
+            finally:
+                data.close()
+        else:
+            raise NotImplementedError(f"Not supported data type: {type(data)}")
+
+    def __write(
+        self, file_path: str, data: Data, file_path_tmp: str | None = None
+    ) -> bool:
+        path = os.path.dirname(file_path)
+        sync_dirs = [path]
+        if not self.__make_dir(path, sync_dirs):
+            return False
+
+        if file_path_tmp is None:
+            file_path_tmp = f"{file_path}.tmp"
         try:
             try:
-                with open(file_path_tmp, "wb") as f:
-                    if isinstance(data, bytes):
-                        f.write(data)
-                    elif isinstance(data, str):
-                        f.write(bytes(data, "utf-8"))
-                    elif isinstance(data, io.BufferedReader):
-                        f.write(data.read())
-                        data.close()
-                    elif callable(data):
-                        data(f)
-                    else:
-                        raise NotImplementedError(
-                            f"Not supported data type: {type(data)}"
-                        )
+                try:
+                    f = open(file_path_tmp, "wb")
+                except FileNotFoundError:
+                    # the known directory is removed meanwhile
+                    with self.__known_dirs_lock:
+                        self.__known_dirs.discard(path)
+                    if not self.__make_dir(path, sync_dirs):
+                        return False
+                    f = open(file_path_tmp, "wb")
+                with f:
+                    FileStorage.__write_data(f, data)
+                    if self.durability == FileStorage.durability_file:
+                        f.flush()
+                        os.fsync(f.fileno())
             except BaseException as e:
                 logging.exception(f"Temporary file writing fail {file_path_tmp}: {e}")
                 return False
@@ -407,6 +1497,11 @@ class FileStorage(StorageInterface):
                     f"File rename fail {file_path_tmp} -> {file_path}: {e}"
                 )
                 return False
+            # the renamed file is stored, a sync failure is reported by flush()
+            if self.durability == FileStorage.durability_file:
+                self.__sync(None, sync_dirs)
+            else:
+                self.__sync(file_path, sync_dirs)
             return True
         finally:
             FileStorage.__remove(file_path_tmp)
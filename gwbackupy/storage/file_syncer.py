@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+
+
+class FileSyncer:
+    """
+    Group commit of file and directory fsyncs.
+    The written files and their parent directories are collected, and a background flusher
+    fsyncs them in one batch every max_pending writes or every interval_ms milliseconds.
+    After flush() returns, every file added before the call is durable.
+    """
+
+    def __init__(self, max_pending: int = 256, interval_ms: int = 100):
+        """
+        :param max_pending: number of pending files which wakes up the flusher before the interval
+        :param interval_ms: maximum delay of the fsync after a write
+        """
+        self.max_pending = max(1, max_pending)
+        self.interval_ms = max(1, interval_ms)
+        self.__cond = threading.Condition()
+        self.__sync_lock = threading.Lock()
+        self.__files: dict[str, None] = {}
+        self.__dirs: dict[str, None] = {}
+        self.__failed = False
+        self.__closed = False
+        self.__thread: threading.Thread | None = None
+
+    def add(self, file_path: str | None, dir_paths: list[str]):
+        """
+        Register a written file and the changed directories for the next batch.
+        :param file_path: path of the written file (None if only directory entries changed)
+        :param dir_paths: directories with new, renamed or removed entries
+        """
+        with self.__cond:
+            if file_path is not None:
+                self.__files[file_path] = None
+            for dir_path in dir_paths:
+                self.__dirs[dir_path] = None
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__closed = False
+                self.__thread = threading.Thread(
+                    target=self.__run, name="FileSyncer", daemon=True
+                )
+                self.__thread.start()
+            if len(self.__files) >= self.max_pending:
+                self.__cond.notify()
+
+    def flush(self) -> bool:
+        """Sync all pending files and directories in the caller thread. Return False if any fsync failed since the last flush."""
+        self.__sync_pending()
+        with self.__cond:
+            result = not self.__failed
+            self.__failed = False
+        return result
+
+    def close(self) -> bool:
+        """Flush and stop the background flusher"""
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify()
+            thread = self.__thread
+            self.__thread = None
+        if thread is not None:
+            thread.join()
+        return self.flush()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                if not self.__closed and len(self.__files) < self.max_pending:
+                    self.__cond.wait(self.interval_ms / 1000)
+                if self.__closed:
+                    return
+            self.__sync_pending()
+
+    def __sync_pending(self):
+        # the sync lock serializes the batches, so flush() waits for the in-flight batch
+        with self.__sync_lock:
+            with self.__cond:
+                files = list(self.__files.keys())
+                dirs = list(self.__dirs.keys())
+                self.__files = {}
+                self.__dirs = {}
+            if len(files) == 0 and len(dirs) == 0:
+                return
+            ok = True
+            for file_path in files:
+                ok = FileSyncer.fsync_file(file_path) and ok
+            # directories after the files, so the new entries point to synced data
+            for dir_path in dirs:
+                ok = FileSyncer.fsync_dir(dir_path) and ok
+            if not ok:
+                with self.__cond:
+                    self.__failed = True
+            logging.debug(f"Synced {len(files)} files and {len(dirs)} directories")
+
+    @staticmethod
+    def fsync_file(file_path: str) -> bool:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except FileNotFoundError:
+            # renamed or removed since the write, the new entry is synced by its directory
+            return True
+        except BaseException as e:
+            logging.exception(f"File open for sync fail {file_path}: {e}")
+            return False
+        try:
+            os.fsync(fd)
+            return True
+        except BaseException as e:
+            logging.exception(f"File sync fail {file_path}: {e}")
+            return False
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def fsync_dir(dir_path: str) -> bool:
+        if os.name == "nt":
+            # directories can not be opened for fsync on Windows, NTFS journals the metadata
+            return True
+        try:
+            fd = os.open(dir_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return True
+        except BaseException as e:
+            logging.exception(f"Directory open for sync fail {dir_path}: {e}")
+            return False
+        try:
+            os.fsync(fd)
+            return True
+        except BaseException as e:
+            logging.exception(f"Directory sync fail {dir_path}: {e}")
+            return False
+        finally:
+            os.close(fd)
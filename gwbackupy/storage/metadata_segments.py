@@ -0,0 +1,362 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Iterator
+
+# Segment structure v1, one segment per month in the year directory of the date-based layout
+# /<root>/<YYYY>
+#    - .metadata-<MM>.seg      append-only data of the metadata records
+#    - .metadata-<MM>.idx      append-only offset index of the segment
+#
+# Index records (one per line):
+#    +<MM-DD>/<link file name>\t<offset>\t<length>
+#    -<MM-DD>/<link file name>
+#
+# Compaction writes the live records into .metadata-<MM>.seg.tmp and .metadata-<MM>.idx.tmp,
+# then replaces the segment and the index. A left index tmp file without a segment tmp file
+# is a committed compaction, which is finished on the next load.
+
+
+class MetadataSegments:
+    """
+    Per-month append-only segments of small records (e.g. message metadata) instead of one file per record.
+    A record is addressed like a file: by its day directory and its link file name.
+    """
+
+    segment_pattern = re.compile(r"^\.metadata-(\d{2})\.idx$")
+    day_pattern = re.compile(r"^\d{2}-\d{2}$")
+    max_open_files = 64
+    """Maximum number of the cached read handles"""
+
+    def __init__(self, root: str):
+        """
+        :param root: root directory of the date-based layout
+        """
+        self.root = root
+        self.__lock = threading.RLock()
+        self.__indexes: dict[str, dict[str, tuple[int, int]]] = {}
+        self.__read_fds: OrderedDict[str, int] = OrderedDict()
+        # live records by the escaped object ID (file name prefix), built on the first lookup
+        self.__by_id: dict[str, set[tuple[str, str]]] | None = None
+
+    def location_of(self, dir_path: str) -> tuple[str, str, str] | None:
+        """Return (year directory, month, day) of a day directory, None if it is not in the date-based layout"""
+        day = os.path.basename(dir_path)
+        year_dir = os.path.dirname(dir_path)
+        if MetadataSegments.day_pattern.match(day) is None:
+            return None
+        if os.path.normpath(os.path.dirname(year_dir)) != os.path.normpath(self.root):
+            return None
+        return year_dir, day[:2], day
+
+    @staticmethod
+    def is_valid_name(file_name: str) -> bool:
+        return "\t" not in file_name and "\n" not in file_name and "\r" not in file_name
+
+    @staticmethod
+    def segment_path(year_dir: str, month: str) -> str:
+        return os.path.join(year_dir, f".metadata-{month}.seg")
+
+    @staticmethod
+    def index_path(year_dir: str, month: str) -> str:
+        return os.path.join(year_dir, f".metadata-{month}.idx")
+
+    def __index(self, year_dir: str, month: str) -> dict[str, tuple[int, int]]:
+        """Live records of a month by <day>/<file name>, loaded on the first use"""
+        index_path = MetadataSegments.index_path(year_dir, month)
+        index = self.__indexes.get(index_path)
+        if index is not None:
+            return index
+        MetadataSegments.__recover(index_path)
+        index = {}
+        complete_size = 0
+        try:
+            with open(index_path, "rb") as f:
+                for line in f:
+                    if line[-1:] != b"\n":
+                        # interrupted append, the data of the record is not referenced
+                        logging.warning(
+                            f"Incomplete metadata index record, truncated ({index_path})"
+                        )
+                        break
+                    complete_size += len(line)
+                    if not MetadataSegments.__load_record(index, line):
+                        logging.warning(
+                            f"Invalid metadata index record, skipped ({index_path}): {line!r}"
+                        )
+        except FileNotFoundError:
+            pass
+        if os.path.exists(index_path) and complete_size != os.path.getsize(index_path):
+            # the next append must start on a new line
+            with open(index_path, "r+b") as f:
+                f.truncate(complete_size)
+        self.__indexes[index_path] = index
+        if self.__by_id is not None:
+            for name in index.keys():
+                self.__by_id_add(year_dir, name)
+        return index
+
+    def __by_id_add(self, year_dir: str, name: str):
+        if self.__by_id is None:
+            return
+        key = name.split("/", 1)[1].split(".", 1)[0]
+        self.__by_id.setdefault(key, set()).add((year_dir, name))
+
+    def __by_id_remove(self, year_dir: str, name: str):
+        if self.__by_id is None:
+            return
+        key = name.split("/", 1)[1].split(".", 1)[0]
+        records = self.__by_id.get(key)
+        if records is None:
+            return
+        records.discard((year_dir, name))
+        if len(records) == 0:
+            del self.__by_id[key]
+
+    @staticmethod
+    def __recover(index_path: str):
+        """Finish or drop an interrupted compaction of a month"""
+        index_tmp = f"{index_path}.tmp"
+        if not os.path.exists(index_tmp):
+            return
+        segment_tmp = f"{index_path[:-len('.idx')]}.seg.tmp"
+        if os.path.exists(segment_tmp):
+            # the segment is not replaced yet, the old files are intact
+            logging.warning(f"Interrupted metadata compaction, dropped ({index_path})")
+            os.remove(index_tmp)
+            os.remove(segment_tmp)
+            return
+        logging.warning(f"Interrupted metadata compaction, finished ({index_path})")
+        os.replace(index_tmp, index_path)
+
+    @staticmethod
+    def __load_record(index: dict[str, tuple[int, int]], line: bytes) -> bool:
+        """Apply an index record, return False if it is invalid"""
+        try:
+            record = line[:-1].decode("utf-8")
+            if record[:1] == "+":
+                name, offset, length = record[1:].rsplit("\t", 2)
+                if "\t" in name:
+                    return False
+                index[name] = (int(offset), int(length))
+                return True
+            if record[:1] == "-" and len(record) > 1:
+                index.pop(record[1:], None)
+                return True
+        except ValueError:
+            pass
+        return False
+
+    def get(self, dir_path: str, file_name: str) -> tuple[int, int] | None:
+        """Offset and length of a record, None if it is not exists"""
+        location = self.location_of(dir_path)
+        if location is None:
+            return None
+        year_dir, month, day = location
+        with self.__lock:
+            return self.__index(year_dir, month).get(f"{day}/{file_name}")
+
+    def read(self, dir_path: str, file_name: str) -> bytes | None:
+        location = self.location_of(dir_path)
+        if location is None:
+            return None
+        year_dir, month, day = location
+        with self.__lock:
+            record = self.__index(year_dir, month).get(f"{day}/{file_name}")
+            if record is None:
+                return None
+            segment_path = MetadataSegments.segment_path(year_dir, month)
+            fd = self.__read_fds.get(segment_path)
+            if fd is None:
+                fd = os.open(segment_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                self.__read_fds[segment_path] = fd
+                if len(self.__read_fds) > MetadataSegments.max_open_files:
+                    os.close(self.__read_fds.popitem(last=False)[1])
+            else:
+                self.__read_fds.move_to_end(segment_path)
+            offset, length = record
+            if hasattr(os, "pread"):
+                return os.pread(fd, length, offset)
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def put(self, dir_path: str, file_name: str, data: bytes) -> list[str]:
+        """
+        Append a record, an existing record with the same name is replaced.
+        :return: the written files
+        """
+        year_dir, month, day = self.location_of(dir_path)
+        segment_path = MetadataSegments.segment_path(year_dir, month)
+        with self.__lock:
+            index = self.__index(year_dir, month)
+            with open(segment_path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+            name = f"{day}/{file_name}"
+            index_path = self.__append_index(
+                year_dir, month, f"+{name}\t{offset}\t{len(data)}\n"
+            )
+            index[name] = (offset, len(data))
+            self.__by_id_add(year_dir, name)
+        return [segment_path, index_path]
+
+    def remove(self, dir_path: str, file_name: str) -> list[str]:
+        year_dir, month, day = self.location_of(dir_path)
+        with self.__lock:
+            index = self.__index(year_dir, month)
+            name = f"{day}/{file_name}"
+            if name not in index:
+                return []
+            index_path = self.__append_index(year_dir, month, f"-{name}\n")
+            del index[name]
+            self.__by_id_remove(year_dir, name)
+        return [index_path]
+
+    def rename(self, dir_path: str, file_name: str, to_file_name: str) -> list[str]:
+        """Rename a record in the same day directory, the data is not copied"""
+        year_dir, month, day = self.location_of(dir_path)
+        with self.__lock:
+            index = self.__index(year_dir, month)
+            name = f"{day}/{file_name}"
+            to_name = f"{day}/{to_file_name}"
+            offset, length = index[name]
+            # one write, so the rename is atomic
+            index_path = self.__append_index(
+                year_dir, month, f"+{to_name}\t{offset}\t{length}\n-{name}\n"
+            )
+            index[to_name] = (offset, length)
+            del index[name]
+            self.__by_id_remove(year_dir, name)
+            self.__by_id_add(year_dir, to_name)
+        return [index_path]
+
+    def __append_index(self, year_dir: str, month: str, lines: str) -> str:
+        index_path = MetadataSegments.index_path(year_dir, month)
+        fd = os.open(index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode("utf-8"))
+        finally:
+            os.close(fd)
+        return index_path
+
+    def __iter_months(self) -> Iterator[tuple[str, str]]:
+        """Stream the (year directory, month) of every segment"""
+        try:
+            with os.scandir(self.root) as it:
+                year_dirs = [
+                    e.path for e in it if e.is_dir() and not e.name.startswith(".")
+                ]
+        except FileNotFoundError:
+            return
+        for year_dir in sorted(year_dirs):
+            with os.scandir(year_dir) as it:
+                months = []
+                for entry in it:
+                    m = MetadataSegments.segment_pattern.match(entry.name)
+                    if m is not None:
+                        months.append(m.group(1))
+            for month in sorted(months):
+                yield year_dir, month
+
+    def iter_records(self) -> Iterator[tuple[str, str]]:
+        """Stream the (day directory, file name) of every live record"""
+        for year_dir, month in self.__iter_months():
+            with self.__lock:
+                names = list(self.__index(year_dir, month).keys())
+            for name in names:
+                day, file_name = name.split("/", 1)
+                yield os.path.join(year_dir, day), file_name
+
+    def records_of(self, escaped_id: str) -> list[tuple[str, str]]:
+        """
+        The (day directory, file name) of the live records with the escaped object ID (the file name prefix before the first dot).
+        All month indexes are loaded on the first call, then the records are looked up from a map by the ID.
+        """
+        with self.__lock:
+            if self.__by_id is None:
+                self.__by_id = {}
+                for year_dir, month in self.__iter_months():
+                    for name in self.__index(year_dir, month).keys():
+                        self.__by_id_add(year_dir, name)
+            records = sorted(self.__by_id.get(escaped_id, ()))
+        result = []
+        for year_dir, name in records:
+            day, file_name = name.split("/", 1)
+            result.append((os.path.join(year_dir, day), file_name))
+        return result
+
+    def compact(self) -> list[str]:
+        """
+        Rewrite the segments of the months with removed or replaced records, so their space is reclaimed.
+        :return: the changed year directories
+        """
+        changed = []
+        for year_dir, month in list(self.__iter_months()):
+            with self.__lock:
+                if self.__compact_month(year_dir, month) and year_dir not in changed:
+                    changed.append(year_dir)
+        return changed
+
+    def __compact_month(self, year_dir: str, month: str) -> bool:
+        index = self.__index(year_dir, month)
+        segment_path = MetadataSegments.segment_path(year_dir, month)
+        index_path = MetadataSegments.index_path(year_dir, month)
+        records = sorted(index.items(), key=lambda item: item[1][0])
+        # without dead records the segment is dense, and the index has one line per record
+        segment_size = sum(length for _, (_, length) in records)
+        index_size = sum(
+            len(f"+{name}\t{offset}\t{length}\n".encode("utf-8"))
+            for name, (offset, length) in records
+        )
+        if segment_size == MetadataSegments.__size(
+            segment_path
+        ) and index_size == MetadataSegments.__size(index_path):
+            return False
+        fd = self.__read_fds.pop(segment_path, None)
+        if fd is not None:
+            os.close(fd)
+        segment_tmp = f"{segment_path}.tmp"
+        new_index = {}
+        lines = []
+        with open(segment_path, "rb") as src, open(segment_tmp, "wb") as dst:
+            for name, (offset, length) in records:
+                src.seek(offset)
+                data = src.read(length)
+                if len(data) != length:
+                    raise OSError(f"Metadata segment is truncated ({segment_path})")
+                new_index[name] = (dst.tell(), length)
+                lines.append(f"+{name}\t{dst.tell()}\t{length}\n")
+                dst.write(data)
+            dst.flush()
+            os.fsync(dst.fileno())
+        # the complete index tmp file is the commit point, see __recover()
+        index_tmp = f"{index_path}.tmp"
+        with open(index_tmp, "wb") as f:
+            f.write("".join(lines).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(segment_tmp, segment_path)
+        os.replace(index_tmp, index_path)
+        self.__indexes[index_path] = new_index
+        logging.debug(
+            f"Metadata segment compacted ({segment_path}), records: {len(records)}"
+        )
+        return True
+
+    @staticmethod
+    def __size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    def close(self):
+        """Close the cached read handles"""
+        with self.__lock:
+            for fd in self.__read_fds.values():
+                os.close(fd)
+            self.__read_fds.clear()
@@ -0,0 +1,608 @@
+from __future__ import annotations
+
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import IO, Iterator
+
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.file_syncer import FileSyncer
+from gwbackupy.storage.storage_interface import (
+    StorageInterface,
+    Data,
+    LinkFilter,
+    LinkInterface,
+    LinkList,
+)
+
+# Directory structure v1
+# /<root>
+#    - index.jsonl             append-only index, one record per line
+#    - <nnnnnn>.pack           append-only segments with the object data
+#
+# Index records:
+#    {"op": "+", "id": <object id>, "e": <extension>, "p": <properties>, "s": <segment>, "o": <offset>, "l": <length>}
+#    {"op": "-", "id": <object id>, "e": <extension>, "p": <properties>}
+# A link is identified by its object id, extension and properties (including the mutation),
+# so the new mutations, the tombstones and the modified links can point to the same data.
+
+
+class PackLink(LinkInterface):
+    __slots__ = ("__id", "__extension", "__properties", "segment", "offset", "length")
+
+    def __init__(self):
+        self.__id: str | None = None
+        self.__extension: str | None = None
+        self.__properties: dict[str, any] = {}
+        self.segment: int | None = None
+        """segment number of the data, None if the link is not stored"""
+        self.offset: int = 0
+        self.length: int = 0
+
+    def fill(self, values: dict[str, any]) -> PackLink:
+        if "object_id" in values:
+            self.__id = values["object_id"]
+        if "extension" in values:
+            self.__extension = sys.intern(values["extension"])
+        if "properties" in values:
+            self.__properties = {}
+            self.set_properties(values["properties"])
+        if "mutation" in values:
+            self.__properties[LinkInterface.property_mutation] = values["mutation"]
+        return self
+
+    def clone(self) -> PackLink:
+        link = PackLink.__new__(PackLink)
+        link.__id = self.__id
+        link.__extension = self.__extension
+        link.__properties = dict(self.__properties)
+        link.segment = self.segment
+        link.offset = self.offset
+        link.length = self.length
+        return link
+
+    def key(self) -> str:
+        """Identity of the link in the index"""
+        return "\0".join(
+            [
+                self.__id,
+                self.__extension,
+                json.dumps(self.__properties, sort_keys=True, separators=(",", ":")),
+            ]
+        )
+
+    def get_extension(self) -> str | None:
+        return self.__extension
+
+    def id(self) -> str:
+        return self.__id
+
+    def mutation(self) -> str:
+        return self.__properties.get(LinkInterface.property_mutation)
+
+    def get_properties(self) -> dict[str, any]:
+        return dict(self.__properties)
+
+    def get_property(self, name: str, default: any = None) -> any:
+        return self.__properties.get(name, default)
+
+    def has_property(self, name: str) -> bool:
+        return self.__properties.get(name) is not None
+
+    def set_properties(self, sets: dict[str, any], replace: bool = False) -> PackLink:
+        if replace:
+            self.__properties = {}
+        for name, value in sets.items():
+            if value is None or value is False:
+                self.__properties.pop(name, None)
+            else:
+                self.__properties[sys.intern(name)] = value
+        return self
+
+    def is_deleted(self) -> bool:
+        return self.has_property(LinkInterface.property_deleted)
+
+    def is_metadata(self) -> bool:
+        return self.has_property(LinkInterface.property_metadata)
+
+    def is_object(self) -> bool:
+        return self.has_property(LinkInterface.property_object)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__}#id:{self.id()},ext:{self.__extension},props:{self.__properties},segment:{self.segment}"
+
+    def __eq__(self, other):
+        if not isinstance(other, PackLink):
+            return False
+        return self.key() == other.key()
+
+
+class PackObjectReader(io.RawIOBase):
+    """Read-only stream of one object in a memory mapped segment, the data is copied only on read"""
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self.__view = view
+        self.__position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        n = min(len(b), len(self.__view) - self.__position)
+        if n <= 0:
+            return 0
+        b[:n] = self.__view[self.__position : self.__position + n]
+        self.__position += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.__position + offset
+        elif whence == io.SEEK_END:
+            position = len(self.__view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.__position = position
+        return position
+
+    def tell(self) -> int:
+        return self.__position
+
+    def close(self):
+        if not self.closed:
+            self.__view.release()
+        super().close()
+
+
+class PackStorage(StorageInterface):
+    """
+    Log-structured storage: the objects are appended into large segment files,
+    and an append-only index holds the links with the location of their data.
+    The storage supports one writer process, the index is kept in memory.
+    """
+
+    index_file_name = "index.jsonl"
+    segment_pattern = re.compile(r"^(\d{6})\.pack$")
+
+    def __init__(
+        self,
+        root: str,
+        segment_size: int = 256 * 1024 * 1024,
+        content_hash_algorithm: str = content_hash.default_algorithm,
+    ):
+        """
+        :param root: root directory of the storage
+        :param segment_size: a new segment is started when the current one reaches this size (bytes)
+        :param content_hash_algorithm: algorithm of the new content hashes, the existing ones are verified by their own algorithm
+        """
+        if content_hash_algorithm not in content_hash.content_hash_prefixes:
+            raise ValueError(
+                f"Not supported content hash algorithm: {content_hash_algorithm}"
+            )
+        self.root = root
+        self.segment_size = segment_size
+        self.content_hash_algorithm = content_hash_algorithm
+        self.__lock = threading.RLock()
+        self.__links: dict[str, PackLink] | None = None
+        self.__index_file: IO[bytes] | None = None
+        self.__segment: int | None = None
+        self.__segment_file: IO[bytes] | None = None
+        self.__maps: dict[int, mmap.mmap] = {}
+
+    def __index_path(self) -> str:
+        return os.path.join(self.root, PackStorage.index_file_name)
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self.root, f"{segment:06d}.pack")
+
+    def __segments(self) -> list[int]:
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        segments = []
+        for name in names:
+            m = PackStorage.segment_pattern.match(name)
+            if m is not None:
+                segments.append(int(m.group(1)))
+        return sorted(segments)
+
+    def __load(self) -> dict[str, PackLink]:
+        """Replay the index on the first use, the incomplete tail of an interrupted write is dropped"""
+        if self.__links is not None:
+            return self.__links
+        links: dict[str, PackLink] = {}
+        segment_sizes = {
+            s: os.path.getsize(self.__segment_path(s)) for s in self.__segments()
+        }
+        valid_size = 0
+        try:
+            with open(self.__index_path(), "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        logging.warning("Pack index has an incomplete record, dropped")
+                        break
+                    record = json.loads(line)
+                    link = PackLink().fill(
+                        {
+                            "object_id": record["id"],
+                            "extension": record["e"],
+                            "properties": record["p"],
+                        }
+                    )
+                    if record["op"] == "+":
+                        link.segment = record["s"]
+                        link.offset = record["o"]
+                        link.length = record["l"]
+                        if link.offset + link.length > segment_sizes.get(
+                            link.segment, -1
+                        ):
+                            logging.warning(
+                                f"Pack index record without data, dropped ({link})"
+                            )
+                            break
+                        links[link.key()] = link
+                    else:
+                        links.pop(link.key(), None)
+                    valid_size += len(line)
+        except FileNotFoundError:
+            pass
+        if os.path.exists(self.__index_path()) and valid_size != os.path.getsize(
+            self.__index_path()
+        ):
+            with open(self.__index_path(), "r+b") as f:
+                f.truncate(valid_size)
+        self.__links = links
+        logging.debug(f"Pack index loaded ({len(links)} links)")
+        return links
+
+    def new_link(
+        self,
+        object_id: str,
+        extension: str,
+        created_timestamp: int | float | None = None,
+    ) -> PackLink:
+        return PackLink().fill(
+            {
+                "object_id": object_id,
+                "extension": extension,
+                "mutation": PackStorage.__gen_mutation(),
+            }
+        )
+
+    @staticmethod
+    def __gen_mutation():
+        return str(int(datetime.now(tz=timezone.utc).timestamp() * 1000))
+
+    def get(self, link: PackLink) -> IO[bytes]:
+        with self.__lock:
+            stored = self.__load().get(link.key())
+            if stored is None:
+                raise FileNotFoundError(f"Link not found: {link}")
+            if stored.length == 0:
+                return io.BytesIO()
+            m = self.__maps.get(stored.segment)
+            if m is None or len(m) < stored.offset + stored.length:
+                # the segment is grown since the last mapping, the old mapping is released by its readers
+                with open(self.__segment_path(stored.segment), "rb") as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.__maps[stored.segment] = m
+            view = memoryview(m)[stored.offset : stored.offset + stored.length]
+        return io.BufferedReader(PackObjectReader(view))
+
+    def put(self, link: PackLink, data: Data) -> bool:
+        with self.__lock:
+            self.__load()
+            try:
+                f = self.__writable_segment()
+                offset = f.tell()
+            except BaseException as e:
+                logging.exception(f"Pack segment open fail: {e}")
+                return False
+            try:
+                if isinstance(data, bytes):
+                    f.write(data)
+                elif isinstance(data, str):
+                    f.write(bytes(data, "utf-8"))
+                elif callable(data):
+                    data(f)
+                elif hasattr(data, "read"):
+                    try:
+                        while True:
+                            chunk = data.read(content_hash.chunk_size)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                    finally:
+                        data.close()
+                else:
+                    raise NotImplementedError(f"Not supported data type: {type(data)}")
+                f.flush()
+            except BaseException as e:
+                logging.exception(f"Pack segment writing fail {link}: {e}")
+                self.__truncate_segment(offset)
+                return False
+            stored = link.clone()
+            stored.segment = self.__segment
+            stored.offset = offset
+            stored.length = f.tell() - offset
+            if not self.__append_index(stored, "+"):
+                self.__truncate_segment(offset)
+                return False
+            logging.debug(f"{link} put successfully")
+            return True
+
+    def __writable_segment(self) -> IO[bytes]:
+        if self.__segment_file is not None:
+            if self.__segment_file.tell() < self.segment_size:
+                return self.__segment_file
+            self.__segment_file.close()
+            self.__segment_file = None
+            self.__segment += 1
+        if self.__segment is None:
+            segments = self.__segments()
+            self.__segment = segments[-1] if len(segments) > 0 else 1
+        os.makedirs(self.root, exist_ok=True)
+        path = self.__segment_path(self.__segment)
+        f = open(path, "r+b" if os.path.exists(path) else "w+b")
+        f.seek(0, io.SEEK_END)
+        self.__segment_file = f
+        if f.tell() >= self.segment_size:
+            return self.__writable_segment()
+        return f
+
+    def __truncate_segment(self, offset: int):
+        try:
+            self.__segment_file.seek(offset)
+            self.__segment_file.truncate()
+        except BaseException as e:
+            logging.exception(f"Pack segment truncate fail: {e}")
+
+    def __append_index(self, link: PackLink, op: str) -> bool:
+        record = {
+            "op": op,
+            "id": link.id(),
+            "e": link.get_extension(),
+            "p": link.get_properties(),
+        }
+        if op == "+":
+            record.update({"s": link.segment, "o": link.offset, "l": link.length})
+        try:
+            if self.__index_file is None:
+                os.makedirs(self.root, exist_ok=True)
+                self.__index_file = open(self.__index_path(), "ab")
+            self.__index_file.write(
+                json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+            )
+            self.__index_file.flush()
+        except BaseException as e:
+            logging.exception(f"Pack index writing fail {link}: {e}")
+            return False
+        if op == "+":
+            self.__links[link.key()] = link
+        else:
+            self.__links.pop(link.key(), None)
+        return True
+
+    def remove(self, link: PackLink, as_new_mutation: bool = True) -> bool:
+        with self.__lock:
+            stored = self.__load().get(link.key())
+            if stored is None:
+                logging.error(f"Remove fail, link not found: {link}")
+                return False
+            if not as_new_mutation:
+                return self.__append_index(stored, "-")
+            # the tombstone points to the data of the removed link
+            dst = stored.clone().set_properties(
+                {
+                    LinkInterface.property_deleted: True,
+                    LinkInterface.property_mutation: self.__gen_mutation(),
+                }
+            )
+            return self.__append_index(dst, "+")
+
+    def find(self, f: LinkFilter | None = None) -> LinkList[PackLink]:
+        return LinkList(self.iter_find(f))
+
+    def iter_find(self, f: LinkFilter | None = None) -> Iterator[PackLink]:
+        with self.__lock:
+            links = list(self.__load().values())
+        for link in links:
+            if f is None or f(link):
+                # the callers may modify the links
+                yield link.clone()
+
+    def modify(self, link: PackLink, to_link: PackLink) -> bool:
+        with self.__lock:
+            stored = self.__load().get(link.key())
+            if stored is None:
+                logging.error(f"Modify fail, link not found: {link}")
+                return False
+            if to_link.key() in self.__links:
+                logging.error(
+                    f"Modify fail ({link}): destination link already exists ({to_link})"
+                )
+                return False
+            dst = to_link.clone()
+            dst.segment = stored.segment
+            dst.offset = stored.offset
+            dst.length = stored.length
+            if not self.__append_index(dst, "+"):
+                return False
+            return self.__append_index(stored, "-")
+
+    def flush(self) -> bool:
+        with self.__lock:
+            ok = True
+            for f in [self.__segment_file, self.__index_file]:
+                if f is not None:
+                    try:
+                        f.flush()
+                        os.fsync(f.fileno())
+                    except BaseException as e:
+                        logging.exception(f"Pack storage sync fail: {e}")
+                        ok = False
+            return FileSyncer.fsync_dir(self.root) and ok
+
+    def close(self):
+        """Flush and close the open segment and index files"""
+        with self.__lock:
+            self.flush()
+            for f in [self.__segment_file, self.__index_file]:
+                if f is not None:
+                    f.close()
+            self.__segment_file = None
+            self.__index_file = None
+            self.__maps = {}
+
+    def compact(self, keep_all_special: bool = True) -> int:
+        """
+        Rewrite the live data into new segments and drop the superseded mutations.
+        Only the latest metadata and the latest object link is kept per object ID.
+        :param keep_all_special: keep every mutation of the special IDs (e.g. labels, their history is used by restore)
+        :return: number of the dropped links
+        """
+        with self.__lock:
+            links = self.__load()
+            latest: dict[tuple[str, bool], PackLink] = {}
+            kept: list[PackLink] = []
+            for link in links.values():
+                if keep_all_special and link.is_special_id():
+                    kept.append(link)
+                    continue
+                kind = (link.id(), link.is_metadata())
+                if kind not in latest or latest[kind].mutation() < link.mutation():
+                    latest[kind] = link
+            kept.extend(latest.values())
+            dropped = len(links) - len(kept)
+            self.__rewrite(kept)
+            logging.info(f"Pack storage compacted, dropped links: {dropped}")
+            return dropped
+
+    def reclaim(self) -> bool:
+        """Rewrite the live links into new segments if the segments have data of removed links"""
+        with self.__lock:
+            try:
+                links = self.__load()
+                self.flush()
+                live = {(l.segment, l.offset, l.length) for l in links.values()}
+                size = sum(
+                    os.path.getsize(self.__segment_path(segment))
+                    for segment in self.__segments()
+                )
+                if sum(length for _, _, length in live) == size:
+                    return True
+                self.__rewrite(list(links.values()))
+            except BaseException as e:
+                logging.exception(f"Pack storage reclaim fail: {e}")
+                return False
+            logging.info(f"Pack storage space reclaimed, live links: {len(links)}")
+            return True
+
+    def __rewrite(self, kept: list[PackLink]):
+        """Copy the data of the kept links into new segments, then replace the index and drop the old segments"""
+        with self.__lock:
+            self.flush()
+            old_segments = self.__segments()
+            if self.__segment_file is not None:
+                self.__segment_file.close()
+                self.__segment_file = None
+            if self.__index_file is not None:
+                self.__index_file.close()
+                self.__index_file = None
+            self.__segment = (old_segments[-1] if len(old_segments) > 0 else 0) + 1
+            first_segment = self.__segment
+            new_links: dict[str, PackLink] = {}
+            locations: dict[tuple[int, int, int], tuple[int, int]] = {}
+            kept.sort(key=lambda l: (l.segment, l.offset))
+            for link in kept:
+                location = (link.segment, link.offset, link.length)
+                new_link = link.clone()
+                if location not in locations:
+                    # the shared data (e.g. of a tombstone) is copied once
+                    f = self.__writable_segment()
+                    offset = f.tell()
+                    with self.get(link) as src:
+                        while True:
+                            chunk = src.read(content_hash.chunk_size)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                    locations[location] = (self.__segment, offset)
+                new_link.segment, new_link.offset = locations[location]
+                new_links[new_link.key()] = new_link
+            if self.__segment_file is not None:
+                self.__segment_file.flush()
+                os.fsync(self.__segment_file.fileno())
+
+            index_tmp = f"{self.__index_path()}.tmp"
+            with open(index_tmp, "wb") as f:
+                for link in new_links.values():
+                    record = {
+                        "op": "+",
+                        "id": link.id(),
+                        "e": link.get_extension(),
+                        "p": link.get_properties(),
+                        "s": link.segment,
+                        "o": link.offset,
+                        "l": link.length,
+                    }
+                    f.write(
+                        json.dumps(record, separators=(",", ":")).encode("utf-8")
+                        + b"\n"
+                    )
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(index_tmp, self.__index_path())
+            FileSyncer.fsync_dir(self.root)
+            self.__links = new_links
+            self.__maps = {}
+            for segment in old_segments:
+                if segment >= first_segment:
+                    continue
+                try:
+                    os.remove(self.__segment_path(segment))
+                except BaseException as e:
+                    # e.g. still mapped by a reader on Windows, removed by the next compaction
+                    logging.warning(f"Pack segment remove fail {segment}: {e}")
+
+    def content_hash_add(self, link: PackLink) -> PackLink:
+        with self.get(link) as f:
+            link_content_hash = self.content_hash_generate(f)
+        to_link = link.clone()
+        to_link.set_properties({LinkInterface.property_content_hash: link_content_hash})
+        if self.modify(link, to_link):
+            return to_link
+        raise RuntimeError(f"Link hashing failed ({link})")
+
+    def content_hash_check(self, link: PackLink) -> bool | None:
+        if not link.has_property(LinkInterface.property_content_hash):
+            return None
+        with self.get(link) as f:
+            return self.content_hash_eq(link, f)
+
+    def content_hash_eq(self, link: PackLink, data: IO[bytes] | bytes | str) -> bool:
+        if not link.has_property(LinkInterface.property_content_hash):
+            return False
+        return content_hash.eq(
+            link.get_property(LinkInterface.property_content_hash), data
+        )
+
+    def content_hash_generate(self, b: IO[bytes] | bytes | str) -> str:
+        return content_hash.generate(b, self.content_hash_algorithm)
@@ -0,0 +1,328 @@
+from __future__ import annotations
+
+import concurrent.futures
+import io
+import logging
+import tempfile
+from datetime import datetime, timezone
+from typing import IO, Iterator
+
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.file_storage import FileLink
+from gwbackupy.storage.storage_interface import (
+    StorageInterface,
+    Data,
+    LinkFilter,
+    LinkInterface,
+    LinkList,
+)
+
+# Key structure, same as the directory structure of the file storage
+# <prefix>/
+#    - <id>.<propname>=<propvalue>.<propname>=<propvalue>.<ext>
+#    - <YYYY>/<MM-DD>/12345678.m=12345678.metadata=.json
+#    - <YYYY>/<MM-DD>/12345678.m=12345678.object=message.eml.gz
+#
+
+
+class S3Link(FileLink):
+    """
+    Link object for an S3 object.
+    The properties are stored in the object key like in the file name of FileLink, the path is the key prefix.
+    """
+
+    __slots__ = ()
+
+    def get_key(self) -> str:
+        path = self.get_path()
+        if path is None or path == "":
+            return self.get_file_name()
+        return f"{path}/{self.get_file_name()}"
+
+    def get_file_path(self) -> str:
+        return self.get_key()
+
+
+class S3Storage(StorageInterface):
+    """
+    Storage on S3-compatible object storage (AWS S3, MinIO, ...).
+    The HTTP connections are pooled by the client, the large objects are transferred in parallel parts,
+    and the key prefixes (date-based layout) are listed in parallel.
+    Requires the optional boto3 package.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: str | None = None,
+        client=None,
+        max_pool_connections: int = 32,
+        list_workers: int = 16,
+        multipart_threshold: int = 8 * 1024 * 1024,
+        multipart_chunksize: int = 8 * 1024 * 1024,
+        content_hash_algorithm: str = content_hash.default_algorithm,
+    ):
+        """
+        :param bucket: name of the bucket
+        :param prefix: key prefix of the storage (e.g. <email>/gmail)
+        :param endpoint_url: endpoint of the S3-compatible service, None means AWS S3
+        :param client: boto3 S3 client, created by the parameters if it is None
+        :param max_pool_connections: size of the HTTP connection pool
+        :param list_workers: number of threads for listing the key prefixes
+        :param multipart_threshold: objects larger than this (bytes) are transferred in parts
+        :param multipart_chunksize: size of the parts (bytes)
+        :param content_hash_algorithm: algorithm of the new content hashes
+        """
+        if content_hash_algorithm not in content_hash.content_hash_prefixes:
+            raise ValueError(
+                f"Not supported content hash algorithm: {content_hash_algorithm}"
+            )
+        boto3 = S3Storage.module()
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.list_workers = max(1, list_workers)
+        self.multipart_threshold = multipart_threshold
+        self.content_hash_algorithm = content_hash_algorithm
+        if client is None:
+            client = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                config=Config(max_pool_connections=max_pool_connections),
+            )
+        self.client = client
+        self.__transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max(1, min(10, max_pool_connections)),
+        )
+
+    @staticmethod
+    def module():
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError(
+                "S3 storage requires the boto3 package: pip install gwbackupy[s3]"
+            )
+        return boto3
+
+    def new_link(
+        self,
+        object_id: str,
+        extension: str,
+        created_timestamp: int | float | None = None,
+    ) -> S3Link:
+        link = S3Link()
+        link.fill(
+            {
+                "path": self.__path_of(created_timestamp),
+                "object_id": object_id,
+                "extension": extension,
+                "mutation": S3Storage.__gen_mutation(),
+            }
+        )
+        return link
+
+    def __path_of(self, created_timestamp: int | float | None) -> str:
+        if created_timestamp is None:
+            return self.prefix
+        date = datetime.fromtimestamp(created_timestamp, tz=timezone.utc)
+        sub_paths = date.strftime("%Y-%m-%d").split("-", 1)
+        if self.prefix == "":
+            return f"{sub_paths[0]}/{sub_paths[1]}"
+        return f"{self.prefix}/{sub_paths[0]}/{sub_paths[1]}"
+
+    @staticmethod
+    def __gen_mutation():
+        return str(int(datetime.now(tz=timezone.utc).timestamp() * 1000))
+
+    @staticmethod
+    def __is_not_found(e: BaseException) -> bool:
+        response = getattr(e, "response", None)
+        if not isinstance(response, dict):
+            return False
+        return response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]
+
+    def get(self, link: S3Link) -> IO[bytes]:
+        """Download the object into a seekable temporary stream (in memory if it is small)"""
+        f = tempfile.SpooledTemporaryFile(max_size=self.multipart_threshold)
+        try:
+            self.client.download_fileobj(
+                self.bucket, link.get_key(), f, Config=self.__transfer_config
+            )
+        except BaseException as e:
+            f.close()
+            if S3Storage.__is_not_found(e):
+                raise FileNotFoundError(f"Object not found: {link.get_key()}")
+            raise
+        f.seek(0)
+        return f
+
+    def put(self, link: S3Link, data: Data) -> bool:
+        key = link.get_key()
+        logging.debug(f"Put object {key}")
+        try:
+            if isinstance(data, str):
+                data = bytes(data, "utf-8")
+            if isinstance(data, bytes):
+                if len(data) < self.multipart_threshold:
+                    self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+                else:
+                    self.__upload(key, io.BytesIO(data))
+            elif callable(data):
+                with tempfile.SpooledTemporaryFile(
+                    max_size=self.multipart_threshold
+                ) as f:
+                    data(f)
+                    f.seek(0)
+                    self.__upload(key, f)
+            elif hasattr(data, "read"):
+                with data:
+                    self.__upload(key, data)
+            else:
+                raise NotImplementedError(f"Not supported data type: {type(data)}")
+        except BaseException as e:
+            logging.exception(f"Object put fail ({key}): {e}")
+            return False
+        logging.debug(f"{key} put successfully")
+        return True
+
+    def __upload(self, key: str, f: IO[bytes]):
+        self.client.upload_fileobj(f, self.bucket, key, Config=self.__transfer_config)
+
+    def __copy(self, key: str, to_key: str):
+        """Server-side copy, the large objects are copied in parts"""
+        self.client.copy(
+            {"Bucket": self.bucket, "Key": key},
+            self.bucket,
+            to_key,
+            Config=self.__transfer_config,
+        )
+
+    def __exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except BaseException as e:
+            if S3Storage.__is_not_found(e):
+                return False
+            raise
+
+    def remove(self, link: S3Link, as_new_mutation: bool = True) -> bool:
+        if not as_new_mutation:
+            try:
+                self.client.delete_object(Bucket=self.bucket, Key=link.get_key())
+                return True
+            except BaseException as e:
+                logging.exception(f"Delete fail {link.get_key()} with error: {e}")
+                return False
+
+        dst = link.clone().fill(
+            {
+                "deleted": True,
+                "mutation": S3Storage.__gen_mutation(),
+            }
+        )
+        try:
+            self.__copy(link.get_key(), dst.get_key())
+            return True
+        except BaseException as e:
+            logging.exception(
+                f"Copy as new mutation is failed {link.get_key()} -> {dst.get_key()}: {e}"
+            )
+            return False
+
+    def find(self, f: LinkFilter | None = None) -> LinkList[S3Link]:
+        return LinkList(self.iter_find(f))
+
+    def iter_find(self, f: LinkFilter | None = None) -> Iterator[S3Link]:
+        for link in self.__iter_all():
+            if f is None or f(link):
+                yield link
+
+    def __iter_all(self) -> Iterator[S3Link]:
+        """List the key prefixes in parallel (like a directory tree), and stream the links"""
+        root = f"{self.prefix}/" if self.prefix != "" else ""
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.list_workers
+        ) as executor:
+            futures = {executor.submit(self.__list_prefix, root)}
+            try:
+                while len(futures) > 0:
+                    done, futures = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        links, sub_prefixes = future.result()
+                        for sub_prefix in sub_prefixes:
+                            futures.add(executor.submit(self.__list_prefix, sub_prefix))
+                        yield from links
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def __list_prefix(self, prefix: str) -> tuple[list[S3Link], list[str]]:
+        """List the objects directly under the prefix, and the sub prefixes"""
+        links: list[S3Link] = []
+        sub_prefixes: list[str] = []
+        path = prefix.rstrip("/")
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=prefix, Delimiter="/"
+        ):
+            for item in page.get("Contents", []):
+                name = item["Key"][len(prefix) :]
+                m = FileLink.parse_file_name(name)
+                if m is None:
+                    continue
+                m["path"] = path
+                links.append(S3Link().fill(m))
+            for item in page.get("CommonPrefixes", []):
+                sub_prefixes.append(item["Prefix"])
+        return links, sub_prefixes
+
+    def modify(self, link: S3Link, to_link: S3Link) -> bool:
+        try:
+            if self.__exists(to_link.get_key()):
+                logging.error(
+                    f"Modify fail ({link.get_key()}): destination link already exists ({to_link.get_key()})"
+                )
+                return False
+            # no rename in object storage
+            self.__copy(link.get_key(), to_link.get_key())
+            self.client.delete_object(Bucket=self.bucket, Key=link.get_key())
+        except BaseException as e:
+            logging.exception(
+                f"Object move fail: {e} ({link.get_key()} -> {to_link.get_key()})"
+            )
+            return False
+        return True
+
+    def content_hash_add(self, link: S3Link) -> S3Link:
+        with self.get(link) as f:
+            link_content_hash = self.content_hash_generate(f)
+        to_link = link.clone()
+        to_link.set_properties({LinkInterface.property_content_hash: link_content_hash})
+        if self.modify(link, to_link):
+            return to_link
+        raise RuntimeError(f"Link hashing failed ({link.get_key()})")
+
+    def content_hash_check(self, link: S3Link) -> bool | None:
+        if not link.has_property(LinkInterface.property_content_hash):
+            return None
+        with self.get(link) as f:
+            return self.content_hash_eq(link, f)
+
+    def content_hash_eq(self, link: S3Link, data: IO[bytes] | bytes | str) -> bool:
+        if not link.has_property(LinkInterface.property_content_hash):
+            return False
+        return content_hash.eq(
+            link.get_property(LinkInterface.property_content_hash), data
+        )
+
+    def content_hash_generate(self, b: IO[bytes] | bytes | str) -> str:
+        return content_hash.generate(b, self.content_hash_algorithm)
@@ -0,0 +1,542 @@
+from __future__ import annotations
+
+import io
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import IO, Iterator
+
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.storage_interface import (
+    StorageInterface,
+    Data,
+    LinkFilter,
+    LinkInterface,
+    LinkList,
+    LinkQuery,
+)
+
+# Directory structure v1
+# /<root>
+#    - links.sqlite3           link rows (WAL mode), the small blobs are inline
+#    - blobs/<xx>/<token>      the large blobs, shared by the rows of the same data (e.g. tombstones)
+#
+# A link is identified by its object id, extension and properties (including the mutation).
+
+
+class SqliteLink(LinkInterface):
+    __slots__ = ("__id", "__extension", "__properties", "path")
+
+    def __init__(self):
+        self.__id: str | None = None
+        self.__extension: str | None = None
+        self.__properties: dict[str, any] = {}
+        self.path: str | None = None
+        """created date of the object (<YYYY>/<MM-DD>), None if it is not dated"""
+
+    def fill(self, values: dict[str, any]) -> SqliteLink:
+        if "object_id" in values:
+            self.__id = values["object_id"]
+        if "extension" in values:
+            self.__extension = values["extension"]
+            if self.__extension is not None:
+                self.__extension = sys.intern(self.__extension)
+        if "properties" in values:
+            self.__properties = {}
+            self.set_properties(values["properties"])
+        if "mutation" in values:
+            self.__properties[LinkInterface.property_mutation] = values["mutation"]
+        if "path" in values:
+            self.path = values["path"]
+        return self
+
+    def clone(self) -> SqliteLink:
+        link = SqliteLink.__new__(SqliteLink)
+        link.__id = self.__id
+        link.__extension = self.__extension
+        link.__properties = dict(self.__properties)
+        link.path = self.path
+        return link
+
+    def key(self) -> str:
+        """Identity of the link in the database"""
+        return "\0".join(
+            [
+                self.__id,
+                self.__extension or "",
+                json.dumps(self.__properties, sort_keys=True, separators=(",", ":")),
+            ]
+        )
+
+    def get_extension(self) -> str | None:
+        return self.__extension
+
+    def id(self) -> str:
+        return self.__id
+
+    def partition(self) -> str | None:
+        return self.path
+
+    def mutation(self) -> str:
+        return self.__properties.get(LinkInterface.property_mutation)
+
+    def get_properties(self) -> dict[str, any]:
+        return dict(self.__properties)
+
+    def get_property(self, name: str, default: any = None) -> any:
+        return self.__properties.get(name, default)
+
+    def has_property(self, name: str) -> bool:
+        return self.__properties.get(name) is not None
+
+    def set_properties(self, sets: dict[str, any], replace: bool = False) -> SqliteLink:
+        if replace:
+            self.__properties = {}
+        for name, value in sets.items():
+            if value is None or value is False:
+                self.__properties.pop(name, None)
+            else:
+                self.__properties[sys.intern(name)] = value
+        return self
+
+    def is_deleted(self) -> bool:
+        return self.has_property(LinkInterface.property_deleted)
+
+    def is_metadata(self) -> bool:
+        return self.has_property(LinkInterface.property_metadata)
+
+    def is_object(self) -> bool:
+        return self.has_property(LinkInterface.property_object)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__}#id:{self.id()},ext:{self.__extension},props:{self.__properties},path:{self.path}"
+
+    def __eq__(self, other):
+        if not isinstance(other, SqliteLink):
+            return False
+        return self.key() == other.key()
+
+
+class SqliteStorage(StorageInterface):
+    """
+    Storage with an SQLite database of the links: find() with a LinkQuery is an indexed query.
+    The writes are committed in batches (the last batch is committed by flush()), the small blobs
+    are stored inline, the large ones as files.
+    The storage supports one writer process.
+    """
+
+    database_file_name = "links.sqlite3"
+    blobs_directory_name = "blobs"
+    __columns = "object_id, extension, properties, path, blob, blob_file"
+
+    def __init__(
+        self,
+        root: str,
+        inline_blob_size: int = 64 * 1024,
+        batch_size: int = 1000,
+        batch_interval_ms: int = 1000,
+        content_hash_algorithm: str = content_hash.default_algorithm,
+    ):
+        """
+        :param root: root directory of the storage
+        :param inline_blob_size: blobs up to this size (bytes) are stored in the database
+        :param batch_size: number of the writes in one transaction
+        :param batch_interval_ms: maximum age of an uncommitted transaction (checked on the next write)
+        :param content_hash_algorithm: algorithm of the new content hashes, the existing ones are verified by their own algorithm
+        """
+        if content_hash_algorithm not in content_hash.content_hash_prefixes:
+            raise ValueError(
+                f"Not supported content hash algorithm: {content_hash_algorithm}"
+            )
+        self.root = root
+        self.inline_blob_size = inline_blob_size
+        self.batch_size = batch_size
+        self.batch_interval_ms = batch_interval_ms
+        self.content_hash_algorithm = content_hash_algorithm
+        self.__lock = threading.RLock()
+        self.__pending_writes = 0
+        self.__batch_started = 0.0
+        # blob files of the removed rows in the open transaction, they are removed after the commit
+        self.__orphan_blob_files: list[str] = []
+        os.makedirs(root, exist_ok=True)
+        self.__db = self.__connect()
+        with self.__lock:
+            self.__db.executescript("""
+                CREATE TABLE IF NOT EXISTS links (
+                    key TEXT PRIMARY KEY,
+                    object_id TEXT NOT NULL,
+                    extension TEXT,
+                    mutation INTEGER,
+                    deleted INTEGER NOT NULL,
+                    metadata INTEGER NOT NULL,
+                    object INTEGER NOT NULL,
+                    content_hash TEXT,
+                    properties TEXT NOT NULL,
+                    path TEXT,
+                    blob BLOB,
+                    blob_file TEXT
+                );
+                CREATE INDEX IF NOT EXISTS links_object_id ON links (object_id, mutation);
+                CREATE INDEX IF NOT EXISTS links_mutation ON links (mutation);
+                CREATE INDEX IF NOT EXISTS links_blob_file ON links (blob_file) WHERE blob_file IS NOT NULL;
+                """)
+
+    def __connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(
+            os.path.join(self.root, SqliteStorage.database_file_name),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        # the WAL is synced on checkpoints, a commit is durable after the next checkpoint or flush()
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def new_link(
+        self,
+        object_id: str,
+        extension: str,
+        created_timestamp: int | float | None = None,
+    ) -> SqliteLink:
+        path = None
+        if created_timestamp is not None:
+            path = "/".join(
+                datetime.fromtimestamp(created_timestamp, tz=timezone.utc)
+                .strftime("%Y-%m-%d")
+                .split("-", 1)
+            )
+        return SqliteLink().fill(
+            {
+                "object_id": object_id,
+                "extension": extension,
+                "mutation": SqliteStorage.__gen_mutation(),
+                "path": path,
+            }
+        )
+
+    @staticmethod
+    def __gen_mutation():
+        return str(int(datetime.now(tz=timezone.utc).timestamp() * 1000))
+
+    def __begin_write(self):
+        """Start a transaction if there is not any, the caller holds the lock"""
+        if self.__pending_writes == 0:
+            self.__db.execute("BEGIN IMMEDIATE")
+            self.__batch_started = time.monotonic()
+
+    def __end_write(self):
+        """Count a write, and commit the batch if it is full or old, the caller holds the lock"""
+        self.__pending_writes += 1
+        if (
+            self.__pending_writes >= self.batch_size
+            or (time.monotonic() - self.__batch_started) * 1000
+            >= self.batch_interval_ms
+        ):
+            self.__commit()
+
+    def __commit(self):
+        if self.__pending_writes == 0:
+            return
+        self.__db.execute("COMMIT")
+        self.__pending_writes = 0
+        orphan_blob_files = self.__orphan_blob_files
+        self.__orphan_blob_files = []
+        for blob_file in orphan_blob_files:
+            self.__remove_blob_file_now(blob_file)
+
+    def __rollback(self):
+        if self.__pending_writes == 0 and self.__db.in_transaction:
+            # nothing else is in the transaction
+            self.__db.execute("ROLLBACK")
+            self.__orphan_blob_files = []
+
+    def flush(self) -> bool:
+        with self.__lock:
+            try:
+                self.__commit()
+                self.__db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+                return True
+            except BaseException as e:
+                logging.exception(f"Database commit fail: {e}")
+                return False
+
+    def close(self):
+        with self.__lock:
+            self.__commit()
+            self.__db.close()
+
+    @staticmethod
+    def __row_values(link: SqliteLink) -> tuple:
+        mutation = link.mutation()
+        return (
+            link.key(),
+            link.id(),
+            link.get_extension(),
+            int(mutation) if mutation is not None else None,
+            1 if link.is_deleted() else 0,
+            1 if link.is_metadata() else 0,
+            1 if link.is_object() else 0,
+            link.get_property(LinkInterface.property_content_hash),
+            json.dumps(link.get_properties(), sort_keys=True, separators=(",", ":")),
+            link.path,
+        )
+
+    def __blob_path(self, blob_file: str) -> str:
+        return os.path.join(self.root, SqliteStorage.blobs_directory_name, blob_file)
+
+    def __write_blob(self, data: Data) -> tuple[bytes | None, str | None]:
+        """Return the inline blob, or the file of the blob if it is large"""
+        if isinstance(data, str):
+            data = bytes(data, "utf-8")
+        if isinstance(data, bytes) and len(data) <= self.inline_blob_size:
+            return data, None
+        token = secrets.token_hex(16)
+        blob_file = f"{token[:2]}/{token}"
+        file_path = self.__blob_path(blob_file)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            elif callable(data):
+                data(f)
+            elif hasattr(data, "read"):
+                with data:
+                    while True:
+                        chunk = data.read(content_hash.chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+            else:
+                raise NotImplementedError(f"Not supported data type: {type(data)}")
+            size = f.tell()
+        if size <= self.inline_blob_size:
+            with open(file_path, "rb") as f:
+                blob = f.read()
+            os.remove(file_path)
+            return blob, None
+        return None, blob_file
+
+    def __remove_blob_file(self, blob_file: str | None):
+        """
+        Remove the blob file of a removed row after the commit, the caller holds the lock.
+        A rolled back row still references its file, a crash before the removal leaves an unreferenced file only.
+        """
+        if blob_file is not None:
+            self.__orphan_blob_files.append(blob_file)
+
+    def __remove_blob_file_now(self, blob_file: str):
+        """Remove the blob file if it is not referenced by any committed row, the caller holds the lock"""
+        try:
+            row = self.__db.execute(
+                "SELECT 1 FROM links WHERE blob_file = ? LIMIT 1", (blob_file,)
+            ).fetchone()
+            if row is not None:
+                return
+            os.remove(self.__blob_path(blob_file))
+        except FileNotFoundError:
+            pass
+        except BaseException as e:
+            logging.exception(f"Blob file remove fail {blob_file}: {e}")
+
+    def get(self, link: SqliteLink) -> IO[bytes]:
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT blob, blob_file FROM links WHERE key = ?", (link.key(),)
+            ).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Link not found: {link}")
+        if row[1] is not None:
+            return open(self.__blob_path(row[1]), "rb")
+        return io.BytesIO(row[0])
+
+    def put(self, link: SqliteLink, data: Data) -> bool:
+        logging.debug(f"Put object {link}")
+        try:
+            blob, blob_file = self.__write_blob(data)
+        except BaseException as e:
+            logging.exception(f"Blob write fail ({link}): {e}")
+            return False
+        with self.__lock:
+            inserted = False
+            try:
+                self.__begin_write()
+                old = self.__db.execute(
+                    "SELECT blob_file FROM links WHERE key = ?", (link.key(),)
+                ).fetchone()
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO links (key, object_id, extension, mutation, deleted, metadata, object,"
+                    " content_hash, properties, path, blob, blob_file) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    SqliteStorage.__row_values(link) + (blob, blob_file),
+                )
+                inserted = True
+                if old is not None:
+                    self.__remove_blob_file(old[0])
+                self.__end_write()
+            except BaseException as e:
+                logging.exception(f"Link insert fail ({link}): {e}")
+                self.__rollback()
+                if blob_file is not None and not inserted:
+                    # not referenced by any row
+                    try:
+                        os.remove(self.__blob_path(blob_file))
+                    except BaseException as e:
+                        logging.exception(f"Blob file remove fail {blob_file}: {e}")
+                return False
+        logging.debug(f"{link} put successfully")
+        return True
+
+    def remove(self, link: SqliteLink, as_new_mutation: bool = True) -> bool:
+        with self.__lock:
+            try:
+                self.__begin_write()
+                row = self.__db.execute(
+                    "SELECT blob, blob_file FROM links WHERE key = ?", (link.key(),)
+                ).fetchone()
+                if row is None:
+                    logging.error(f"Link not found: {link}")
+                    self.__rollback()
+                    return False
+                if as_new_mutation:
+                    dst = link.clone().set_properties(
+                        {
+                            LinkInterface.property_deleted: True,
+                            LinkInterface.property_mutation: SqliteStorage.__gen_mutation(),
+                        }
+                    )
+                    # the deleted mutation shares the blob file
+                    self.__db.execute(
+                        "INSERT OR REPLACE INTO links (key, object_id, extension, mutation, deleted, metadata, object,"
+                        " content_hash, properties, path, blob, blob_file) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        SqliteStorage.__row_values(dst) + (row[0], row[1]),
+                    )
+                else:
+                    self.__db.execute("DELETE FROM links WHERE key = ?", (link.key(),))
+                    self.__remove_blob_file(row[1])
+                self.__end_write()
+                return True
+            except BaseException as e:
+                logging.exception(f"Link remove fail ({link}): {e}")
+                self.__rollback()
+                return False
+
+    def modify(self, link: SqliteLink, to_link: SqliteLink) -> bool:
+        with self.__lock:
+            try:
+                self.__begin_write()
+                if (
+                    self.__db.execute(
+                        "SELECT 1 FROM links WHERE key = ?", (to_link.key(),)
+                    ).fetchone()
+                    is not None
+                ):
+                    logging.error(
+                        f"Modify fail ({link}): destination link already exists ({to_link})"
+                    )
+                    self.__rollback()
+                    return False
+                cursor = self.__db.execute(
+                    "UPDATE links SET key = ?, object_id = ?, extension = ?, mutation = ?, deleted = ?, metadata = ?,"
+                    " object = ?, content_hash = ?, properties = ?, path = ? WHERE key = ?",
+                    SqliteStorage.__row_values(to_link) + (link.key(),),
+                )
+                if cursor.rowcount == 0:
+                    logging.error(f"Modify fail, link not found ({link})")
+                    self.__rollback()
+                    return False
+                self.__end_write()
+                return True
+            except BaseException as e:
+                logging.exception(f"Link modify fail ({link} -> {to_link}): {e}")
+                self.__rollback()
+                return False
+
+    def find(self, f: LinkFilter | None = None) -> LinkList[SqliteLink]:
+        return LinkList(self.iter_find(f))
+
+    def iter_find(self, f: LinkFilter | None = None) -> Iterator[SqliteLink]:
+        """Stream the links, a LinkQuery filter is evaluated by the database"""
+        sql = f"SELECT {SqliteStorage.__columns} FROM links"
+        params: list = []
+        if isinstance(f, LinkQuery):
+            where, params = SqliteStorage.where(f)
+            if where != "":
+                sql += f" WHERE {where}"
+            f = None
+        with self.__lock:
+            # the reader connection sees the committed rows only
+            self.__commit()
+        db = self.__connect()
+        try:
+            cursor = db.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(1000)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    link = SqliteLink().fill(
+                        {
+                            "object_id": row[0],
+                            "extension": row[1],
+                            "properties": json.loads(row[2]),
+                            "path": row[3],
+                        }
+                    )
+                    if f is None or f(link):
+                        yield link
+        finally:
+            db.close()
+
+    @staticmethod
+    def where(query: LinkQuery) -> tuple[str, list]:
+        """SQL condition and parameters of a link query"""
+        conditions: list[str] = []
+        params: list = []
+        if query.object_id is not None:
+            conditions.append("object_id = ?")
+            params.append(query.object_id)
+        for column, value in [
+            ("deleted", query.deleted),
+            ("metadata", query.metadata),
+            ("object", query.object),
+        ]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(1 if value else 0)
+        if query.mutation_from is not None:
+            conditions.append("mutation >= ?")
+            params.append(int(query.mutation_from))
+        if query.mutation_to is not None:
+            conditions.append("mutation < ?")
+            params.append(int(query.mutation_to))
+        return " AND ".join(conditions), params
+
+    def content_hash_add(self, link: SqliteLink) -> SqliteLink:
+        with self.get(link) as f:
+            link_content_hash = self.content_hash_generate(f)
+        to_link = link.clone()
+        to_link.set_properties({LinkInterface.property_content_hash: link_content_hash})
+        if self.modify(link, to_link):
+            return to_link
+        raise RuntimeError(f"Link hashing failed ({link})")
+
+    def content_hash_check(self, link: SqliteLink) -> bool | None:
+        if not link.has_property(LinkInterface.property_content_hash):
+            return None
+        with self.get(link) as f:
+            return self.content_hash_eq(link, f)
+
+    def content_hash_eq(self, link: SqliteLink, data: IO[bytes] | bytes | str) -> bool:
+        if not link.has_property(LinkInterface.property_content_hash):
+            return False
+        return content_hash.eq(
+            link.get_property(LinkInterface.property_content_hash), data
+        )
+
+    def content_hash_generate(self, b: IO[bytes] | bytes | str) -> str:
+        return content_hash.generate(b, self.content_hash_algorithm)
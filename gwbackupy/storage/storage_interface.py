@@ -1,10 +1,12 @@
 from __future__ import annotations
 
-from typing import Callable, IO, Union
+import copy
+from typing import Callable, IO, Iterable, Iterator, Union
 
 Path = str
 DataCall = Callable[[IO[bytes]], None]
 Data = Union[str, bytes, DataCall, IO]
+"""Data to put: text (stored as UTF-8), bytes, a writer callback, or a readable binary stream (closed after writing)"""
 
 
 class LinkInterface:
@@ -12,6 +14,8 @@ class LinkInterface:
     This interface represents a link to an storage item.
     """
 
+    __slots__ = ()
+
     property_deleted = "deleted"
     property_metadata = "metadata"
     property_object = "object"
@@ -42,6 +46,9 @@ class LinkInterface:
     def mutation(self) -> str:
         raise NotImplementedError("LinkInterface#mutation")
 
+    def get_extension(self) -> str | None:
+        raise NotImplementedError("LinkInterface#get_extension")
+
     def is_deleted(self) -> bool:
         raise NotImplementedError("LinkInterface#is_deleted")
 
@@ -51,11 +58,76 @@ class LinkInterface:
     def is_object(self) -> bool:
         raise NotImplementedError("LinkInterface#is_object")
 
+    def clone(self) -> LinkInterface:
+        """Return an independent copy of the link"""
+        return copy.deepcopy(self)
+
+    def partition(self) -> str | None:
+        """Storage partition of the link (e.g. its date directory), None if the storage is not partitioned"""
+        return None
+
 
 LinkFilter = Callable[[LinkInterface], bool]
 LinkGroupBy = Callable[[LinkInterface], list]
 
 
+class LinkQuery:
+    """
+    Link filter of the common predicates (all given predicates must match).
+    It can be used as a LinkFilter in any storage, and the storages with an index can push it down
+    (e.g. into an SQL query) instead of evaluating it link by link.
+    """
+
+    def __init__(
+        self,
+        object_id: str | None = None,
+        deleted: bool | None = None,
+        metadata: bool | None = None,
+        object: bool | None = None,
+        mutation_from: str | None = None,
+        mutation_to: str | None = None,
+    ):
+        """
+        :param object_id: object ID of the links
+        :param deleted: True/False: only the deleted/not deleted links
+        :param metadata: True/False: only the metadata/not metadata links
+        :param object: True/False: only the object/not object links
+        :param mutation_from: mutation from (inclusive)
+        :param mutation_to: mutation to (exclusive)
+        """
+        self.object_id = object_id
+        self.deleted = deleted
+        self.metadata = metadata
+        self.object = object
+        self.mutation_from = mutation_from
+        self.mutation_to = mutation_to
+
+    def __call__(self, link: LinkInterface) -> bool:
+        if self.object_id is not None and link.id() != self.object_id:
+            return False
+        if self.deleted is not None and link.is_deleted() != self.deleted:
+            return False
+        if self.metadata is not None and link.is_metadata() != self.metadata:
+            return False
+        if self.object is not None and link.is_object() != self.object:
+            return False
+        if self.mutation_from is not None or self.mutation_to is not None:
+            mutation = link.mutation()
+            if mutation is None:
+                return False
+            # mutations are millisecond timestamps, compared as numbers
+            if self.mutation_from is not None and int(mutation) < int(
+                self.mutation_from
+            ):
+                return False
+            if self.mutation_to is not None and int(mutation) >= int(self.mutation_to):
+                return False
+        return True
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.__dict__})"
+
+
 class LinkList(list):
     """
     List of links. The list is allows to group and filter.
@@ -130,6 +202,143 @@ class LinkList(list):
         return None
 
 
+class LinkIndexEntry:
+    """Latest links of one key in LinkIndex"""
+
+    __slots__ = ("latest", "metadata", "object", "mutations")
+
+    def __init__(self):
+        self.latest: LinkInterface | None = None
+        """latest link of any kind"""
+        self.metadata: LinkInterface | None = None
+        """latest metadata link"""
+        self.object: LinkInterface | None = None
+        """latest object link"""
+        self.mutations: list[LinkInterface] | None = None
+        """all links, only if the index keeps the mutations"""
+
+
+class LinkIndex:
+    """
+    Index of links built in one pass.
+    It keeps the latest link, the latest metadata link and the latest object link per key (object ID by default),
+    and optionally all mutations.
+    """
+
+    def __init__(
+        self,
+        key: Callable[[LinkInterface], str] | None = None,
+        keep_mutations: bool = False,
+    ):
+        """
+        :param key: key of a link, default is the object ID
+        :param keep_mutations: keep all links per key, see mutations()
+        """
+        self.__key = key
+        self.__keep_mutations = keep_mutations
+        self.__entries: dict[str, LinkIndexEntry] = {}
+
+    @staticmethod
+    def build(
+        links: Iterable[LinkInterface],
+        f: LinkFilter | None = None,
+        key: Callable[[LinkInterface], str] | None = None,
+        keep_mutations: bool = False,
+    ) -> LinkIndex:
+        """Build an index from links, if filter is specified then only matching links are indexed"""
+        index = LinkIndex(key=key, keep_mutations=keep_mutations)
+        for link in links:
+            if f is None or f(link):
+                index.add(link)
+        return index
+
+    def add(self, link: LinkInterface):
+        key = link.id() if self.__key is None else self.__key(link)
+        entry = self.__entries.get(key)
+        if entry is None:
+            entry = LinkIndexEntry()
+            self.__entries[key] = entry
+        mutation = link.mutation()
+        if entry.latest is None or entry.latest.mutation() < mutation:
+            entry.latest = link
+        if link.is_metadata():
+            if entry.metadata is None or entry.metadata.mutation() < mutation:
+                entry.metadata = link
+        elif link.is_object():
+            if entry.object is None or entry.object.mutation() < mutation:
+                entry.object = link
+        if self.__keep_mutations:
+            if entry.mutations is None:
+                entry.mutations = []
+            entry.mutations.append(link)
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__entries
+
+    def __getitem__(self, key: str) -> LinkIndexEntry:
+        return self.__entries[key]
+
+    def __delitem__(self, key: str):
+        del self.__entries[key]
+
+    def get(self, key: str) -> LinkIndexEntry | None:
+        return self.__entries.get(key)
+
+    def keys(self) -> list[str]:
+        return list(self.__entries.keys())
+
+    def latest(self, key: str) -> LinkInterface | None:
+        entry = self.__entries.get(key)
+        return entry.latest if entry is not None else None
+
+    def latest_metadata(self, key: str) -> LinkInterface | None:
+        entry = self.__entries.get(key)
+        return entry.metadata if entry is not None else None
+
+    def latest_object(self, key: str) -> LinkInterface | None:
+        entry = self.__entries.get(key)
+        return entry.object if entry is not None else None
+
+    def latest_links(self) -> dict[str, LinkInterface]:
+        """Latest link of any kind by key"""
+        return {key: entry.latest for key, entry in self.__entries.items()}
+
+    def mutations(self, key: str) -> list[LinkInterface]:
+        """All links of the key ordered by mutation (oldest first)"""
+        if not self.__keep_mutations:
+            raise RuntimeError("LinkIndex is not keeping the mutations")
+        entry = self.__entries.get(key)
+        if entry is None:
+            return []
+        return sorted(entry.mutations, key=lambda link: link.mutation())
+
+    def deleted_keys(self) -> list[str]:
+        """Keys where the latest metadata is deleted"""
+        return [
+            key
+            for key, entry in self.__entries.items()
+            if entry.metadata is not None and entry.metadata.is_deleted()
+        ]
+
+    def special_keys(self) -> list[str]:
+        """Keys where the latest link has a special ID"""
+        return [
+            key for key, entry in self.__entries.items() if entry.latest.is_special_id()
+        ]
+
+    def iter_by_mutation(self) -> Iterator[LinkInterface]:
+        """Latest links of all keys ordered by mutation (oldest first)"""
+        return iter(
+            sorted(
+                (entry.latest for entry in self.__entries.values()),
+                key=lambda link: link.mutation(),
+            )
+        )
+
+
 class StorageInterface:
     """
     Storage interface with base storage functionality
@@ -152,15 +361,119 @@ class StorageInterface:
     def remove(self, link: LinkInterface, as_new_mutation: bool = True) -> bool:
         raise NotImplementedError("StorageInterface#remove")
 
+    def get_many(self, links: list[LinkInterface]) -> list[IO[bytes]]:
+        """
+        Open multiple links, the streams are in the order of the links.
+        The default implementation calls get() link by link.
+        """
+        streams = []
+        try:
+            for link in links:
+                streams.append(self.get(link))
+        except BaseException:
+            for stream in streams:
+                stream.close()
+            raise
+        return streams
+
+    def put_many(self, items: list[tuple[LinkInterface, Data]]) -> list[bool]:
+        """
+        Put multiple links, and return the result of each item.
+        The items of the same directory (e.g. the object and the metadata of a message) are written in the given order.
+        The default implementation calls put() item by item.
+        """
+        return [self.put(link, data) for link, data in items]
+
+    def remove_many(
+        self, links: list[LinkInterface], as_new_mutation: bool = True
+    ) -> list[bool]:
+        """
+        Remove multiple links, and return the result of each link.
+        The default implementation calls remove() link by link.
+        """
+        return [self.remove(link, as_new_mutation) for link in links]
+
     def find(self, f: LinkFilter | None = None) -> LinkList[LinkInterface]:
         raise NotImplementedError("StorageInterface#find")
 
+    def iter_find(self, f: LinkFilter | None = None) -> Iterator[LinkInterface]:
+        """
+        Find links as a stream, without materializing all links in a LinkList.
+        The default implementation iterates over the result of find().
+        """
+        return iter(self.find(f))
+
+    def get_versions(self, object_id: str) -> LinkList[LinkInterface]:
+        """
+        All links (mutations) of one object ID ordered by mutation (oldest first).
+        The default implementation scans the storage with a LinkQuery, see iter_find().
+        """
+        return LinkList(
+            sorted(
+                self.iter_find(LinkQuery(object_id=object_id)),
+                key=lambda link: link.mutation(),
+            )
+        )
+
+    def get_latest(self, object_id: str) -> LinkIndexEntry | None:
+        """
+        Latest links (any kind, metadata and object) of one object ID, None if the object ID is not stored.
+        The default implementation is based on get_versions().
+        """
+        return LinkIndex.build(self.get_versions(object_id)).get(object_id)
+
     def modify(self, link: LinkInterface, to_link: LinkInterface) -> bool:
         """
         modify link to a new link
         """
         raise NotImplementedError("StorageInterface#modify")
 
+    def prepare(
+        self,
+        created_timestamp_from: int | float,
+        created_timestamp_to: int | float,
+    ) -> bool:
+        """
+        Prepare the storage for new links created in the range (e.g. create directories in advance).
+        The default implementation has nothing to prepare.
+        """
+        return True
+
+    def flush(self) -> bool:
+        """
+        Make all previous writes durable. Return False if any write could not be made durable.
+        The default implementation has nothing to flush.
+        """
+        return True
+
+    def reclaim(self) -> bool:
+        """
+        Reclaim the space of the links removed without a new mutation (e.g. rewrite the append-only files).
+        The default implementation has nothing to reclaim, the removed links are deleted instantly.
+        """
+        return True
+
+    def uncached(self) -> StorageInterface:
+        """
+        The storage without the local copies of the data (e.g. for the verification of the stored data).
+        The default implementation is not cached.
+        """
+        return self
+
+    def has_content(self, link: LinkInterface) -> bool:
+        """
+        The data of the link is already stored (e.g. in a content-addressed pool), so put() will not read the data.
+        The default implementation has no shared content.
+        """
+        return False
+
+    def shares_content(self) -> bool:
+        """
+        The stored data is shared with other storages by content hash (e.g. a pool of the accounts).
+        The default implementation has no shared content.
+        """
+        return False
+
     def content_hash_add(self, link: LinkInterface) -> LinkInterface:
         """
         Add content hash to link, and return with the new link
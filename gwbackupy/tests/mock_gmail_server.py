@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+
+from gwbackupy.helpers import encode_base64url
+from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
+
+
+class MockGmailServer:
+    """
+    Local Gmail REST API on top of MockGmailServiceWrapper (for the async client).
+    The access token is the email of the account.
+    """
+
+    def __init__(self, wrapper: MockGmailServiceWrapper, latency: float = 0.0):
+        """
+        :param wrapper: data of the accounts
+        :param latency: simulated latency of the requests (seconds)
+        """
+        self.wrapper = wrapper
+        self.latency = latency
+        self.request_count = 0
+        self.rejected_tokens: set[str] = set()
+        """tokens answered by 401 (e.g. revoked)"""
+        self.max_in_flight = 0
+        self.__in_flight = 0
+        self.__runner: web.AppRunner | None = None
+        self.base_url: str | None = None
+
+    def application(self) -> web.Application:
+        app = web.Application(middlewares=[self.__middleware])
+        app.router.add_get("/gmail/v1/users/me/labels", self.__get_labels)
+        app.router.add_post("/gmail/v1/users/me/labels", self.__create_label)
+        app.router.add_get("/gmail/v1/users/me/messages", self.__get_messages)
+        app.router.add_get(
+            "/gmail/v1/users/me/messages/{message_id}", self.__get_message
+        )
+        app.router.add_post("/upload/gmail/v1/users/me/messages", self.__insert_message)
+        return app
+
+    async def start(self) -> str:
+        self.__runner = web.AppRunner(self.application())
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    @staticmethod
+    def __email(request: web.Request) -> str:
+        return request.headers["Authorization"].removeprefix("Bearer ")
+
+    @web.middleware
+    async def __middleware(self, request: web.Request, handler):
+        self.request_count += 1
+        self.__in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.__in_flight)
+        try:
+            if self.latency > 0:
+                await asyncio.sleep(self.latency)
+            if MockGmailServer.__email(request) in self.rejected_tokens:
+                return web.json_response({"error": {"code": 401}}, status=401)
+            return await handler(request)
+        finally:
+            self.__in_flight -= 1
+
+    async def __get_labels(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"labels": self.wrapper.get_labels(MockGmailServer.__email(request))}
+        )
+
+    async def __create_label(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        try:
+            label = self.wrapper.create_label(
+                MockGmailServer.__email(request), data["name"]
+            )
+        except Exception as e:
+            logging.debug(f"Create label failed: {e}")
+            return web.json_response({"error": {"code": 409}}, status=409)
+        return web.json_response(label)
+
+    async def __get_messages(self, request: web.Request) -> web.Response:
+        messages = self.wrapper.get_messages(
+            MockGmailServer.__email(request), request.query.get("q", "")
+        )
+        ids = sorted(messages.keys())
+        page_size = int(request.query.get("maxResults", 100))
+        start = int(request.query.get("pageToken", 0))
+        result = {
+            "messages": [
+                {"id": message_id, "threadId": message_id}
+                for message_id in ids[start : start + page_size]
+            ]
+        }
+        if start + page_size < len(ids):
+            result["nextPageToken"] = str(start + page_size)
+        return web.json_response(result)
+
+    async def __get_message(self, request: web.Request) -> web.Response:
+        message = self.wrapper.get_message(
+            MockGmailServer.__email(request), request.match_info["message_id"]
+        )
+        if message is None:
+            return web.json_response({"error": {"code": 404}}, status=404)
+        message = dict(message)
+        if request.query.get("format") != "raw":
+            message.pop("raw", None)
+        return web.json_response(message)
+
+    async def __insert_message(self, request: web.Request) -> web.Response:
+        reader = await request.multipart()
+        metadata = json.loads(await (await reader.next()).text())
+        raw = await (await reader.next()).read()
+        return web.json_response(
+            self.wrapper.insert_message(
+                MockGmailServer.__email(request),
+                {
+                    "labelIds": metadata.get("labelIds", []),
+                    "raw": encode_base64url(raw),
+                    "internalDate": "0",
+                    "snippet": "",
+                },
+            )
+        )
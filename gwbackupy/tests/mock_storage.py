@@ -4,7 +4,7 @@ import gzip
 import hashlib
 import io
 from datetime import datetime, timezone
-from typing import IO
+from typing import IO, Iterator
 
 from gwbackupy.storage.storage_interface import (
     StorageInterface,
@@ -18,11 +18,14 @@ from gwbackupy.storage.storage_interface import (
 class MockLink(LinkInterface):
     def __init__(self):
         self.__id: str | None = None
+        self.__extension: str | None = None
         self.__properties: dict[str, any] = {}
 
     def fill(self, data: dict[str, any]):
         if "id" in data:
             self.__id = data["id"]
+        if "extension" in data:
+            self.__extension = data["extension"]
         if "mutation" in data:
             self.__properties[LinkInterface.property_mutation] = data["mutation"]
 
@@ -38,6 +41,9 @@ class MockLink(LinkInterface):
     def id(self) -> str:
         return self.__id
 
+    def get_extension(self) -> str | None:
+        return self.__extension
+
     def get_properties(self) -> dict[str, any]:
         return self.__properties
 
@@ -95,7 +101,11 @@ class MockStorage(StorageInterface):
         created_timestamp: int | float | None = None,
     ) -> MockLink:
         link = MockLink()
-        data = {"id": object_id, "mutation": MockStorage.__gen_mutation()}
+        data = {
+            "id": object_id,
+            "extension": extension,
+            "mutation": MockStorage.__gen_mutation(),
+        }
         link.fill(data)
         return link
 
@@ -126,6 +136,12 @@ class MockStorage(StorageInterface):
             links.append(d.get("link"))
         return LinkList(links)
 
+    def iter_find(self, f: LinkFilter | None = None) -> Iterator[MockLink]:
+        for d in self.__objects:
+            link = d.get("link")
+            if f is None or f(link):
+                yield link
+
     def modify(self, link: MockLink, to_link: MockLink) -> bool:
         for d in self.__objects:
             if d.get("link") == link:
@@ -167,15 +183,13 @@ class MockStorage(StorageInterface):
             return data
         elif isinstance(data, str):
             return bytes(data, "utf-8")
-        elif isinstance(data, io.BufferedReader):
-            return data.read()
-        elif isinstance(data, io.BytesIO):
-            return data.read()
         elif callable(data):
             stream = io.BytesIO()
             data(stream)
             stream.seek(0)
             return stream.read()
+        elif hasattr(data, "read"):
+            return data.read()
         else:
             raise RuntimeError(f"Not supported data type: {type(data)}")
 
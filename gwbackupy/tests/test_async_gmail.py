@@ -0,0 +1,167 @@
+import asyncio
+import os
+import tempfile
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from gwbackupy.async_gmail import AsyncGmail
+from gwbackupy.filters.gmail_filter import GmailFilter
+from gwbackupy.gmail import Gmail
+from gwbackupy.helpers import random_string, encode_base64url
+from gwbackupy.object_codec import codec_of_extension
+from gwbackupy.providers.async_gmail_client import AsyncGmailClient
+from gwbackupy.storage.async_storage_interface import AsyncStorageAdapter
+from gwbackupy.storage.file_storage import FileStorage
+from gwbackupy.storage.storage_interface import LinkIndex
+from gwbackupy.tests.mock_gmail_server import MockGmailServer
+from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
+
+email = "example@example.com"
+
+
+def inject_messages(sw: MockGmailServiceWrapper, count: int) -> dict[str, bytes]:
+    messages = {}
+    for i in range(count):
+        message_id = random_string()
+        messages[message_id] = bytes(f"Subject: {i}\r\n\r\nBody {message_id}", "utf-8")
+        sw.inject_message(
+            email,
+            {
+                "id": message_id,
+                "raw": encode_base64url(messages[message_id]),
+                "internalDate": str(int(datetime.now().timestamp() * 1000)),
+                "labelIds": ["INBOX"],
+                "snippet": f"Body {i}",
+            },
+        )
+    return messages
+
+
+async def run_with_server(sw: MockGmailServiceWrapper, storage, fn, latency=0.0):
+    server = MockGmailServer(sw, latency=latency)
+    base_url = await server.start()
+    client = AsyncGmailClient(lambda e, refresh: e, base_url=base_url, try_sleep=0)
+    async_storage = AsyncStorageAdapter(storage)
+    try:
+        return await fn(server, client, async_storage)
+    finally:
+        await client.close()
+        await async_storage.close()
+        await server.stop()
+
+
+def test_backup_and_restore():
+    sw = MockGmailServiceWrapper()
+    sw.inject_label(email, "INBOX", "INBOX", "system")
+    messages = inject_messages(sw, 20)
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        storage = FileStorage(os.path.join(temproot, "gmail"))
+
+        async def backup(server, client, async_storage):
+            gmail = AsyncGmail(email, async_storage, client, max_in_flight=5)
+            assert await gmail.backup()
+
+        asyncio.run(run_with_server(sw, storage, backup))
+        index = LinkIndex.build(storage.iter_find())
+        for message_id, raw in messages.items():
+            assert index[message_id].metadata is not None
+            with storage.get(index[message_id].object) as f:
+                codec = codec_of_extension(index[message_id].object.get_extension())
+                assert codec().decompress(f) == raw
+        assert Gmail.object_id_labels in index
+
+        # deleted on server
+        deleted_id = next(iter(messages))
+        sw.inject_messages_clear()
+        for message_id in messages:
+            if message_id != deleted_id:
+                sw.inject_message(email, {"id": message_id, "internalDate": "0"})
+
+        async def restore(server, client, async_storage):
+            gmail = AsyncGmail(email, async_storage, client)
+            assert await gmail.backup()
+            item_filter = GmailFilter()
+            item_filter.with_match_deleted()
+            item_filter.with_match_missing()
+            assert await gmail.restore(item_filter, add_labels=["restored"])
+
+        asyncio.run(run_with_server(sw, storage, restore))
+        index = LinkIndex.build(storage.iter_find())
+        assert index[deleted_id].metadata.is_deleted()
+        restored = [m for m in sw.get_messages(email, q="all").values() if "raw" in m]
+        assert len(restored) == 1
+        assert restored[0]["raw"] == encode_base64url(messages[deleted_id])
+        label_names = {l["id"]: l["name"] for l in sw.get_labels(email)}
+        assert sorted(label_names[i] for i in restored[0]["labelIds"]) == [
+            "INBOX",
+            "restored",
+        ]
+
+
+def test_backup_is_readable_by_thread_engine():
+    sw = MockGmailServiceWrapper()
+    to_email = "example-to@example.com"
+    sw.inject_label(email, "INBOX", "INBOX", "system")
+    sw.inject_label(to_email, "INBOX", "INBOX", "system")
+    messages = inject_messages(sw, 3)
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        storage = FileStorage(os.path.join(temproot, "gmail"))
+
+        async def backup(server, client, async_storage):
+            assert await AsyncGmail(email, async_storage, client).backup()
+
+        asyncio.run(run_with_server(sw, storage, backup))
+        sw.inject_messages_clear()
+        item_filter = GmailFilter()
+        item_filter.with_match_missing()
+        gmail = Gmail(email=email, storage=storage, service_wrapper=sw)
+        assert gmail.restore(item_filter, to_email=to_email, add_labels=[])
+        restored = sorted(m["raw"] for m in sw.get_messages(to_email, q="all").values())
+        assert restored == sorted(encode_base64url(raw) for raw in messages.values())
+
+
+def test_max_in_flight():
+    sw = MockGmailServiceWrapper()
+    inject_messages(sw, 40)
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        storage = FileStorage(os.path.join(temproot, "gmail"))
+
+        async def backup(server, client, async_storage):
+            gmail = AsyncGmail(email, async_storage, client, max_in_flight=8)
+            assert await gmail.backup()
+            return server.max_in_flight
+
+        max_in_flight = asyncio.run(run_with_server(sw, storage, backup, latency=0.02))
+        # concurrent, but bounded
+        assert 1 < max_in_flight <= 8
+
+
+def test_token_refresh_on_unauthorized():
+    sw = MockGmailServiceWrapper()
+    sw.inject_label(email, "INBOX", "INBOX", "system")
+    refreshes = []
+
+    def token_provider(e: str, refresh: bool) -> str:
+        refreshes.append(refresh)
+        # the cached token is revoked on the server
+        return e if refresh else "revoked"
+
+    async def run():
+        server = MockGmailServer(sw)
+        server.rejected_tokens.add("revoked")
+        client = AsyncGmailClient(
+            token_provider, base_url=await server.start(), try_sleep=0
+        )
+        try:
+            labels = await client.get_labels(email)
+            assert [l["id"] for l in labels] == ["INBOX"]
+            await client.get_labels(email)
+        finally:
+            await client.close()
+            await server.stop()
+
+    asyncio.run(run())
+    assert refreshes == [False, True]
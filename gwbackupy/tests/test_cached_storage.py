@@ -0,0 +1,177 @@
+import io
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from gwbackupy.filters.gmail_filter import GmailFilter
+from gwbackupy.gmail import Gmail
+from gwbackupy.helpers import random_string, encode_base64url
+from gwbackupy.storage.cached_storage import CachedStorage
+from gwbackupy.storage.file_storage import FileStorage, FileLink
+from gwbackupy.storage.storage_interface import LinkInterface
+from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
+
+
+class UnseekableStream(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self.f.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class CountingFileStorage(FileStorage):
+    def __init__(self, root: str):
+        super().__init__(root)
+        self.gets = 0
+        self.seekable = True
+
+    def get(self, link: FileLink):
+        self.gets += 1
+        f = super().get(link)
+        if not self.seekable:
+            return io.BufferedReader(UnseekableStream(f))
+        return f
+
+
+def test_write_through_and_read_cache():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        primary = CountingFileStorage(os.path.join(temproot, "primary"))
+        cs = CachedStorage(primary, os.path.join(temproot, "cache"))
+        link = cs.new_link("testid", "json", time.time()).set_properties(
+            {LinkInterface.property_metadata: True}
+        )
+        assert cs.put(link, '{"a": 1}')
+        # written through
+        with primary.get(link) as f:
+            assert f.read() == b'{"a": 1}'
+        primary.gets = 0
+        with cs.get(link) as f:
+            assert f.read() == b'{"a": 1}'
+        assert primary.gets == 0
+
+        # streams are cached on the first read
+        link2 = cs.new_link("testid", "eml.gz").set_properties(
+            {LinkInterface.property_object: True}
+        )
+        assert cs.put(link2, io.BytesIO(b"object"))
+        for _ in range(3):
+            with cs.get(link2) as f:
+                assert f.read() == b"object"
+        assert primary.gets == 1
+        assert cs.hits == 3 and cs.misses == 1
+
+        # modify moves the cached item
+        link3 = cs.content_hash_add(link2)
+        assert cs.content_hash_check(link3)
+        assert primary.gets == 1
+        assert len(cs.find()) == 2
+
+        # reopen, the cache is persistent
+        primary = CountingFileStorage(os.path.join(temproot, "primary"))
+        cs = CachedStorage(primary, os.path.join(temproot, "cache"))
+        with cs.get(link3) as f:
+            assert f.read() == b"object"
+        assert primary.gets == 0
+        assert cs.remove(link3, as_new_mutation=False)
+        assert len(cs.find()) == 1
+
+
+def test_put_many_and_remove_many():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        primary = CountingFileStorage(os.path.join(temproot, "primary"))
+        cs = CachedStorage(primary, os.path.join(temproot, "cache"))
+        links = [cs.new_link(f"id{i}", "json", time.time()) for i in range(3)]
+        assert cs.put_many([(l, f"data{l.id()}") for l in links]) == [True] * 3
+        for link in links:
+            with cs.get(link) as f:
+                assert f.read() == bytes(f"data{link.id()}", "utf-8")
+        assert primary.gets == 0
+        assert cs.remove_many(links, as_new_mutation=False) == [True] * 3
+        assert len(cs.find()) == 0
+        assert cs.hits == 3 and cs.misses == 0
+
+
+def test_lru_eviction():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        primary = CountingFileStorage(os.path.join(temproot, "primary"))
+        cs = CachedStorage(
+            primary, os.path.join(temproot, "cache"), max_size=250, max_item_size=100
+        )
+        links = []
+        for i in range(3):
+            link = cs.new_link(f"id{i}", "json")
+            assert cs.put(link, bytes([i]) * 100)
+            links.append(link)
+        # the first one is evicted
+        with cs.get(links[0]) as f:
+            assert f.read() == bytes([0]) * 100
+        assert primary.gets == 1
+        # the second one is evicted, it was the least recently used
+        with cs.get(links[2]) as f:
+            assert f.read() == bytes([2]) * 100
+        assert primary.gets == 1
+        with cs.get(links[1]) as f:
+            assert f.read() == bytes([1]) * 100
+        assert primary.gets == 2
+
+        # too large for the cache, the size is checked before the read
+        large = cs.new_link("large", "json")
+        assert cs.put(large, bytes(range(250)) * 4)
+        with cs.get(large) as f:
+            assert f.read() == bytes(range(250)) * 4
+        assert primary.gets == 3
+        assert cs.misses == 3
+
+        # the size is unknown, the primary storage is read once
+        primary.seekable = False
+        with cs.get(large) as f:
+            assert f.read(10) == bytes(range(10))
+            assert f.read() == bytes(range(10, 250)) + bytes(range(250)) * 3
+        assert primary.gets == 4
+        small = cs.new_link("small", "json")
+        assert primary.put(small, b"small")
+        with cs.get(small) as f:
+            assert f.read() == b"small"
+        with cs.get(small) as f:
+            assert f.read() == b"small"
+        assert primary.gets == 5
+
+
+def test_gmail_backup_restore():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        primary = CountingFileStorage(os.path.join(temproot, "primary"))
+        cs = CachedStorage(primary, os.path.join(temproot, "cache"))
+        sw = MockGmailServiceWrapper()
+        email = "example@example.com"
+        message_raw = bytes(f"Message body... {random_string()}", "utf-8")
+        sw.inject_message(
+            email,
+            {
+                "id": random_string(),
+                "raw": encode_base64url(message_raw),
+                "internalDate": str(int(datetime.now().timestamp() * 1000)),
+                "snippet": "A short snippet",
+            },
+        )
+        gmail = Gmail(email=email, storage=cs, service_wrapper=sw)
+        assert gmail.backup()
+        assert gmail.backup()
+        sw.inject_messages_clear()
+        sw.inject_labels_clear()
+        filtr = GmailFilter()
+        filtr.with_match_missing()
+        assert gmail.restore(filtr, add_labels=[], to_email="to@example.com")
+        restored = list(sw.get_messages("to@example.com", q="all").values())
+        assert restored[0]["raw"] == encode_base64url(message_raw)
+        assert primary.gets == 0
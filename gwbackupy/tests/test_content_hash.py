@@ -0,0 +1,72 @@
+import gzip
+import io
+import tempfile
+
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.file_storage import FileStorage
+from gwbackupy.storage.storage_interface import LinkInterface
+from gwbackupy.tests.helpers import get_exception
+
+
+def test_generate():
+    assert content_hash.generate("a1234") == "m828c88f34ecb4c1ca8d89e018c6fad1a"
+    assert content_hash.generate(b"a1234", "md5") == "m828c88f34ecb4c1ca8d89e018c6fad1a"
+    assert content_hash.generate("a1234", "blake2b").startswith("b")
+    assert len(content_hash.generate("a1234", "blake2b")) == 65
+    assert (
+        content_hash.generate("a1234", "sha256")
+        == "s3e0a3501a65b4a7bf889c6f180cc6e35747e5aaff931cc90b760671efa09aeac"
+    )
+    e = get_exception(lambda: content_hash.generate("a1234", "crc"))
+    assert isinstance(e, ValueError)
+    e = get_exception(lambda: content_hash.generate({}))
+    assert isinstance(e, NotImplementedError)
+
+
+def test_generate_chunked_stream():
+    data = bytes(range(256)) * 10000
+    original_chunk_size = content_hash.chunk_size
+    content_hash.chunk_size = 1000
+    try:
+        for algorithm in content_hash.content_hash_prefixes:
+            expected = content_hash.generate(data, algorithm)
+            assert content_hash.generate(io.BytesIO(data), algorithm) == expected
+            with gzip.GzipFile(
+                fileobj=io.BytesIO(gzip.compress(data)), mode="rb"
+            ) as gf:
+                assert content_hash.generate(gf, algorithm) == expected
+    finally:
+        content_hash.chunk_size = original_chunk_size
+
+
+def test_algorithm_of_and_eq():
+    for algorithm, prefix in content_hash.content_hash_prefixes.items():
+        h = content_hash.generate("a1234", algorithm)
+        assert content_hash.algorithm_of(h) == algorithm
+        assert content_hash.eq(h, "a1234")
+        assert not content_hash.eq(h, "a12345")
+    assert content_hash.algorithm_of("x1234") is None
+    assert not content_hash.eq("x1234", "a1234")
+
+
+def test_file_storage_algorithm():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        e = get_exception(lambda: FileStorage(temproot, content_hash_algorithm="crc"))
+        assert isinstance(e, ValueError)
+        fs_md5 = FileStorage(root=temproot)
+        link = fs_md5.new_link("test", "ext")
+        fs_md5.put(link, "a1234")
+        link_md5 = fs_md5.content_hash_add(link)
+        assert link_md5.get_property(LinkInterface.property_content_hash).startswith(
+            "m"
+        )
+
+        fs = FileStorage(root=temproot, content_hash_algorithm="blake2b")
+        link2 = fs.new_link("test2", "ext")
+        fs.put(link2, "a1234")
+        link2 = fs.content_hash_add(link2)
+        assert link2.get_property(LinkInterface.property_content_hash).startswith("b")
+        assert fs.content_hash_check(link2) is True
+        # previously stored md5 hashes stay verifiable
+        assert fs.content_hash_check(link_md5) is True
+        assert fs.content_hash_eq(link_md5, io.BytesIO(b"a1234"))
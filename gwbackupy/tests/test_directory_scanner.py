@@ -0,0 +1,62 @@
+import os
+import tempfile
+
+from gwbackupy.storage.directory_scanner import DirectoryScanner
+
+
+def __create_tree(root: str):
+    for year in ["2022", "2023"]:
+        for day in ["01-01", "01-02", "12-31"]:
+            path = os.path.join(root, year, day)
+            os.makedirs(path)
+            for i in range(3):
+                with open(os.path.join(path, f"{year}{day}-{i}.json"), "w") as f:
+                    f.write("a")
+    with open(os.path.join(root, "root.json"), "w") as f:
+        f.write("a")
+    os.makedirs(os.path.join(root, ".skip"))
+    with open(os.path.join(root, ".skip", "skipped.json"), "w") as f:
+        f.write("a")
+
+
+def __walk(root: str, skip_dir: str) -> list[tuple[str, list[str]]]:
+    result = []
+    for path, dirnames, filenames in os.walk(root):
+        if skip_dir in dirnames:
+            dirnames.remove(skip_dir)
+        result.append((path, sorted(filenames)))
+    result.sort(key=lambda r: r[0])
+    return result
+
+
+def test_scan():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        __create_tree(temproot)
+        expected = __walk(temproot, ".skip")
+        for workers in [1, 4]:
+            scanner = DirectoryScanner(
+                temproot,
+                lambda path, filenames: sorted(filenames),
+                workers=workers,
+                skip_dirs=[".skip"],
+            )
+            result = scanner.scan()
+            assert result == expected
+            assert result[0] == (temproot, ["root.json"])
+
+
+def test_scan_not_exists():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        root = os.path.join(temproot, "not-exists")
+        scanner = DirectoryScanner(root, lambda path, filenames: len(filenames))
+        assert scanner.scan() == [(root, 0)]
+
+
+def test_scan_symlink_not_followed():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        __create_tree(temproot)
+        os.symlink(os.path.join(temproot, "2022"), os.path.join(temproot, "link"))
+        scanner = DirectoryScanner(temproot, lambda path, filenames: filenames)
+        paths = [path for path, _ in scanner.scan()]
+        assert os.path.join(temproot, "link") not in paths
+        assert os.path.join(temproot, "2022") in paths
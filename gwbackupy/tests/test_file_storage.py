@@ -1,10 +1,17 @@
 import datetime
+import io
 import os
 import tempfile
 import time
+from unittest import mock
+
+import pytest
 from os.path import exists
 
+from gwbackupy.storage import content_hash
+from gwbackupy.storage.file_link_index import FileLinkIndex
 from gwbackupy.storage.file_storage import FileStorage, FileLink
+from gwbackupy.storage.file_syncer import FileSyncer
 from gwbackupy.storage.storage_interface import LinkInterface
 
 
@@ -192,13 +199,13 @@ def test_find_with_tempfile():
     with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
         fs = FileStorage(root=temproot)
 
-        # tempfile remove test
+        # find is read only, the temporary file is kept
         tmp = os.path.join(temproot, "any.tmp")
         with open(tmp, "w") as f:
             f.write("a")
         links = fs.find()
         assert len(links) == 0
-        assert not exists(tmp)
+        assert exists(tmp)
 
         # tempfile remove fail test, work only in windows???
         # tmp2 = os.path.join(temproot, "any2.tmp")
@@ -421,3 +428,608 @@ def test_file_link_unescape():
     assert FileLink.unescape("a%255c%252f%5ca") == "a%5c%2f\\a"
     assert FileLink.unescape("a%3da") == "a=a"
     assert FileLink.unescape("a%2ea") == "a.a"
+
+
+def test_index_find():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        assert len(fs.find()) == 0
+        assert fs.index.exists()
+        link = fs.new_link("test", "ext", datetime.datetime.now().timestamp())
+        assert fs.put(link, "data")
+        link2 = fs.new_link("test2", "ext")
+        assert fs.put(link2, "data2")
+        time.sleep(0.002)
+        assert fs.remove(link2)
+        link3 = fs.new_link("test3", "ext")
+        assert fs.modify(link, link3)
+        assert fs.index.load() is not None
+        links = fs.find()
+        assert len(links) == 3
+        assert link3 in links
+        assert link2 in links
+        assert link not in links
+        links_scanned = FileStorage(root=temproot, use_index=False).find()
+        assert len(links_scanned) == len(links)
+        for link_scanned in links_scanned:
+            assert link_scanned in links
+
+
+def test_index_not_used():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot, use_index=False)
+        link = fs.new_link("test", "ext")
+        assert fs.put(link, "data")
+        assert len(fs.find()) == 1
+        assert not exists(os.path.join(temproot, FileLinkIndex.directory_name))
+
+
+def test_index_rebuild_if_inconsistent():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        link = fs.new_link("test", "ext", datetime.datetime.now().timestamp())
+        assert fs.put(link, "data")
+        assert len(fs.find()) == 1
+
+        # removed without index
+        os.remove(link.get_file_path())
+        assert fs.index.load() is None
+        assert len(fs.find()) == 0
+
+        # added without index into a new directory
+        fs_without_index = FileStorage(root=temproot, use_index=False)
+        link2 = fs_without_index.new_link("test2", "ext", 86400 * 365)
+        assert fs_without_index.put(link2, "data")
+        assert fs.index.load() is None
+        assert fs.find() == [link2]
+
+        # added without index into the root
+        link3 = fs_without_index.new_link("test3", "ext")
+        assert fs_without_index.put(link3, "data")
+        assert fs.index.load() is None
+        assert len(fs.find()) == 2
+
+        # interrupted write
+        shard = os.path.join(fs.index.path, f"{FileLinkIndex.shard_of('test3')}.log")
+        with open(shard, "a") as f:
+            f.write("+test3.mutation=1")
+        assert fs.index.load() is None
+        assert len(fs.find()) == 2
+        assert fs.index.load() is not None
+
+
+def test_index_rebuild_if_day_directory_modified():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        now = time.time()
+        link = fs.new_link("test", "ext", now)
+        assert fs.put(link, "data")
+        assert len(fs.find()) == 1
+        link2 = fs.new_link("test2", "ext", now)
+        assert fs.put(link2, "data")
+        # changed by this process, loaded without flush
+        assert fs.index.load() is not None
+        assert fs.flush()
+        assert FileStorage(root=temproot).index.load() is not None
+
+        # added and removed without index in an existing day directory
+        time.sleep(0.05)
+        fs_without_index = FileStorage(root=temproot, use_index=False)
+        link3 = fs_without_index.new_link("test3", "ext", now)
+        assert fs_without_index.put(link3, "data")
+        fs = FileStorage(root=temproot)
+        assert fs.index.load() is None
+        assert sorted(l.id() for l in fs.find()) == ["test", "test2", "test3"]
+        assert fs.index.load() is not None
+        time.sleep(0.05)
+        os.remove(link.get_file_path())
+        fs = FileStorage(root=temproot)
+        assert fs.index.load() is None
+        assert sorted(l.id() for l in fs.find()) == ["test2", "test3"]
+
+
+def test_get_versions_with_files_written_without_index():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        ts = datetime.datetime(2023, 3, 1).timestamp()
+        assert fs.put(fs.new_link("test", "json", ts), "data")
+        assert fs.put(fs.new_link("token", "json"), "data")
+        assert fs.flush()
+        assert len(fs.get_versions("test")) == 1
+        assert len(fs.get_versions("token")) == 1
+
+        fs_without_index = FileStorage(root=temproot, use_index=False)
+        time.sleep(0.05)
+        # in a directory of the shard records
+        link = fs_without_index.new_link("test", "json", ts).set_properties(
+            {"mutation": "1"}
+        )
+        assert fs_without_index.put(link, "data")
+        assert len(fs.get_versions("test")) == 2
+        # in the root
+        link = fs_without_index.new_link("token", "json").set_properties(
+            {"mutation": "1"}
+        )
+        assert fs_without_index.put(link, "data")
+        assert len(fs.get_versions("token")) == 2
+        assert fs.flush()
+
+        # in a new directory, checked on the first lookup
+        time.sleep(0.05)
+        ts2 = datetime.datetime(2024, 5, 1).timestamp()
+        assert fs_without_index.put(fs_without_index.new_link("test", "json", ts2), "")
+        fs = FileStorage(root=temproot)
+        assert len(fs.get_versions("test")) == 3
+
+
+def test_index_rebuild():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        link = fs.new_link("test", "ext")
+        assert fs.put(link, "data")
+        assert not fs.index.exists()
+        fs.rebuild_index()
+        assert fs.index.exists()
+        assert fs.index.load() == [os.path.basename(link.get_file_path())]
+
+
+def test_iter_find():
+    for use_index in [True, False]:
+        with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+            fs = FileStorage(root=temproot, use_index=use_index)
+            link = fs.new_link("test", "ext", datetime.datetime.now().timestamp())
+            assert fs.put(link, "data")
+            link2 = fs.new_link("test2", "ext")
+            assert fs.put(link2, "data")
+            it = fs.iter_find(f=lambda l: l.id() == "test2")
+            assert not isinstance(it, list)
+            assert list(it) == [link2]
+            assert len(list(fs.iter_find())) == len(fs.find())
+
+
+def test_link_clone():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        link = fs.new_link("test", "ext", datetime.datetime.now().timestamp())
+        link.set_properties({LinkInterface.property_object: True, "my": "value"})
+        clone = link.clone()
+        assert clone == link
+        assert clone is not link
+        assert clone.get_file_path() == link.get_file_path()
+        clone.set_properties({LinkInterface.property_deleted: True, "my": None})
+        assert clone.is_deleted()
+        assert clone.get_property("my") is None
+        assert not link.is_deleted()
+        assert link.get_property("my") == "value"
+        assert not hasattr(link, "__dict__")
+
+
+def test_link_properties_roundtrip():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        link = fs.new_link("test", "ext")
+        link.set_properties(
+            {
+                LinkInterface.property_metadata: True,
+                LinkInterface.property_content_hash: "m1234",
+                "my": "value",
+            }
+        )
+        assert link.is_metadata()
+        assert not link.is_deleted()
+        assert fs.put(link, "data")
+        links = fs.find()
+        assert links == [link]
+        assert links[0].get_properties() == link.get_properties()
+        link.set_properties({LinkInterface.property_content_hash: None})
+        assert LinkInterface.property_content_hash not in link.get_properties()
+
+
+def test_link_put_stream():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        data = bytes(range(256)) * 4096
+        stream = io.BytesIO(data)
+        link = fs.new_link("testid", "bin")
+        assert fs.put(link, stream)
+        assert stream.closed
+        with fs.get(link) as f:
+            assert f.read() == data
+
+        class ReadOnly:
+            def __init__(self, b: bytes):
+                self.stream = io.BytesIO(b)
+                self.closed = False
+
+            def read(self, size: int = -1) -> bytes:
+                return self.stream.read(size)
+
+            def close(self):
+                self.closed = True
+
+        link2 = fs.new_link("testid2", "bin")
+        assert fs.put(link2, ReadOnly(data))
+        with fs.get(link2) as f:
+            assert f.read() == data
+
+
+def test_link_put_file_from_offset():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        data = bytes(range(256)) * 4096
+        link = fs.new_link("testid", "bin")
+        assert fs.put(link, data)
+        link2 = fs.new_link("testid2", "bin")
+        f = fs.get(link)
+        f.read(1000)
+        assert fs.put(link2, f)
+        with fs.get(link2) as f2:
+            assert f2.read() == data[1000:]
+
+
+def test_copy_stream_fallback():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        data = bytes(range(256)) * 4096
+        src_path = os.path.join(temproot, "src")
+        with open(src_path, "wb") as f:
+            f.write(data)
+        for dst in [io.BytesIO(), open(os.path.join(temproot, "dst"), "w+b")]:
+            with dst, open(src_path, "rb") as src:
+                dst.write(b"head")
+                FileStorage.copy_stream(src, dst)
+                dst.seek(0)
+                assert dst.read() == b"head" + data
+
+
+def test_copy_stream_kernel():
+    copy_function = next(
+        (name for name in ["copy_file_range", "sendfile"] if hasattr(os, name)), None
+    )
+    if copy_function is None:
+        pytest.skip("no kernel space copy")
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        data = bytes(range(256)) * 4096
+        src_path = os.path.join(temproot, "src")
+        dst_path = os.path.join(temproot, "dst")
+        with open(src_path, "wb") as f:
+            f.write(data)
+        with mock.patch(
+            f"os.{copy_function}", wraps=getattr(os, copy_function)
+        ) as copy:
+            with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+                # from the current position of the source, after the buffered data of the destination
+                src.read(1000)
+                dst.write(b"head")
+                FileStorage.copy_stream(src, dst)
+                assert src.tell() == len(data)
+                assert src.read() == b""
+                dst.write(b"tail")
+            assert copy.call_count > 0
+        with open(dst_path, "rb") as f:
+            assert f.read() == b"head" + data[1000:] + b"tail"
+
+
+def test_remove_as_new_mutation_tombstone_mode():
+    for mode in FileStorage.tombstone_modes:
+        with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+            fs = FileStorage(root=temproot, tombstone_mode=mode)
+            data = bytes(range(256)) * 16
+            # an older mutation, the tombstone can be created in the same millisecond
+            link = fs.new_link("testid", "bin", time.time()).set_properties(
+                {"mutation": "1000"}
+            )
+            assert fs.put(link, data)
+            assert fs.remove(link, as_new_mutation=True)
+            links = fs.find()
+            assert len(links) == 2
+            deleted = [l for l in links if l.is_deleted()]
+            assert len(deleted) == 1
+            assert deleted[0].mutation() != link.mutation()
+            assert deleted[0].get_file_path() != link.get_file_path()
+            with fs.get(deleted[0]) as f:
+                assert f.read() == data
+            if mode == FileStorage.tombstone_mode_hardlink:
+                assert (
+                    os.stat(deleted[0].get_file_path()).st_ino
+                    == os.stat(link.get_file_path()).st_ino
+                )
+            links = FileStorage(root=temproot, use_index=False).find()
+            assert len(links) == 2
+
+
+def test_invalid_tombstone_mode():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        with pytest.raises(ValueError):
+            FileStorage(root=temproot, tombstone_mode="rename")
+
+
+def test_durability():
+    for durability in FileStorage.durabilities:
+        with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+            fs = FileStorage(root=temproot, durability=durability)
+            link = fs.new_link("testid", "bin", time.time())
+            assert fs.put(link, b"test")
+            link2 = link.clone().set_properties({"custom": "x"})
+            assert fs.modify(link, link2)
+            assert fs.remove(link2)
+            assert fs.flush()
+            links = fs.find()
+            assert len(links) == 2
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        with pytest.raises(ValueError):
+            FileStorage(root=temproot, durability="always")
+
+
+def test_prepare():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        day = 24 * 3600
+        start = datetime.datetime(2022, 12, 30, 12, tzinfo=datetime.timezone.utc)
+        assert fs.prepare(start.timestamp(), start.timestamp() + 3 * day)
+        for path in ["2022/12-30", "2022/12-31", "2023/01-01", "2023/01-02"]:
+            assert os.path.isdir(os.path.join(temproot, path))
+        assert not exists(os.path.join(temproot, "2023/01-03"))
+        link = fs.new_link("testid", "bin", start.timestamp() + day)
+        assert fs.put(link, b"test")
+        assert len(fs.find()) == 1
+
+
+def test_prepare_keeps_index():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        link = fs.new_link("testid", "bin", time.time())
+        assert fs.put(link, b"test")
+        assert len(fs.find()) == 1
+        now = time.time()
+        assert fs.prepare(now - 400 * 24 * 3600, now + 24 * 3600)
+        assert fs.flush()
+        # the empty prepared directories are known by the reloaded index
+        assert FileStorage(root=temproot).index.load() == [
+            os.path.relpath(link.get_file_path(), temproot).replace(os.sep, "/")
+        ]
+
+
+def test_known_dir_removed():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot, use_index=False)
+        now = time.time()
+        link = fs.new_link("testid", "bin", now)
+        assert fs.put(link, b"test")
+        os.remove(link.get_file_path())
+        os.rmdir(os.path.dirname(link.get_file_path()))
+        link = fs.new_link("testid2", "bin", now)
+        assert fs.put(link, b"test")
+        assert len(fs.find()) == 1
+
+
+def test_sweep_temporary_files():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        os.makedirs(os.path.join(temproot, "2022", "01-01"))
+        old_tmp = os.path.join(temproot, "2022", "01-01", "old.m=1.bin.tmp")
+        new_tmp = os.path.join(temproot, "new.m=2.bin.tmp")
+        for path in [old_tmp, new_tmp]:
+            with open(path, "w") as f:
+                f.write("a")
+        old = time.time() - 7200
+        os.utime(old_tmp, (old, old))
+        assert fs.sweep_temporary_files(grace_period=3600) == 1
+        assert not exists(old_tmp)
+        assert exists(new_tmp)
+        fs.start_sweeper(grace_period=0).join()
+        assert not exists(new_tmp)
+
+
+def test_object_pool():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        pool = os.path.join(temproot, "objects")
+        with pytest.raises(ValueError):
+            FileStorage(root=os.path.join(temproot, "a"), object_pool=pool)
+        fs1 = FileStorage(
+            root=os.path.join(temproot, "a"),
+            object_pool=pool,
+            content_hash_algorithm="sha256",
+        )
+        fs2 = FileStorage(
+            root=os.path.join(temproot, "b"),
+            object_pool=pool,
+            content_hash_algorithm="blake2b",
+        )
+        data = bytes(range(256)) * 16
+        ch = fs1.content_hash_generate(data)
+        calls = []
+
+        def write(f):
+            calls.append(True)
+            f.write(data)
+
+        links = []
+        for fs in [fs1, fs2]:
+            link = fs.new_link("testid", "eml.gz", time.time()).set_properties(
+                {"object": True, "ch": ch}
+            )
+            assert fs.put(link, write)
+            links.append(link)
+            with fs.get(link) as f:
+                assert f.read() == data
+        # the second account is linked, the writer is not called
+        assert len(calls) == 1
+        pool_path = os.path.join(pool, ch[-2:], f"{ch}.eml.gz")
+        assert os.stat(pool_path).st_nlink == 3
+        assert os.stat(links[0].get_file_path()).st_ino == os.stat(pool_path).st_ino
+
+        # links with md5 content hash (e.g. of an older backup) are not pooled
+        link = fs1.new_link("testid3", "eml.gz").set_properties(
+            {"object": True, "ch": content_hash.generate(data, "md5")}
+        )
+        assert fs1.put(link, data)
+        assert os.stat(link.get_file_path()).st_nlink == 1
+
+        # links without content hash are not pooled
+        link = fs1.new_link("testid2", "json").set_properties({"metadata": True})
+        assert fs1.put(link, b"{}")
+        assert os.stat(link.get_file_path()).st_nlink == 1
+
+        assert fs1.gc_object_pool(grace_period=0) == 0
+        assert fs1.remove(links[0], as_new_mutation=False)
+        assert fs2.remove(links[1], as_new_mutation=False)
+        assert fs1.gc_object_pool(grace_period=3600) == 0
+        assert fs1.gc_object_pool(grace_period=0) == 1
+        assert not exists(pool_path)
+
+
+def test_put_many_get_many():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        ts = datetime.datetime(2023, 3, 1).timestamp()
+        links = [
+            fs.new_link(f"id{i}", "json", ts + (i % 3) * 86400).set_properties(
+                {LinkInterface.property_metadata: True}
+            )
+            for i in range(10)
+        ]
+        items = [(link, f"data{i}") for i, link in enumerate(links)]
+        items.append((fs.new_link("cb", "eml", ts), lambda f: f.write(b"callback")))
+        items.append((fs.new_link("bad", "json", ts), 1))
+        assert fs.put_many(items) == [True] * 11 + [False]
+        streams = fs.get_many(links)
+        for i, stream in enumerate(streams):
+            with stream:
+                assert stream.read() == bytes(f"data{i}", "utf-8")
+        with fs.get_many([items[10][0]])[0] as f:
+            assert f.read() == b"callback"
+        # the index is maintained, no temporary files are left
+        fs2 = FileStorage(root=temproot)
+        assert sorted(l.id() for l in fs2.find()) == sorted(
+            [f"id{i}" for i in range(10)] + ["cb"]
+        )
+        assert fs2.sweep_temporary_files(grace_period=0) == 0
+        with pytest.raises(FileNotFoundError):
+            fs.get_many([links[0], fs.new_link("missing", "json", ts)])
+
+
+def test_remove_many():
+    for mode in FileStorage.tombstone_modes:
+        with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+            fs = FileStorage(root=temproot, tombstone_mode=mode)
+            ts = datetime.datetime(2023, 3, 1).timestamp()
+            links = [fs.new_link(f"id{i}", "eml", ts + i * 86400) for i in range(5)]
+            assert all(fs.put_many([(l, f"data{l.id()}") for l in links]))
+            time.sleep(0.002)
+            assert fs.remove_many(links) == [True] * 5
+            found = fs.find()
+            assert len(found) == 10
+            for link in found:
+                if link.is_deleted():
+                    with fs.get(link) as f:
+                        assert f.read() == bytes(f"data{link.id()}", "utf-8")
+            missing = fs.new_link("missing", "eml", ts)
+            assert (
+                fs.remove_many(links + [missing], as_new_mutation=False) == [True] * 6
+            )
+            assert sorted(l.id() for l in FileStorage(root=temproot).find()) == [
+                f"id{i}" for i in range(5)
+            ]
+
+
+def test_put_many_sync_failure(monkeypatch):
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot, durability=FileStorage.durability_file)
+        ts = datetime.datetime(2023, 3, 1).timestamp()
+        assert fs.put(fs.new_link("existing", "json", ts), b"{}")
+        monkeypatch.setattr(FileSyncer, "fsync_dir", staticmethod(lambda path: False))
+        links = [fs.new_link(f"id{i}", "json", ts) for i in range(2)]
+        # written and indexed, the sync failure is reported by flush()
+        assert fs.put_many([(l, b"{}") for l in links]) == [True, True]
+        assert fs.put(fs.new_link("single", "json", ts), b"{}")
+        assert not fs.flush()
+        assert fs.flush()
+        assert len(fs.get_versions("id1")) == 1
+        assert len(fs.get_versions("single")) == 1
+
+
+def test_put_many_open_failure_closes_fd(monkeypatch):
+    if not os.path.isdir("/proc/self/fd"):
+        pytest.skip("no /proc/self/fd")
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        ts = datetime.datetime(2023, 3, 1).timestamp()
+        assert fs.put(fs.new_link("existing", "json", ts), b"{}")
+
+        def failing_open(file, *args, **kwargs):
+            if isinstance(file, int):
+                raise OSError("open fail")
+            return open(file, *args, **kwargs)
+
+        fds = len(os.listdir("/proc/self/fd"))
+        monkeypatch.setattr(
+            "gwbackupy.storage.file_storage.open", failing_open, raising=False
+        )
+        links = [fs.new_link(f"id{i}", "json", ts) for i in range(3)]
+        assert fs.put_many([(l, b"{}") for l in links]) == [False] * 3
+        monkeypatch.undo()
+        assert len(os.listdir("/proc/self/fd")) == fds
+        assert [l.id() for l in fs.find()] == ["existing"]
+
+
+def test_put_many_metadata_segments():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot, metadata_segments=True)
+        ts = datetime.datetime(2023, 3, 1).timestamp()
+        meta = fs.new_link("id1", "json", ts).set_properties(
+            {LinkInterface.property_metadata: True}
+        )
+        obj = fs.new_link("id1", "eml", ts).set_properties(
+            {LinkInterface.property_object: True}
+        )
+        assert fs.put_many([(obj, b"object"), (meta, b"{}")]) == [True, True]
+        assert not os.path.exists(meta.get_file_path())
+        assert [f.read() for f in fs.get_many([meta, obj])] == [b"{}", b"object"]
+        assert fs.remove_many([meta, obj]) == [True, True]
+        deleted = [l for l in fs.find() if l.is_deleted()]
+        assert len(deleted) == 2
+        assert fs.remove_many(deleted + [meta], as_new_mutation=False) == [True] * 3
+        assert [l.id() for l in fs.find()] == ["id1"]
+
+
+def test_get_versions_and_latest(monkeypatch):
+    for metadata_segments in [False, True]:
+        with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+            fs = FileStorage(root=temproot, metadata_segments=metadata_segments)
+            ts = datetime.datetime(2023, 3, 1).timestamp()
+            for i in range(50):
+                link = fs.new_link(f"id{i}", "json", ts).set_properties(
+                    {LinkInterface.property_metadata: True}
+                )
+                assert fs.put(link, "{}")
+            meta = fs.new_link("id.1", "json", ts).set_properties(
+                {LinkInterface.property_metadata: True}
+            )
+            obj = fs.new_link("id.1", "eml", ts).set_properties(
+                {LinkInterface.property_object: True}
+            )
+            assert fs.put_many([(obj, b"object"), (meta, b"{}")]) == [True, True]
+            time.sleep(0.002)
+            assert fs.remove(meta)
+            assert len(fs.find()) == 53
+
+            # point lookup in a new instance, without loading the whole index
+            fs = FileStorage(root=temproot, metadata_segments=metadata_segments)
+            monkeypatch.setattr(FileLinkIndex, "load", lambda self: pytest.fail())
+            versions = fs.get_versions("id.1")
+            assert len(versions) == 3
+            assert versions[-1].is_deleted() and versions[-1].is_metadata()
+            latest = fs.get_latest("id.1")
+            assert latest.metadata.is_deleted()
+            assert latest.object == obj
+            assert fs.get_latest("id") is None
+            assert len(fs.get_versions("id1")) == 1
+            monkeypatch.undo()
+
+            # without index the storage is scanned
+            fs = FileStorage(
+                root=temproot, use_index=False, metadata_segments=metadata_segments
+            )
+            assert [l.mutation() for l in fs.get_versions("id.1")] == [
+                l.mutation() for l in versions
+            ]
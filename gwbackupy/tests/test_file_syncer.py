@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+from gwbackupy.storage.file_syncer import FileSyncer
+
+
+def test_flush_syncs_pending():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        syncer = FileSyncer(max_pending=1000, interval_ms=60000)
+        paths = []
+        for i in range(10):
+            path = os.path.join(temproot, f"file{i}")
+            with open(path, "wb") as f:
+                f.write(b"test")
+            paths.append(path)
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            for path in paths:
+                syncer.add(path, [temproot])
+            assert syncer.flush()
+            # 10 files and the directory once
+            assert fsync.call_count == 11
+            assert syncer.flush()
+            assert fsync.call_count == 11
+        assert syncer.close()
+
+
+def test_background_flush_by_batch_size():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        syncer = FileSyncer(max_pending=2, interval_ms=60000)
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            for i in range(2):
+                path = os.path.join(temproot, f"file{i}")
+                with open(path, "wb") as f:
+                    f.write(b"test")
+                syncer.add(path, [temproot])
+            # synced by the batch size, long before the interval and without close()
+            deadline = time.monotonic() + 10
+            while fsync.call_count < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert fsync.call_count == 3
+            assert syncer.close()
+            assert fsync.call_count == 3
+
+
+def test_missing_file_is_not_failure():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        syncer = FileSyncer()
+        syncer.add(os.path.join(temproot, "not-exists"), [temproot])
+        assert syncer.close()
+
+
+def test_fsync_failure():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        path = os.path.join(temproot, "file")
+        open(path, "wb").close()
+        syncer = FileSyncer(interval_ms=60000)
+        with mock.patch("os.fsync", side_effect=OSError("EIO")):
+            syncer.add(path, [])
+            assert not syncer.flush()
+        # failure is reported once
+        assert syncer.close()
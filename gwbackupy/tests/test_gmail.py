@@ -1,9 +1,13 @@
 import copy
 import gzip
+import json
 import logging
+import os
 import sys
+import time
 from datetime import datetime, timedelta
 import parametrize_from_file
+import pytest
 
 from typing import List, Dict
 
@@ -11,6 +15,10 @@ from gwbackupy import global_properties
 from gwbackupy.filters.gmail_filter import GmailFilter
 from gwbackupy.gmail import Gmail
 from gwbackupy.helpers import random_string, encode_base64url
+from gwbackupy.object_codec import GzipCodec
+from gwbackupy.storage.cached_storage import CachedStorage
+from gwbackupy.storage.file_storage import FileStorage
+from gwbackupy.storage.pack_storage import PackStorage
 from gwbackupy.storage.storage_interface import LinkInterface
 from gwbackupy.tests.mock_storage import MockStorage
 from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
@@ -356,3 +364,357 @@ if __name__ == "__main__":
         level=logging.DEBUG,
     )
     test_restore_with_label_recreate("example2@example.com", True)
+
+
+def test_backup_restore_zstd_dictionary():
+    pytest.importorskip("zstandard")
+    ms = MockStorage()
+    sw = MockGmailServiceWrapper()
+    email = "example@example.com"
+    to_email = "example-to@example.com"
+    raws = []
+
+    def inject(count: int):
+        for _ in range(count):
+            message_id = random_string()
+            message_raw = bytes(
+                f"From: sender@example.com\r\nTo: {email}\r\nSubject: Report {message_id}\r\n"
+                f"X-Mailer: gwbackupy-test\r\n\r\nMessage body... {message_id}\r\n",
+                "utf-8",
+            )
+            raws.append(encode_base64url(message_raw))
+            sw.inject_message(
+                email,
+                {
+                    "id": message_id,
+                    "raw": encode_base64url(message_raw),
+                    "internalDate": str(int(datetime.now().timestamp() * 1000)),
+                    "snippet": "A short snippet",
+                },
+            )
+
+    inject(200)
+    gmail = Gmail(
+        email=email,
+        storage=ms,
+        service_wrapper=sw,
+        object_codec="zstd",
+        zstd_dictionary=True,
+    )
+    assert gmail.backup()
+    dictionaries = list(
+        ms.iter_find(lambda l: l.id() == Gmail.object_id_zstd_dictionary)
+    )
+    assert len(dictionaries) == 1
+    objects = list(ms.iter_find(lambda l: l.is_object()))
+    assert len(objects) == 200
+    assert all(l.get_extension() == "eml.zst" for l in objects)
+
+    # compressed with the dictionary
+    inject(1)
+    assert gmail.backup()
+    assert (
+        len(list(ms.iter_find(lambda l: l.id() == Gmail.object_id_zstd_dictionary)))
+        == 1
+    )
+    assert len(list(ms.iter_find(lambda l: l.is_object()))) == 201
+
+    # restore selects the decoder by the extension, also with gzip codec
+    sw.inject_messages_clear()
+    sw.inject_labels_clear()
+    gmail = Gmail(email=email, storage=ms, service_wrapper=sw)
+    filtr = GmailFilter()
+    filtr.with_match_missing()
+    assert gmail.restore(filtr, add_labels=[], to_email=to_email)
+    restored = sw.get_messages(to_email, q="all")
+    assert len(restored) == 201
+    assert sorted(m["raw"] for m in restored.values()) == sorted(raws)
+
+
+def test_backup_object_pool_skips_compression(tmp_path, monkeypatch):
+    sw = MockGmailServiceWrapper()
+    message_raw = bytes("Message body... shared", "utf-8")
+    emails = ["example@example.com", "example2@example.com"]
+    for email in emails:
+        sw.inject_message(
+            email,
+            {
+                "id": random_string(),
+                "raw": encode_base64url(message_raw),
+                "internalDate": str(int(datetime.now().timestamp() * 1000)),
+            },
+        )
+    writes = []
+    writer = GzipCodec.writer
+
+    def counting_writer(self, data: bytes):
+        write = writer(self, data)
+
+        def counted(f):
+            writes.append(data)
+            write(f)
+
+        return counted
+
+    monkeypatch.setattr(GzipCodec, "writer", counting_writer)
+    storages = []
+    for email in emails:
+        storage = FileStorage(
+            str(tmp_path / email),
+            content_hash_algorithm="sha256",
+            object_pool=str(tmp_path / "pool"),
+        )
+        storages.append(storage)
+        gmail = Gmail(email=email, storage=storage, service_wrapper=sw)
+        assert gmail.backup()
+        # the message of the second account is in the pool already
+        assert len(writes) == 1
+    for storage in storages:
+        objects = [l for l in storage.find() if l.is_object()]
+        assert len(objects) == 1
+        with storage.get(objects[0]) as f:
+            assert gzip.decompress(f.read()) == message_raw
+
+
+def test_object_pool_with_zstd_dictionary(tmp_path):
+    storage = FileStorage(
+        str(tmp_path / "example"),
+        content_hash_algorithm="sha256",
+        object_pool=str(tmp_path / "pool"),
+    )
+    for s in [storage, CachedStorage(storage, str(tmp_path / "cache"))]:
+        with pytest.raises(ValueError):
+            Gmail(
+                email="example@example.com",
+                storage=s,
+                service_wrapper=MockGmailServiceWrapper(),
+                object_codec="zstd",
+                zstd_dictionary=True,
+            )
+    Gmail(
+        email="example@example.com",
+        storage=storage,
+        service_wrapper=MockGmailServiceWrapper(),
+        object_codec="zstd",
+    )
+
+
+def test_restore_message_stream(monkeypatch):
+    """Restore spools the decompressed message in chunks and uploads it as a stream"""
+
+    class StreamRecorder(MockGmailServiceWrapper):
+        def __init__(self):
+            super().__init__()
+            self.streams = []
+
+        def insert_message_stream(self, email, label_ids, message):
+            self.streams.append(message)
+            return super().insert_message_stream(email, label_ids, message)
+
+    monkeypatch.setattr(Gmail, "restore_spool_size", 1024)
+    ms = MockStorage()
+    sw = StreamRecorder()
+    email = "example@example.com"
+    to_email = "example-to@example.com"
+    message_raw = b"Subject: large\r\n\r\n" + os.urandom(100 * 1024)
+    sw.inject_message(
+        email,
+        {
+            "id": random_string(),
+            "raw": encode_base64url(message_raw),
+            "internalDate": str(int(datetime.now().timestamp() * 1000)),
+            "snippet": "A short snippet",
+        },
+    )
+    gmail = Gmail(email=email, storage=ms, service_wrapper=sw)
+    assert gmail.backup()
+    sw.inject_messages_clear()
+    sw.inject_labels_clear()
+    filtr = GmailFilter()
+    filtr.with_match_missing()
+    assert gmail.restore(filtr, add_labels=[], to_email=to_email)
+    assert len(sw.streams) == 1
+    # larger than the spool size, so it is not kept in memory
+    assert sw.streams[0]._rolled
+    restored = list(sw.get_messages(to_email, q="all").values())
+    assert len(restored) == 1
+    assert restored[0]["raw"] == encode_base64url(message_raw)
+
+
+def stored_bytes(root: str, suffix: str) -> int:
+    total = 0
+    for path, _, files in os.walk(root):
+        total += sum(
+            os.path.getsize(os.path.join(path, f)) for f in files if f.endswith(suffix)
+        )
+    return total
+
+
+@pytest.mark.parametrize("storage_type", ["file", "metadata_segments", "pack"])
+def test_compact(tmp_path, storage_type: str):
+    root = str(tmp_path / "gmail")
+    if storage_type == "pack":
+        storage = PackStorage(root)
+    else:
+        storage = FileStorage(
+            root, metadata_segments=storage_type == "metadata_segments"
+        )
+    sw = MockGmailServiceWrapper()
+    email = "example@example.com"
+    sw.inject_label(email, "INBOX", "INBOX", "system")
+    sw.inject_label(email, "old label", "Label_1", "user")
+
+    def inject(message_id: str, label_ids: list[str]):
+        sw.inject_message(
+            email,
+            {
+                "id": message_id,
+                "raw": encode_base64url(
+                    bytes(f"Message body... {message_id}", "utf-8")
+                ),
+                "internalDate": str(int(datetime.now().timestamp() * 1000)),
+                "labelIds": label_ids,
+            },
+        )
+
+    inject("kept", ["INBOX"])
+    inject("deleted", ["INBOX"])
+    gmail = Gmail(email=email, storage=storage, service_wrapper=sw)
+    assert gmail.backup()
+    # new metadata versions, a new labels snapshot, and a deleted message
+    inject("kept", ["INBOX", "Label_1"])
+    assert gmail.backup()
+    inject("kept", ["INBOX"])
+    sw.inject_labels_clear()
+    sw.inject_label(email, "INBOX", "INBOX", "system")
+    sw.inject_messages_clear()
+    inject("kept", ["INBOX"])
+    assert gmail.backup()
+
+    def links(object_id: str) -> list[LinkInterface]:
+        return list(storage.get_versions(object_id))
+
+    assert len([l for l in links("kept") if l.is_metadata()]) == 3
+    assert len(links(Gmail.object_id_labels)) == 2
+
+    assert gmail.compact(keep_metadata_versions=2)
+    assert len([l for l in links("kept") if l.is_metadata()]) == 2
+    assert len([l for l in links("kept") if l.is_object()]) == 1
+    deleted = [l for l in links("deleted") if l.is_object()]
+    assert [l.is_deleted() for l in deleted] == [True]
+    labels = links(Gmail.object_id_labels)
+    assert len(labels) == 1
+    with storage.get(labels[0]) as f:
+        # the restore still knows the removed label
+        assert sorted(l["name"] for l in json.load(f)) == ["INBOX", "old label"]
+
+    # the deleted messages are kept by default, then dropped after the retention
+    assert gmail.compact(keep_metadata_versions=1)
+    assert len(links("deleted")) == 2
+    assert len(links("kept")) == 2
+    time.sleep(0.01)
+    assert gmail.compact(keep_metadata_versions=1, deleted_retention_days=0)
+    assert links("deleted") == []
+    assert len(links("kept")) == 2
+    # compacting again is a no-op, a backup is still incremental
+    assert gmail.compact(keep_metadata_versions=1, deleted_retention_days=0)
+    assert gmail.backup()
+    assert len(links("kept")) == 2
+    # the merged labels differ from the labels on the server
+    assert len(links(Gmail.object_id_labels)) == 2
+
+    # the space of the removed links is reclaimed
+    live = storage.find()
+    if storage_type == "pack":
+        locations = {(l.segment, l.offset, l.length) for l in live}
+        assert stored_bytes(root, ".pack") == sum(l for _, _, l in locations)
+    elif storage_type == "metadata_segments":
+        metadata = [l for l in live if l.is_metadata() and not l.is_special_id()]
+        size = 0
+        for link in metadata:
+            with storage.get(link) as f:
+                size += len(f.read())
+        assert stored_bytes(root, ".seg") == size
+
+
+def test_verify(tmp_path, monkeypatch):
+    storage = FileStorage(str(tmp_path / "gmail"))
+    sw = MockGmailServiceWrapper()
+    email = "example@example.com"
+    for i in range(6):
+        sw.inject_message(
+            email,
+            {
+                "id": f"message-{i}",
+                "raw": encode_base64url(bytes(f"Message body... {i}", "utf-8")),
+                "internalDate": str(int(datetime.now().timestamp() * 1000)),
+            },
+        )
+    gmail = Gmail(email=email, storage=storage, service_wrapper=sw)
+    assert gmail.backup()
+    report_path = str(tmp_path / "report.json")
+    assert gmail.verify(report_path, workers=2)
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report["counts"]["ok"] == 6
+    assert report["problems"] == []
+    assert not os.path.exists(report_path + ".checkpoint")
+
+    corrupt = storage.get_latest("message-1").object
+    with open(corrupt.get_file_path(), "wb") as f:
+        f.write(gzip.compress(b"Modified body"))
+    missing = storage.get_latest("message-2").object
+    os.remove(missing.get_file_path())
+
+    # interrupted after the first batch
+    monkeypatch.setattr(Gmail, "verify_batch_size", 1)
+    calls = []
+    monkeypatch.setattr(
+        "gwbackupy.gmail.is_killed", lambda: calls.append(None) or len(calls) > 1
+    )
+    assert not gmail.verify(report_path, workers=1)
+    with open(report_path + ".checkpoint", "a") as f:
+        f.write('{"links": ["partial')
+    monkeypatch.setattr("gwbackupy.gmail.is_killed", lambda: False)
+    assert not gmail.verify(report_path, workers=2)
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report["resumed"] >= 1
+    assert report["counts"] == {"ok": 4, "unhashed": 0, "corrupt": 1, "missing": 1}
+    assert sorted((p["object_id"], p["status"]) for p in report["problems"]) == [
+        ("message-1", "corrupt"),
+        ("message-2", "missing"),
+    ]
+
+
+def test_verify_reads_primary_storage(tmp_path):
+    primary = FileStorage(str(tmp_path / "gmail"))
+    storage = CachedStorage(primary, str(tmp_path / "cache"))
+    sw = MockGmailServiceWrapper()
+    email = "example@example.com"
+    message_raw = bytes("Message body...", "utf-8")
+    sw.inject_message(
+        email,
+        {
+            "id": "message",
+            "raw": encode_base64url(message_raw),
+            "internalDate": str(int(datetime.now().timestamp() * 1000)),
+        },
+    )
+    gmail = Gmail(email=email, storage=storage, service_wrapper=sw)
+    assert gmail.backup()
+    report_path = str(tmp_path / "report.json")
+    assert gmail.verify(report_path, workers=1)
+
+    # corrupt on the primary storage, the cached copy is intact
+    link = primary.get_latest("message").object
+    with open(link.get_file_path(), "wb") as f:
+        f.write(gzip.compress(b"Modified body"))
+    with storage.get(link) as f:
+        assert gzip.decompress(f.read()) == message_raw
+    assert not gmail.verify(report_path, workers=1)
+    with open(report_path) as f:
+        report = json.load(f)
+    assert [(p["object_id"], p["status"]) for p in report["problems"]] == [
+        ("message", "corrupt")
+    ]
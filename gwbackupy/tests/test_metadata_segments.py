@@ -0,0 +1,229 @@
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from gwbackupy.gmail import Gmail
+from gwbackupy.helpers import random_string, encode_base64url
+from gwbackupy.storage.file_storage import FileStorage
+from gwbackupy.storage.metadata_segments import MetadataSegments
+from gwbackupy.storage.storage_interface import LinkInterface
+from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
+
+
+def test_put_get_remove_rename():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        segments = MetadataSegments(temproot)
+        day = os.path.join(temproot, "2023", "03-06")
+        os.makedirs(os.path.dirname(day))
+        segments.put(day, "a.json", b"aaa")
+        segments.put(day, "b.json", b"bb")
+        segments.put(day, "a.json", b"a2")
+        assert segments.read(day, "a.json") == b"a2"
+        assert segments.read(day, "b.json") == b"bb"
+        segments.rename(day, "b.json", "c.json")
+        assert segments.read(day, "b.json") is None
+        segments.remove(day, "a.json")
+        assert segments.remove(day, "a.json") == []
+        assert list(segments.iter_records()) == [(day, "c.json")]
+        segments.close()
+
+        # reopen, with an interrupted index append
+        with open(MetadataSegments.index_path(os.path.dirname(day), "03"), "a") as f:
+            f.write("+03-06/d.json\t0")
+        segments = MetadataSegments(temproot)
+        assert list(segments.iter_records()) == [(day, "c.json")]
+        assert segments.read(day, "c.json") == b"bb"
+        segments.close()
+
+
+def test_records_of():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        day = os.path.join(temproot, "2023", "03-06")
+        day2 = os.path.join(temproot, "2024", "11-30")
+        os.makedirs(os.path.dirname(day))
+        os.makedirs(os.path.dirname(day2))
+        segments = MetadataSegments(temproot)
+        segments.put(day, "a.metadata=.mutation=1.json", b"a1")
+        segments.put(day, "ab.metadata=.mutation=1.json", b"ab")
+        segments.close()
+
+        segments = MetadataSegments(temproot)
+        assert segments.records_of("a") == [(day, "a.metadata=.mutation=1.json")]
+        segments.put(day2, "a.metadata=.mutation=2.json", b"a2")
+        segments.rename(day, "ab.metadata=.mutation=1.json", "a.json")
+        segments.remove(day, "a.metadata=.mutation=1.json")
+        assert segments.records_of("a") == [
+            (day, "a.json"),
+            (day2, "a.metadata=.mutation=2.json"),
+        ]
+        assert segments.records_of("ab") == []
+        assert segments.records_of("x") == []
+        segments.close()
+
+
+def test_append_after_torn_record():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        day = os.path.join(temproot, "2023", "07-01")
+        os.makedirs(os.path.dirname(day))
+        index_path = MetadataSegments.index_path(os.path.dirname(day), "07")
+        segments = MetadataSegments(temproot)
+        segments.put(day, "a.json", b"aaa")
+        segments.close()
+        with open(index_path, "a") as f:
+            # a complete invalid record, and an interrupted append
+            f.write("+07-01/x.json\tnot-a-number\n+07-01/b.json\t3")
+        segments = MetadataSegments(temproot)
+        segments.put(day, "c.json", b"ccc")
+        segments.close()
+
+        segments = MetadataSegments(temproot)
+        assert segments.read(day, "a.json") == b"aaa"
+        assert segments.read(day, "b.json") is None
+        assert segments.read(day, "c.json") == b"ccc"
+        assert sorted(name for _, name in segments.iter_records()) == [
+            "a.json",
+            "c.json",
+        ]
+        segments.close()
+        with open(index_path) as f:
+            assert f.read().endswith("+07-01/c.json\t3\t3\n")
+
+
+def test_compact():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        year_dir = os.path.join(temproot, "2023")
+        day = os.path.join(year_dir, "03-06")
+        os.makedirs(year_dir)
+        segment_path = MetadataSegments.segment_path(year_dir, "03")
+        index_path = MetadataSegments.index_path(year_dir, "03")
+        segments = MetadataSegments(temproot)
+        segments.put(day, "a.json", b"aaa")
+        segments.put(day, "b.json", b"bb")
+        segments.put(day, "a.json", b"a2")
+        segments.rename(day, "b.json", "c.json")
+        assert segments.read(day, "c.json") == b"bb"
+        assert segments.compact() == [year_dir]
+        assert os.path.getsize(segment_path) == 4
+        assert segments.read(day, "a.json") == b"a2"
+        assert segments.read(day, "c.json") == b"bb"
+        # nothing to reclaim
+        assert segments.compact() == []
+        segments.remove(day, "a.json")
+        segments.close()
+
+        # interrupted before the segment replace: the old files are kept
+        with open(f"{segment_path}.tmp", "wb") as f:
+            f.write(b"xx")
+        with open(f"{index_path}.tmp", "w") as f:
+            f.write("+03-06/c.json\t0\t2\n")
+        segments = MetadataSegments(temproot)
+        assert segments.read(day, "c.json") == b"bb"
+        assert not os.path.exists(f"{index_path}.tmp")
+        assert not os.path.exists(f"{segment_path}.tmp")
+        segments.close()
+
+        # interrupted after the segment replace: the index replace is finished
+        with open(segment_path, "wb") as f:
+            f.write(b"bb")
+        with open(f"{index_path}.tmp", "w") as f:
+            f.write("+03-06/c.json\t0\t2\n")
+        segments = MetadataSegments(temproot)
+        assert list(segments.iter_records()) == [(day, "c.json")]
+        assert segments.read(day, "c.json") == b"bb"
+        assert segments.compact() == []
+        segments.close()
+
+
+def test_location_of():
+    segments = MetadataSegments("/tmp/root")
+    assert segments.location_of("/tmp/root/2023/03-06") == (
+        "/tmp/root/2023",
+        "03",
+        "03-06",
+    )
+    assert segments.location_of("/tmp/root") is None
+    assert segments.location_of("/tmp/other/2023/03-06") is None
+
+
+def test_file_storage():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot, metadata_segments=True)
+        ts = time.time()
+        link = fs.new_link("id1", "json", ts).set_properties(
+            {LinkInterface.property_metadata: True}
+        )
+        assert fs.put(link, '{"a": 1}')
+        obj = fs.new_link("id1", "eml.gz", ts).set_properties(
+            {LinkInterface.property_object: True}
+        )
+        assert fs.put(obj, b"object")
+        # metadata is not a standalone file, the object is
+        assert not os.path.exists(link.get_file_path())
+        assert os.path.exists(obj.get_file_path())
+        links = fs.find()
+        assert len(links) == 2
+        assert link in links and obj in links
+        with fs.get(link) as f:
+            assert f.read() == b'{"a": 1}'
+
+        link2 = link.clone().set_properties({"custom": "x"})
+        assert fs.modify(link, link2)
+        assert not fs.modify(link, link2)
+        assert fs.remove(link2)
+        links = FileStorage(root=temproot).find()
+        assert len(links) == 3
+        deleted = [l for l in links if l.is_deleted()]
+        assert len(deleted) == 1
+        with fs.get(deleted[0]) as f:
+            assert f.read() == b'{"a": 1}'
+        assert fs.remove(link2, as_new_mutation=False)
+        assert len(fs.find()) == 2
+        # special ids are standalone files
+        labels = fs.new_link(Gmail.object_id_labels, "json").set_properties(
+            {LinkInterface.property_metadata: True}
+        )
+        assert fs.put(labels, b"[]")
+        assert os.path.exists(labels.get_file_path())
+
+
+def test_mixed_mode():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot)
+        ts = time.time()
+        link = fs.new_link("id1", "json", ts).set_properties(
+            {LinkInterface.property_metadata: True, "mutation": "1000"}
+        )
+        assert fs.put(link, b"file")
+        fs = FileStorage(root=temproot, metadata_segments=True)
+        link2 = link.clone().set_properties({"mutation": "2000"})
+        assert fs.put(link2, b"segment")
+        links = FileStorage(root=temproot).find()
+        assert len(links) == 2
+        for l in links:
+            with fs.get(l) as f:
+                assert f.read() == (b"file" if l.mutation() == "1000" else b"segment")
+
+
+def test_gmail_backup():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        fs = FileStorage(root=temproot, metadata_segments=True)
+        sw = MockGmailServiceWrapper()
+        email = "example@example.com"
+        for _ in range(3):
+            message_id = random_string()
+            sw.inject_message(
+                email,
+                {
+                    "id": message_id,
+                    "raw": encode_base64url(bytes(f"Message {message_id}", "utf-8")),
+                    "internalDate": str(int(datetime.now().timestamp() * 1000)),
+                },
+            )
+        gmail = Gmail(email=email, storage=fs, service_wrapper=sw)
+        assert gmail.backup()
+        assert gmail.backup()
+        metadata = fs.find(lambda l: l.is_metadata() and not l.is_special_id())
+        assert len(metadata) == 3
+        for link in metadata:
+            assert not os.path.exists(link.get_file_path())
@@ -0,0 +1,66 @@
+import gzip
+import io
+
+import pytest
+
+from gwbackupy.object_codec import GzipCodec, ZstdCodec, codec_of_extension
+
+
+def encode(codec, data: bytes) -> bytes:
+    stream = io.BytesIO()
+    codec.writer(data)(stream)
+    return stream.getvalue()
+
+
+def samples(count: int) -> list[bytes]:
+    return [
+        (
+            f"From: sender{i % 7}@example.com\r\nTo: user@example.com\r\n"
+            f"Subject: Report {i}\r\nX-Mailer: gwbackupy-test\r\n"
+            f"Content-Type: text/plain; charset=UTF-8\r\n\r\nBody of message {i}\r\n"
+        ).encode("utf-8")
+        for i in range(count)
+    ]
+
+
+def test_gzip_codec():
+    codec = GzipCodec()
+    data = b"Message body" * 100
+    encoded = encode(codec, data)
+    assert gzip.decompress(encoded) == data
+    # deterministic output
+    assert encode(codec, data) == encoded
+    assert codec.decompress(io.BytesIO(encoded)) == data
+
+
+def test_codec_of_extension():
+    assert codec_of_extension("eml.gz") is GzipCodec
+    assert codec_of_extension("eml.zst") is ZstdCodec
+    assert codec_of_extension(None) is GzipCodec
+    assert codec_of_extension("eml") is GzipCodec
+
+
+def test_zstd_codec():
+    pytest.importorskip("zstandard")
+    codec = ZstdCodec()
+    data = b"Message body" * 100
+    encoded = encode(codec, data)
+    assert len(encoded) < len(data)
+    assert codec.decompress(io.BytesIO(encoded)) == data
+
+
+def test_zstd_codec_dictionary():
+    pytest.importorskip("zstandard")
+    messages = samples(1000)
+    dictionary = ZstdCodec.train(messages, size=4096)
+    codec = ZstdCodec(dictionary=dictionary)
+    assert codec.has_dictionary()
+    message = messages[0]
+    encoded = encode(codec, message)
+    assert len(encoded) < len(encode(ZstdCodec(), message))
+    assert codec.decompress(io.BytesIO(encoded)) == message
+    # decoder selects the dictionary by the frame header
+    decoder = ZstdCodec(dictionaries=[ZstdCodec.train(messages[1:], 4096), dictionary])
+    assert decoder.decompress(io.BytesIO(encoded)) == message
+    with pytest.raises(RuntimeError):
+        ZstdCodec().decompress(io.BytesIO(encoded))
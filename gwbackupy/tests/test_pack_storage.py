@@ -0,0 +1,150 @@
+import gzip
+import io
+import os
+import tempfile
+from datetime import datetime
+
+from gwbackupy.gmail import Gmail
+from gwbackupy.helpers import random_string, encode_base64url
+from gwbackupy.storage.pack_storage import PackStorage
+from gwbackupy.storage.storage_interface import LinkInterface
+from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
+
+
+def test_put_get_find():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ps = PackStorage(root=temproot)
+        link = ps.new_link("testid", "json").set_properties(
+            {LinkInterface.property_metadata: True}
+        )
+        assert ps.put(link, '{"a": 1}')
+        link2 = ps.new_link("testid", "eml.gz").set_properties(
+            {LinkInterface.property_object: True}
+        )
+        data = bytes(range(256)) * 1000
+        assert ps.put(link2, io.BytesIO(data))
+        links = ps.find()
+        assert len(links) == 2
+        assert link in links and link2 in links
+        with ps.get(link) as f:
+            assert f.read() == b'{"a": 1}'
+        with ps.get(link2) as f:
+            assert f.read(10) == data[:10]
+            f.seek(0)
+            assert f.read() == data
+        assert len(ps.find(lambda l: l.is_object())) == 1
+        ps.close()
+
+        # reopen
+        ps = PackStorage(root=temproot)
+        links = ps.find()
+        assert len(links) == 2
+        with ps.get(link2) as f:
+            assert f.read() == data
+
+
+def test_remove_and_modify():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ps = PackStorage(root=temproot)
+        link = ps.new_link("testid", "json").set_properties(
+            {LinkInterface.property_metadata: True, "mutation": "1000"}
+        )
+        assert ps.put(link, b"test")
+        assert ps.remove(link)
+        links = ps.find()
+        assert len(links) == 2
+        deleted = [l for l in links if l.is_deleted()]
+        assert len(deleted) == 1
+        with ps.get(deleted[0]) as f:
+            assert f.read() == b"test"
+        # both links point to the same data
+        assert os.path.getsize(os.path.join(temproot, "000001.pack")) == 4
+
+        link2 = link.clone().set_properties({"custom": "x"})
+        assert ps.modify(link, link2)
+        assert not ps.modify(link, link2)
+        with ps.get(link2) as f:
+            assert f.read() == b"test"
+        assert ps.remove(link2, as_new_mutation=False)
+        assert len(ps.find()) == 1
+        assert not ps.remove(link2)
+        ps.close()
+        assert len(PackStorage(root=temproot).find()) == 1
+
+
+def test_segment_rolling_and_compact():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ps = PackStorage(root=temproot, segment_size=1000)
+        for i in range(10):
+            for mutation in ["1000", "2000"]:
+                link = ps.new_link(f"id{i}", "eml.gz").set_properties(
+                    {LinkInterface.property_object: True, "mutation": mutation}
+                )
+                assert ps.put(link, bytes([i]) * 300)
+        labels = ps.new_link(Gmail.object_id_labels, "json").set_properties(
+            {LinkInterface.property_metadata: True, "mutation": "1000"}
+        )
+        assert ps.put(labels, b"[]")
+        labels2 = labels.clone().set_properties({"mutation": "2000"})
+        assert ps.put(labels2, b"[1]")
+        segments = [n for n in os.listdir(temproot) if n.endswith(".pack")]
+        assert len(segments) > 1
+        assert ps.compact() == 10
+        links = ps.find()
+        assert len(links) == 12
+        for link in links:
+            if link.is_special_id():
+                continue
+            assert link.mutation() == "2000"
+            with ps.get(link) as f:
+                assert f.read() == bytes([int(link.id()[2:])]) * 300
+        total = sum(
+            os.path.getsize(os.path.join(temproot, n))
+            for n in os.listdir(temproot)
+            if n.endswith(".pack")
+        )
+        assert total == 10 * 300 + 2 + 3
+        ps.close()
+        assert len(PackStorage(root=temproot).find()) == 12
+
+
+def test_incomplete_index_tail():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ps = PackStorage(root=temproot)
+        link = ps.new_link("testid", "json")
+        assert ps.put(link, b"test")
+        ps.close()
+        with open(os.path.join(temproot, PackStorage.index_file_name), "ab") as f:
+            f.write(b'{"op":"+","id":"broken"')
+        ps = PackStorage(root=temproot)
+        assert len(ps.find()) == 1
+        link2 = ps.new_link("testid2", "json")
+        assert ps.put(link2, b"test2")
+        ps.close()
+        assert len(PackStorage(root=temproot).find()) == 2
+
+
+def test_gmail_backup():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ps = PackStorage(root=temproot)
+        sw = MockGmailServiceWrapper()
+        email = "example@example.com"
+        message_id = random_string()
+        message_raw = bytes(f"Message body... {message_id}", "utf-8")
+        sw.inject_message(
+            email,
+            {
+                "id": message_id,
+                "raw": encode_base64url(message_raw),
+                "internalDate": str(int(datetime.now().timestamp() * 1000)),
+            },
+        )
+        gmail = Gmail(email=email, storage=ps, service_wrapper=sw)
+        assert gmail.backup()
+        assert gmail.backup()
+        objects = ps.find(lambda l: l.id() == message_id and l.is_object())
+        assert len(objects) == 1
+        with ps.get(objects[0]) as f:
+            assert gzip.decompress(f.read()) == message_raw
+        # labels, metadata, object
+        assert len(ps.find()) == 3
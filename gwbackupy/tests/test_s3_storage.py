@@ -0,0 +1,98 @@
+import io
+import time
+from datetime import datetime
+
+import pytest
+
+from gwbackupy.gmail import Gmail
+from gwbackupy.helpers import random_string, encode_base64url
+from gwbackupy.storage.storage_interface import LinkInterface
+from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from gwbackupy.storage.s3_storage import S3Storage  # noqa: E402
+
+
+@pytest.fixture
+def storage():
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="backup")
+        yield S3Storage(
+            "backup",
+            prefix="example@example.com/gmail",
+            client=client,
+            multipart_threshold=5 * 1024 * 1024,
+            multipart_chunksize=5 * 1024 * 1024,
+        )
+
+
+def test_put_get_find(storage: S3Storage):
+    ts = time.time()
+    link = storage.new_link("test/id", "json", ts).set_properties(
+        {LinkInterface.property_metadata: True}
+    )
+    assert storage.put(link, '{"a": 1}')
+    assert link.get_key().startswith("example@example.com/gmail/")
+    assert "test%2fid." in link.get_key()
+    obj = storage.new_link("test/id", "eml.gz", ts).set_properties(
+        {LinkInterface.property_object: True}
+    )
+    # multipart upload
+    data = bytes(range(256)) * (24 * 1024)
+    assert storage.put(obj, io.BytesIO(data))
+    labels = storage.new_link(Gmail.object_id_labels, "json")
+    assert storage.put(labels, lambda f: f.write(b"[]"))
+
+    links = storage.find()
+    assert len(links) == 3
+    assert link in links and obj in links and labels in links
+    with storage.get(link) as f:
+        assert f.read() == b'{"a": 1}'
+    with storage.get(obj) as f:
+        assert f.read() == data
+    assert len(storage.find(lambda l: l.is_object())) == 1
+    missing = storage.new_link("missing", "json")
+    with pytest.raises(FileNotFoundError):
+        storage.get(missing)
+
+
+def test_remove_and_modify(storage: S3Storage):
+    link = storage.new_link("testid", "json", time.time()).set_properties(
+        {LinkInterface.property_metadata: True}
+    )
+    assert storage.put(link, b"test")
+    assert storage.remove(link)
+    links = storage.find()
+    assert len(links) == 2
+    deleted = [l for l in links if l.is_deleted()]
+    assert len(deleted) == 1
+    with storage.get(deleted[0]) as f:
+        assert f.read() == b"test"
+
+    link2 = storage.content_hash_add(link)
+    assert storage.content_hash_check(link2)
+    assert not storage.modify(deleted[0], link2)
+    assert storage.remove(link2, as_new_mutation=False)
+    assert storage.find() == [deleted[0]]
+
+
+def test_gmail_backup(storage: S3Storage):
+    sw = MockGmailServiceWrapper()
+    email = "example@example.com"
+    message_id = random_string()
+    sw.inject_message(
+        email,
+        {
+            "id": message_id,
+            "raw": encode_base64url(bytes(f"Message body... {message_id}", "utf-8")),
+            "internalDate": str(int(datetime.now().timestamp() * 1000)),
+        },
+    )
+    gmail = Gmail(email=email, storage=storage, service_wrapper=sw)
+    assert gmail.backup()
+    assert gmail.backup()
+    # labels, metadata, object
+    assert len(storage.find()) == 3
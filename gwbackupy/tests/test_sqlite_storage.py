@@ -0,0 +1,194 @@
+import io
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from gwbackupy.gmail import Gmail
+from gwbackupy.helpers import random_string, encode_base64url
+from gwbackupy.storage.sqlite_storage import SqliteStorage
+from gwbackupy.storage.storage_interface import LinkInterface, LinkQuery
+from gwbackupy.tests.mock_gmail_service_wrapper import MockGmailServiceWrapper
+
+
+def test_put_get_find():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ss = SqliteStorage(root=temproot, inline_blob_size=100)
+        link = ss.new_link("testid", "json", time.time()).set_properties(
+            {LinkInterface.property_metadata: True}
+        )
+        assert ss.put(link, '{"a": 1}')
+        link2 = ss.new_link("testid", "eml.gz").set_properties(
+            {LinkInterface.property_object: True}
+        )
+        data = bytes(range(256)) * 10
+        assert ss.put(link2, io.BytesIO(data))
+        links = ss.find()
+        assert len(links) == 2
+        assert link in links and link2 in links
+        with ss.get(link) as f:
+            assert f.read() == b'{"a": 1}'
+        with ss.get(link2) as f:
+            assert f.read() == data
+        assert len(ss.find(lambda l: l.is_object())) == 1
+        ss.close()
+
+        # reopen
+        ss = SqliteStorage(root=temproot)
+        assert len(ss.find()) == 2
+        with ss.get(link2) as f:
+            assert f.read() == data
+        ss.close()
+
+
+def test_remove_and_modify():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ss = SqliteStorage(root=temproot, inline_blob_size=2)
+        link = ss.new_link("testid", "json").set_properties(
+            {LinkInterface.property_metadata: True, "mutation": "1000"}
+        )
+        assert ss.put(link, b"test")
+        assert ss.remove(link)
+        links = ss.find()
+        assert len(links) == 2
+        deleted = [l for l in links if l.is_deleted()]
+        assert len(deleted) == 1
+        with ss.get(deleted[0]) as f:
+            assert f.read() == b"test"
+
+        link2 = ss.content_hash_add(link)
+        assert ss.content_hash_check(link2)
+        assert not ss.modify(link, link2)
+        assert ss.remove(link2, as_new_mutation=False)
+        assert not ss.remove(link2)
+        # the blob file is kept for the deleted mutation
+        with ss.get(deleted[0]) as f:
+            assert f.read() == b"test"
+        assert ss.remove(deleted[0], as_new_mutation=False)
+        assert ss.find() == []
+        blobs = os.path.join(temproot, SqliteStorage.blobs_directory_name)
+        assert sum(len(files) for _, _, files in os.walk(blobs)) == 0
+        ss.close()
+
+
+def test_link_query():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ss = SqliteStorage(root=temproot)
+        for i in range(10):
+            for mutation in ["1000", "2000", "10000"]:
+                link = ss.new_link(f"id{i}", "json").set_properties(
+                    {
+                        LinkInterface.property_metadata: True,
+                        LinkInterface.property_deleted: i % 2 == 0,
+                        "mutation": mutation,
+                    }
+                )
+                assert ss.put(link, b"{}")
+        queries = [
+            LinkQuery(object_id="id3"),
+            LinkQuery(deleted=True),
+            LinkQuery(metadata=True, object=False, deleted=False),
+            LinkQuery(object=True),
+            LinkQuery(mutation_from="2000"),
+            LinkQuery(object_id="id4", mutation_from="1000", mutation_to="10000"),
+        ]
+        links = ss.find()
+        assert len(links) == 30
+        for query in queries:
+            # the pushed down query is the same as the evaluation as a filter
+            expected = [l for l in links if query(l)]
+            assert sorted(ss.find(query), key=lambda l: l.key()) == sorted(
+                expected, key=lambda l: l.key()
+            )
+        assert len(ss.find(LinkQuery(mutation_from="2000"))) == 20
+        ss.close()
+
+
+def test_get_versions_and_latest():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ss = SqliteStorage(root=temproot)
+        for i in range(3):
+            for mutation in ["1000", "3000", "2000"]:
+                link = ss.new_link(f"id{i}", "json").set_properties(
+                    {LinkInterface.property_metadata: True, "mutation": mutation}
+                )
+                assert ss.put(link, b"{}")
+        assert [l.mutation() for l in ss.get_versions("id1")] == [
+            "1000",
+            "2000",
+            "3000",
+        ]
+        assert ss.get_latest("id2").metadata.mutation() == "3000"
+        assert ss.get_latest("id3") is None
+        ss.close()
+
+
+def test_batched_transactions():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ss = SqliteStorage(root=temproot, batch_size=1000, batch_interval_ms=60000)
+        for i in range(10):
+            assert ss.put(ss.new_link(f"id{i}", "json"), b"{}")
+        # not committed yet
+        assert len(SqliteStorage(root=temproot).find()) == 0
+        assert ss.flush()
+        assert len(SqliteStorage(root=temproot).find()) == 10
+        ss.close()
+
+
+def test_blob_file_removed_after_commit():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        blobs = os.path.join(temproot, SqliteStorage.blobs_directory_name)
+
+        def blob_files() -> int:
+            return sum(len(files) for _, _, files in os.walk(blobs))
+
+        ss = SqliteStorage(root=temproot, inline_blob_size=2)
+        link = ss.new_link("testid", "eml").set_properties({"mutation": "1000"})
+        assert ss.put(link, b"test")
+        assert ss.flush()
+        ss.close()
+
+        ss = SqliteStorage(
+            root=temproot, inline_blob_size=2, batch_size=1000, batch_interval_ms=60000
+        )
+        assert ss.put(link, b"test2")
+        assert ss.remove(link, as_new_mutation=False)
+        # not committed yet (e.g. the process crashes), the committed row still has its blob
+        assert blob_files() == 2
+        other = SqliteStorage(root=temproot)
+        with other.get(link) as f:
+            assert f.read() == b"test"
+        other.close()
+        assert ss.flush()
+        assert blob_files() == 0
+
+        # the blob file of a failed insert is removed
+        invalid = ss.new_link("testid", "eml").set_properties({"mutation": "invalid"})
+        assert not ss.put(invalid, b"test")
+        assert blob_files() == 0
+        ss.close()
+
+
+def test_gmail_backup():
+    with tempfile.TemporaryDirectory(prefix="myapp-") as temproot:
+        ss = SqliteStorage(root=temproot)
+        sw = MockGmailServiceWrapper()
+        email = "example@example.com"
+        message_id = random_string()
+        sw.inject_message(
+            email,
+            {
+                "id": message_id,
+                "raw": encode_base64url(
+                    bytes(f"Message body... {message_id}", "utf-8")
+                ),
+                "internalDate": str(int(datetime.now().timestamp() * 1000)),
+            },
+        )
+        gmail = Gmail(email=email, storage=ss, service_wrapper=sw)
+        assert gmail.backup()
+        assert gmail.backup()
+        # labels, metadata, object
+        assert len(ss.find()) == 3
+        assert len(ss.find(LinkQuery(object_id=message_id, object=True))) == 1
+        ss.close()
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from gwbackupy.stage_executor import Stage
+
+
+def test_submit_and_join():
+    stage = Stage("test", 4)
+    results = []
+    lock = threading.Lock()
+
+    def work(i):
+        time.sleep(0.01)
+        with lock:
+            results.append(i)
+        return i * 2
+
+    futures = [stage.submit(work, i) for i in range(20)]
+    assert stage.join()
+    assert sorted(results) == list(range(20))
+    assert [f.result() for f in futures] == [i * 2 for i in range(20)]
+    metrics = stage.metrics()
+    assert metrics["submitted"] == 20
+    assert metrics["completed"] == 20
+    assert metrics["queue_depth"] == 0
+    assert metrics["max_queue_depth"] > 0
+    assert "test" in repr(stage)
+    stage.shutdown()
+
+
+def test_bounded_queue_blocks_submit():
+    stage = Stage("bounded", 1, max_queue=1)
+    release = threading.Event()
+    stage.submit(release.wait)
+    stage.submit(release.wait)
+    submitted = threading.Event()
+
+    def submit_third():
+        stage.submit(lambda: None)
+        submitted.set()
+
+    threading.Thread(target=submit_third, daemon=True).start()
+    assert not submitted.wait(0.2)
+    assert stage.queue_depth == 1
+    release.set()
+    assert submitted.wait(2)
+    assert stage.join()
+    assert stage.metrics()["max_queue_depth"] <= 2
+    assert stage.metrics()["blocked_seconds"] > 0
+    stage.shutdown()
+
+
+def test_join_stop_and_cancel():
+    stage = Stage("cancel", 1, max_queue=10)
+    release = threading.Event()
+    stage.submit(release.wait)
+    for _ in range(5):
+        stage.submit(release.wait)
+    assert not stage.join(should_stop=lambda: True)
+    stage.shutdown(wait=False, cancel_futures=True)
+    release.set()
+    stage.shutdown()
+    assert stage.queue_depth == 0
+    assert len(stage.pending()) == 0
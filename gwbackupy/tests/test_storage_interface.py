@@ -1,4 +1,4 @@
-from gwbackupy.storage.storage_interface import LinkInterface, LinkList
+from gwbackupy.storage.storage_interface import LinkIndex, LinkInterface, LinkList
 from gwbackupy.tests.helpers import get_exception
 from gwbackupy.tests.mock_not_impleneted_storage_interface import (
     MockNotImplementedStorage,
@@ -134,3 +134,61 @@ def test_link_list_find():
         "apple": {"x": link2},
         "apple2": {"x": link3},
     }
+
+
+def test_link_index():
+    ms = MockStorage()
+    index = LinkIndex()
+    assert len(index) == 0
+    assert index.latest("apple") is None
+    assert index.latest_metadata("apple") is None
+    assert index.latest_object("apple") is None
+    meta = ms.new_link("apple", "-")
+    meta.set_mutation_timestamp(1000)
+    meta.set_properties({LinkInterface.property_metadata: True})
+    meta2 = ms.new_link("apple", "-")
+    meta2.set_mutation_timestamp(3000)
+    meta2.set_properties(
+        {LinkInterface.property_metadata: True, LinkInterface.property_deleted: True}
+    )
+    obj = ms.new_link("apple", "-")
+    obj.set_mutation_timestamp(2000)
+    obj.set_properties({LinkInterface.property_object: True})
+    special = ms.new_link(LinkInterface.id_special_prefix + "apple", "-")
+    special.set_mutation_timestamp(1500)
+    for link in [meta2, obj, meta, special]:
+        index.add(link)
+    assert len(index) == 2
+    assert "apple" in index
+    assert index.latest("apple") == meta2
+    assert index.latest_metadata("apple") == meta2
+    assert index.latest_object("apple") == obj
+    assert index["apple"].object == obj
+    assert index.deleted_keys() == ["apple"]
+    assert index.special_keys() == [LinkInterface.id_special_prefix + "apple"]
+    assert list(index.iter_by_mutation()) == [special, meta2]
+    assert isinstance(get_exception(lambda: index.mutations("apple")), RuntimeError)
+    del index["apple"]
+    assert "apple" not in index
+    assert index.keys() == [LinkInterface.id_special_prefix + "apple"]
+
+
+def test_link_index_build():
+    ms = MockStorage()
+    links = []
+    for i in range(3):
+        link = ms.new_link("apple", "-")
+        link.set_mutation_timestamp(1000 + i)
+        link.set_properties({"email": "a" if i != 1 else "b"})
+        links.append(link)
+    links.reverse()
+    index = LinkIndex.build(
+        links,
+        f=lambda l: l.get_property("email") is not None,
+        key=lambda l: l.get_property("email"),
+        keep_mutations=True,
+    )
+    assert index.latest_links() == {"a": links[0], "b": links[1]}
+    assert index.mutations("a") == [links[2], links[0]]
+    assert index.mutations("not-exists") == []
+    assert index.get("b").latest == links[1]